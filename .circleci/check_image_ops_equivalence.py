@@ -0,0 +1,162 @@
+# Copyright © 2016-2020 Medical Image Analysis Laboratory, University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+"""Check that the in-process image operations match the MIALSRTK tools they replace.
+
+The script reads the nodes of a super-resolution workflow run with
+``--image_ops_backend numpy --fused_intensity_normalization``, runs the
+MIALSRTK tools (and :func:`pymialsrtk.interfaces.postprocess.binarize_image`)
+on the same inputs, and compares their outputs with the ones of
+:class:`~pymialsrtk.interfaces.preprocess.MaskImage`,
+:class:`~pymialsrtk.interfaces.postprocess.BinarizeImage` and
+:class:`~pymialsrtk.interfaces.preprocess.IntensityNormalization` with
+:func:`~pymialsrtk.interfaces.utils.check_image_equivalence`.
+
+Examples
+--------
+$ python check_image_ops_equivalence.py /output_dir/nipype/sub-01/rec-1/srr_pipeline --bids_dir /bids_dir
+
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+from glob import glob
+
+from nipype.pipeline.engine.utils import load_resultfile
+
+from pymialsrtk.interfaces import preprocess, postprocess
+from pymialsrtk.interfaces.utils import check_image_equivalence
+
+
+def get_node_results(p_node_dir):
+    """Return the results of a node, or of each of its iterations if it is a MapNode.
+
+    The paths of the outputs, saved relative to the node directory, are resolved.
+    """
+    results = sorted(glob(os.path.join(p_node_dir, 'mapflow', '_*', 'result_*.pklz')))
+    if not results:
+        results = glob(os.path.join(p_node_dir, 'result_*.pklz'))
+    return [load_resultfile(f, resolve=True) for f in results]
+
+
+def run_in(p_directory, p_interface):
+    """Run an interface with a working directory and return its outputs."""
+    cwd = os.getcwd()
+    os.makedirs(p_directory, exist_ok=True)
+    os.chdir(p_directory)
+    try:
+        return p_interface.run().outputs
+    finally:
+        os.chdir(cwd)
+
+
+def check_mask_image(p_node_dir, p_bids_dir, p_work_dir):
+    """Compare the outputs of a MaskImage node with the ones of ``mialsrtkMaskImage``."""
+    checks = []
+    for i, result in enumerate(get_node_results(p_node_dir)):
+        interface = preprocess.MialsrtkMaskImage(bids_dir=p_bids_dir,
+                                                 in_file=result.inputs['in_file'],
+                                                 in_mask=result.inputs['in_mask'],
+                                                 out_im_postfix=result.inputs['out_im_postfix'])
+        reference = run_in(os.path.join(p_work_dir, str(i)), interface).out_im_file
+        checks.append((result.outputs.out_im_file, reference,
+                       check_image_equivalence(result.outputs.out_im_file, reference, 'intensity')))
+    return checks
+
+
+def check_binarize_image(p_node_dir, p_work_dir):
+    """Compare the output of a BinarizeImage node with the one of ``binarize_image``."""
+    checks = []
+    for i, result in enumerate(get_node_results(p_node_dir)):
+        directory = os.path.join(p_work_dir, str(i))
+        os.makedirs(directory, exist_ok=True)
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            reference = postprocess.binarize_image(result.inputs['input_image'])
+        finally:
+            os.chdir(cwd)
+        checks.append((result.outputs.output_srmask, reference,
+                       check_image_equivalence(result.outputs.output_srmask, reference, 'mask')))
+    return checks
+
+
+def check_intensity_normalization(p_node_dir, p_bids_dir, p_work_dir, p_tolerance):
+    """Compare the outputs of an IntensityNormalization node with the ones of the MIALSRTK sequence.
+
+    The sequence is the one run by the workflow without ``--fused_intensity_normalization``:
+    ``mialsrtkIntensityStandardization``, ``mialsrtkHistogramNormalization`` and
+    ``mialsrtkIntensityStandardization``.
+    """
+    checks = []
+    for i, result in enumerate(get_node_results(p_node_dir)):
+        directory = os.path.join(p_work_dir, str(i))
+        images = run_in(os.path.join(directory, 'standardization01'),
+                        preprocess.MialsrtkIntensityStandardization(
+                            bids_dir=p_bids_dir, input_images=result.inputs['input_images'])).output_images
+        images = run_in(os.path.join(directory, 'histogram_normalization'),
+                        preprocess.MialsrtkHistogramNormalization(
+                            bids_dir=p_bids_dir, input_images=images,
+                            input_masks=result.inputs['input_masks'])).output_images
+        references = run_in(os.path.join(directory, 'standardization02'),
+                            preprocess.MialsrtkIntensityStandardization(
+                                bids_dir=p_bids_dir, input_images=images)).output_images
+
+        references = {os.path.basename(f): f for f in references}
+        for output in result.outputs.output_images:
+            reference = references.get(os.path.basename(output))
+            checks.append((output, reference,
+                           reference is not None and
+                           check_image_equivalence(output, reference, 'intensity', p_tolerance)))
+    return checks
+
+
+def get_parser():
+    """Create the parser of the script."""
+    p = argparse.ArgumentParser(description='Check that the in-process image operations of a workflow run '
+                                            'with --image_ops_backend numpy --fused_intensity_normalization '
+                                            'match the MIALSRTK tools.')
+    p.add_argument('pipeline_dir',
+                   help='Working directory of the workflow, e.g. '
+                        '``<output_dir>/nipype/sub-01/rec-1/srr_pipeline``')
+    p.add_argument('--bids_dir', required=True,
+                   help='BIDS root directory, in which the MIALSRTK tools are run')
+    p.add_argument('--work_dir', default=None,
+                   help='Directory where the outputs of the MIALSRTK tools are written '
+                        '(Default: temporary directory)')
+    p.add_argument('--tolerance', type=float, default=1e-5,
+                   help='Maximal absolute difference between the normalized intensities, relative '
+                        'to the maximal intensity. (Default: 1e-5)')
+    return p
+
+
+def main():
+    """Run the checks and return 0 if all the outputs are equivalent, 1 otherwise."""
+    args = get_parser().parse_args()
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='image_ops_')
+
+    checks = []
+    for node in ['srtkMaskImage01', 'srtkMaskImage02']:
+        checks += check_mask_image(os.path.join(args.pipeline_dir, node), args.bids_dir,
+                                   os.path.join(work_dir, node))
+    checks += check_binarize_image(os.path.join(args.pipeline_dir, 'srtkHRMask'),
+                                   os.path.join(work_dir, 'srtkHRMask'))
+    for node in ['srtkIntensityNormalization', 'srtkIntensityNormalization_nlm']:
+        if os.path.isdir(os.path.join(args.pipeline_dir, node)):
+            checks += check_intensity_normalization(os.path.join(args.pipeline_dir, node), args.bids_dir,
+                                                    os.path.join(work_dir, node), args.tolerance)
+
+    for output, reference, equivalent in checks:
+        print('{}: {} (reference: {})'.format('OK' if equivalent else 'DIFFERENT', output, reference))
+
+    if not checks:
+        print('No image operation found in {}'.format(args.pipeline_dir))
+        return 1
+    return 0 if all(equivalent for _, _, equivalent in checks) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,6 +7,9 @@
 import os
 import sys
 import json
+import datetime
+import tempfile
+from glob import glob
 # from traits.api import *
 
 import multiprocessing
@@ -14,6 +17,9 @@ import multiprocessing
 # Import the super-resolution pipeline
 from pymialsrtk.parser import get_parser
 from pymialsrtk.pipelines.anatomical.srr import AnatomicalPipeline
+from pymialsrtk.pipelines.resources import get_stacks_geometry
+from pymialsrtk.interfaces.utils import CPU_AFFINITY_LEDGER_ENV, get_available_cores, init_cpu_affinity_ledger
+from pymialsrtk.info import __version__
 
 
 def return_default_nb_of_cores(nb_of_cores, openmp_proportion=2):
@@ -137,7 +143,14 @@ def check_and_return_valid_nb_of_cores(openmp_nb_of_cores, nipype_nb_of_cores, o
 
 
 def main(bids_dir, output_dir, subject, p_stacks, session, paramTV=None, number_of_cores=1, srID=None,
-         masks_derivatives_dir='', dict_custom_interfaces=None): #skip_svr=False, do_refine_hr_mask=False, skip_nlm_denoising=False, skip_stacks_ordering=False):
+         masks_derivatives_dir='', dict_custom_interfaces=None, hash_method='cached',
+         work_dir=None, prune_intermediates=False, keep_only_outputs=False,
+         uncompressed_intermediates=False, image_ops_backend='mialsrtk',
+         fused_intensity_normalization=False, crop_to_roi=False, roi_margin=10.0,
+         openmp_number_of_cores=None, memory_gb=None, dry_run=False,
+         execution_backend='nipype', dask_scheduler=None, cpu_affinity=False,
+         tv_checkpoint_loops=0, tv_stop_tolerance=0.0, time_budget=None,
+         svr_warm_start=False, pack_transforms=False): #skip_svr=False, do_refine_hr_mask=False, skip_nlm_denoising=False, skip_stacks_ordering=False):
     """Main function that creates and executes the workflow of the BIDS App on one subject.
 
     It creates an instance of the class :class:`pymialsrtk.pipelines.anatomical.srr.AnatomicalPipeline`,
@@ -185,6 +198,73 @@ def main(bids_dir, output_dir, subject, p_stacks, session, paramTV=None, number_
     skip_stacks_ordering <bool> (optional)
         Weither the automatic stacks ordering should be skipped. (default is False)
 
+    hash_method <string>
+        Method used to hash the input files of the workflow nodes
+        (``"cached"``, ``"content"`` or ``"timestamp"``). (default is ``"cached"``)
+
+    work_dir <string>
+        Directory where the Nipype working directories are created (optional)
+
+    prune_intermediates <bool>
+        Weither intermediate outputs are deleted as soon as they are not needed anymore. (default is False)
+
+    keep_only_outputs <bool>
+        Weither only the final derivatives, the logs and a provenance file are kept at the end. (default is False)
+
+    uncompressed_intermediates <bool>
+        Weither intermediate images are written uncompressed (``.nii``). (default is False)
+
+    image_ops_backend <string>
+        Implementation of the simple image operations (``"mialsrtk"`` or ``"numpy"``). (default is ``"mialsrtk"``)
+
+    fused_intensity_normalization <bool>
+        Weither the intensity standardization and histogram normalization steps are run as a single stage. (default is False)
+
+    crop_to_roi <bool>
+        Weither the stacks are cropped to the bounding box of their brain mask before the processing. (default is False)
+
+    roi_margin <float>
+        Margin in mm added around the bounding box of the brain mask. (default is 10.0)
+
+    openmp_number_of_cores <int>
+        Number of threads of the multithreaded steps, the other steps using one thread each.
+        If None, all steps inherit ``OMP_NUM_THREADS``. (default is None)
+
+    memory_gb <float>
+        Memory in GB available to the Nipype engine. If None, 90% of the system memory is used. (default is None)
+
+    dry_run <bool>
+        Weither the execution is only predicted from the headers of the stacks, without running the workflow.
+        The prediction is returned instead of the execution results. (default is False)
+
+    execution_backend <string>
+        Execution backend of the workflow (``"nipype"``, ``"dask"`` or ``"native"``). (default is ``"nipype"``)
+
+    dask_scheduler <string>
+        Address of the scheduler of an existing Dask cluster. If None, a local cluster is
+        started with the ``"dask"`` execution backend. (default is None)
+
+    cpu_affinity <bool>
+        Weither each running MIALSRTK tool is pinned to a set of cores disjoint from the other running tools.
+        (default is False)
+
+    tv_checkpoint_loops <int>
+        Number of loops of each checkpointed segment of the TV super-resolution (0: no checkpoint). (default is 0)
+
+    tv_stop_tolerance <float>
+        Relative change between two checkpoints below which the TV super-resolution is stopped. (default is 0.0)
+
+    time_budget <float>
+        Wall-clock time budget in minutes of the reconstruction, whose settings are degraded
+        to fit in it. If None, the configured settings are used. (default is None)
+
+    svr_warm_start <bool>
+        Weither the slice-to-volume registration of the unchanged stacks is initialized with
+        the transforms cached by the previous reconstructions of the subject. (default is False)
+
+    pack_transforms <bool>
+        Weither the slice transforms of all the stacks are also saved in a single NPZ file. (default is False)
+
     """
 
     if paramTV is None:
@@ -205,7 +285,25 @@ def main(bids_dir, output_dir, subject, p_stacks, session, paramTV=None, number_
                                   session,
                                   paramTV,
                                   masks_derivatives_dir,
-                                  p_dict_custom_interfaces=dict_custom_interfaces)
+                                  p_dict_custom_interfaces=dict_custom_interfaces,
+                                  p_hash_method=hash_method,
+                                  p_work_dir=work_dir,
+                                  p_prune_intermediates=prune_intermediates,
+                                  p_keep_only_outputs=keep_only_outputs,
+                                  p_uncompressed_intermediates=uncompressed_intermediates,
+                                  p_image_ops_backend=image_ops_backend,
+                                  p_fused_intensity_normalization=fused_intensity_normalization,
+                                  p_crop_to_roi=crop_to_roi,
+                                  p_roi_margin=roi_margin,
+                                  p_openmp_number_of_cores=openmp_number_of_cores,
+                                  p_execution_backend=execution_backend,
+                                  p_dask_scheduler=dask_scheduler,
+                                  p_cpu_affinity=cpu_affinity,
+                                  p_tv_checkpoint_loops=tv_checkpoint_loops,
+                                  p_tv_stop_tolerance=tv_stop_tolerance,
+                                  p_time_budget=time_budget,
+                                  p_svr_warm_start=svr_warm_start,
+                                  p_pack_transforms=pack_transforms)
                                   # skip_svr,
                                   # do_refine_hr_mask,
                                   # p_skip_nlm_denoising=skip_nlm_denoising,
@@ -213,12 +311,385 @@ def main(bids_dir, output_dir, subject, p_stacks, session, paramTV=None, number_
     # Create the super resolution Nipype workflow
     pipeline.create_workflow()
 
+    if dry_run:
+        plan = pipeline.dry_run(number_of_cores=number_of_cores, memory_gb=memory_gb)
+        print(json.dumps(plan, indent=4))
+        return plan
+
     # Execute the workflow
-    res = pipeline.run(number_of_cores=number_of_cores)
+    res = pipeline.run(number_of_cores=number_of_cores, memory_gb=memory_gb)
 
     return res
 
 
+def get_work_item_key(subject, sr_id, session=None):
+    """Function that returns the key identifying a reconstruction (work item) of a subject.
+
+    Parameters
+    ----------
+    subject <string>
+        Subject label (without "sub-")
+
+    sr_id <int>
+        ``sr-id`` of the reconstruction
+
+    session <string>
+        Session label (without "ses-") if any
+
+    """
+    return '/'.join([str(subject), str(sr_id), str(session)])
+
+
+def process_subject(args, sub, sr_list, number_of_cores, openmp_number_of_cores, memory_gb=None,
+                    item_status=None):
+    """Function that runs the super-resolution reconstructions of one subject.
+
+    The reconstructions are independent: if one fails, the following ones are still run,
+    and the error of the first failed reconstruction is raised once all of them are done.
+
+    Parameters
+    ----------
+    args <argparse.Namespace>
+        Arguments of the BIDS App
+
+    sub <string>
+        Subject label (without "sub-")
+
+    sr_list list<dict>
+        Reconstruction parameters of the subject from the BIDS App configuration file
+
+    number_of_cores <int>
+        Number of cores used by the Nipype engine
+
+    openmp_number_of_cores <int>
+        Number of threads of the multithreaded steps
+
+    memory_gb <float>
+        Memory in GB available to the Nipype engine (optional)
+
+    item_status <dict>
+        Dictionary (possibly shared between processes) where the status (``"done"`` or
+        ``"failed"``) of each reconstruction is recorded by :func:`get_work_item_key` (optional)
+
+    """
+    print(sr_list)
+
+    error = None
+
+    for sr_params in sr_list:
+
+        ses = sr_params["session"] if "session" in sr_params.keys() else None
+        stacks = sr_params['stacks'] if 'stacks' in sr_params.keys() else None
+        paramTV = sr_params['paramTV'] if 'paramTV' in sr_params.keys() else None
+
+        dict_custom_interfaces = sr_params['custom_interfaces'] if 'custom_interfaces' in sr_params.keys() else None
+
+        if ("sr-id" not in sr_params.keys()):
+            print('Do not process subjects %s because of missing parameters.' % sub)
+            continue
+
+        key = get_work_item_key(sub, sr_params['sr-id'], ses)
+        try:
+            main(bids_dir=args.bids_dir,
+                 output_dir=args.output_dir,
+                 subject=sub,
+                 p_stacks=stacks,
+                 session=ses,
+                 paramTV=paramTV,
+                 srID=sr_params['sr-id'],
+                 masks_derivatives_dir=args.masks_derivatives_dir,
+                 number_of_cores=number_of_cores,
+                 dict_custom_interfaces = dict_custom_interfaces,
+                 hash_method=args.hash_method,
+                 work_dir=args.work_dir,
+                 prune_intermediates=args.prune_intermediates,
+                 keep_only_outputs=args.keep_only_outputs,
+                 uncompressed_intermediates=args.uncompressed_intermediates,
+                 image_ops_backend=args.image_ops_backend,
+                 fused_intensity_normalization=args.fused_intensity_normalization,
+                 crop_to_roi=args.crop_to_roi,
+                 roi_margin=args.roi_margin,
+                 openmp_number_of_cores=openmp_number_of_cores,
+                 memory_gb=memory_gb,
+                 dry_run=args.dry_run,
+                 execution_backend=args.execution_backend,
+                 dask_scheduler=args.dask_scheduler,
+                 cpu_affinity=args.cpu_affinity,
+                 tv_checkpoint_loops=args.tv_checkpoint_loops,
+                 tv_stop_tolerance=args.tv_stop_tolerance,
+                 time_budget=args.time_budget,
+                 svr_warm_start=args.svr_warm_start,
+                 pack_transforms=args.pack_transforms)
+        except Exception as e:
+            print(f'ERROR: Reconstruction sr-id {sr_params["sr-id"]} of sub-{sub} failed: {e}')
+            if item_status is not None:
+                item_status[key] = "failed"
+            if error is None:
+                error = e
+            continue
+        if item_status is not None:
+            item_status[key] = "done"
+
+    if error is not None:
+        raise error
+
+
+def discover_subjects(bids_dir, participants_params):
+    """Function that returns the labels of the subjects of a BIDS dataset having reconstruction parameters.
+
+    Parameters
+    ----------
+    bids_dir <string>
+        BIDS root directory
+
+    participants_params <dict>
+        Content of the BIDS App configuration file
+
+    Returns
+    -------
+    subjects list<string>
+        Labels (without "sub-") of the subjects found in ``bids_dir`` and in ``participants_params``
+
+    """
+    subjects = []
+    for entry in sorted(os.listdir(bids_dir)):
+        if entry.startswith('sub-') and os.path.isdir(os.path.join(bids_dir, entry)):
+            if entry[len('sub-'):] in participants_params.keys():
+                subjects.append(entry[len('sub-'):])
+            else:
+                print(f'WARNING: No reconstruction parameters for {entry} in the configuration file. It will be skipped.')
+    return subjects
+
+
+def get_subject_priority(sr_list):
+    """Function that returns the priority of a subject, i.e. the highest ``"priority"`` of its reconstructions (0 by default)."""
+    return max([sr_params.get('priority', 0) for sr_params in sr_list] + [0])
+
+
+def run_subjects(args, subjects, participants_params, subject_nb_of_cores, openmp_nb_of_cores,
+                 subject_memory_gb, total_nb_of_cores, total_memory_gb, item_status=None):
+    """Function that runs the reconstructions of several subjects in parallel within a global budget.
+
+    Each subject is processed in its own process, such that the failure of one subject
+    does not stop the others. Subjects are started by decreasing priority as long as the
+    sum of the cores and memory of the running subjects fits in the global budget.
+    A subject is always started if no other subject is running.
+
+    Parameters
+    ----------
+    args <argparse.Namespace>
+        Arguments of the BIDS App
+
+    subjects list<string>
+        Labels of the subjects to be processed
+
+    participants_params <dict>
+        Content of the BIDS App configuration file
+
+    subject_nb_of_cores <int>
+        Number of cores used by each subject
+
+    openmp_nb_of_cores <int>
+        Number of threads of the multithreaded steps
+
+    subject_memory_gb <float>
+        Memory in GB used by each subject
+
+    total_nb_of_cores <int>
+        Number of cores available to all the subjects
+
+    total_memory_gb <float>
+        Memory in GB available to all the subjects
+
+    item_status <dict>
+        Dictionary shared between the processes, e.g. created by a ``multiprocessing.Manager``,
+        where the status of each reconstruction is recorded (see :func:`process_subject`)
+
+    Returns
+    -------
+    exit_codes <dict>
+        Exit code of the process of each subject
+
+    """
+    from multiprocessing.connection import wait
+
+    # Stable sort: subjects with the same priority keep their order
+    pending = sorted(subjects, key=lambda sub: -get_subject_priority(participants_params[sub]))
+    running = dict()
+    exit_codes = dict()
+
+    while pending or running:
+        while pending and (not running or
+                           ((len(running) + 1) * subject_nb_of_cores <= total_nb_of_cores and
+                            (len(running) + 1) * subject_memory_gb <= total_memory_gb)):
+            sub = pending.pop(0)
+            proc = multiprocessing.Process(target=process_subject,
+                                           args=(args, sub, participants_params[sub], subject_nb_of_cores,
+                                                 openmp_nb_of_cores, subject_memory_gb, item_status),
+                                           name=f'sub-{sub}')
+            proc.start()
+            running[proc.sentinel] = (sub, proc)
+            print(f'INFO: Start processing of sub-{sub} ({len(running)} subject(s) running, {len(pending)} pending)')
+
+        for sentinel in wait(list(running.keys())):
+            sub, proc = running.pop(sentinel)
+            proc.join()
+            exit_codes[sub] = proc.exitcode
+            if proc.exitcode == 0:
+                print(f'INFO: Processing of sub-{sub} finished')
+            else:
+                print(f'ERROR: Processing of sub-{sub} failed (exit code {proc.exitcode})')
+
+    return exit_codes
+
+
+def estimate_work_item_cost(bids_dir, sub, sr_params):
+    """Function that estimates the cost of a reconstruction by the number of voxels of its stacks.
+
+    Only the headers of the stacks are read.
+
+    Parameters
+    ----------
+    bids_dir <string>
+        BIDS root directory
+
+    sub <string>
+        Subject label (without "sub-")
+
+    sr_params <dict>
+        Reconstruction parameters from the BIDS App configuration file
+
+    Returns
+    -------
+    cost <int>
+        Total number of voxels of the stacks used by the reconstruction
+
+    """
+    anat_dir = os.path.join(bids_dir, 'sub-' + sub)
+    if 'session' in sr_params.keys():
+        anat_dir = os.path.join(anat_dir, 'ses-' + str(sr_params['session']))
+    stacks = sorted(glob(os.path.join(anat_dir, 'anat', '*_run-*_T2w.nii*')))
+    if 'stacks' in sr_params.keys():
+        stacks = [f for f in stacks
+                  if any('_run-{}_'.format(run_id) in os.path.basename(f) for run_id in sr_params['stacks'])]
+    return sum(shape[0] * shape[1] * shape[2] for shape, _ in get_stacks_geometry(stacks))
+
+
+def get_shard_work_items(bids_dir, subjects, participants_params, shard_index, shard_count):
+    """Function that returns the reconstructions assigned to one shard.
+
+    The (subject, sr-id) work items are distributed over the shards by decreasing
+    estimated cost, each item going to the shard with the lowest total cost so far
+    (ties broken by the lowest shard index). The assignment is deterministic, such that
+    independent invocations with the same inputs and different shard indices process
+    complementary sets of reconstructions.
+
+    Parameters
+    ----------
+    bids_dir <string>
+        BIDS root directory
+
+    subjects list<string>
+        Labels of the subjects to be processed
+
+    participants_params <dict>
+        Content of the BIDS App configuration file
+
+    shard_index <int>
+        Index of the shard (from 0 to ``shard_count - 1``)
+
+    shard_count <int>
+        Number of shards
+
+    Returns
+    -------
+    work_items list<dict>
+        Work items of the shard with keys ``"subject"``, ``"sr-id"``, ``"session"``, ``"cost"``
+        and ``"params"`` (reconstruction parameters)
+
+    """
+    work_items = []
+    for sub in sorted(subjects):
+        for sr_params in participants_params[sub]:
+            if "sr-id" not in sr_params.keys():
+                continue
+            work_items.append({"subject": sub,
+                               "sr-id": sr_params["sr-id"],
+                               "session": sr_params.get("session"),
+                               "cost": estimate_work_item_cost(bids_dir, sub, sr_params),
+                               "params": sr_params})
+
+    loads = [0] * shard_count
+    shard_items = []
+    for item in sorted(work_items, key=lambda it: (-it["cost"], it["subject"], str(it["sr-id"]), str(it["session"]))):
+        shard = loads.index(min(loads))
+        loads[shard] += item["cost"]
+        if shard == shard_index:
+            shard_items.append(item)
+    print(f'INFO: Estimated cost (voxels) of the shards: {loads}')
+    return shard_items
+
+
+def write_shard_manifest(output_dir, shard_index, shard_count, work_items, exit_codes=None, item_status=None):
+    """Function that writes the manifest listing the reconstructions of a shard and their status.
+
+    Parameters
+    ----------
+    output_dir <string>
+        Output derivatives directory
+
+    shard_index <int>
+        Index of the shard
+
+    shard_count <int>
+        Number of shards
+
+    work_items list<dict>
+        Work items returned by :func:`get_shard_work_items`
+
+    exit_codes <dict>
+        Exit code of the processing of each subject, if the processing is finished
+
+    item_status <dict>
+        Status of each reconstruction recorded by :func:`process_subject`, by :func:`get_work_item_key`.
+        A reconstruction without status is failed, e.g. if its subject process was killed before it,
+        unless its subject was processed successfully
+
+    Returns
+    -------
+    manifest_file <string>
+        Path of the manifest, ``<output_dir>/pymialsrtk-<version>/logs/shard-<index>-of-<count>_manifest.json``
+
+    """
+    manifest_file = os.path.join(output_dir, '-'.join(["pymialsrtk", __version__]), 'logs',
+                                 f'shard-{shard_index}-of-{shard_count}_manifest.json')
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+
+    items = []
+    for item in work_items:
+        key = get_work_item_key(item["subject"], item["sr-id"], item["session"])
+        if exit_codes is None:
+            status = "pending"
+        elif item_status is not None and key in item_status.keys():
+            status = item_status[key]
+        else:
+            status = "done" if exit_codes.get(item["subject"]) == 0 else "failed"
+        items.append({"subject": item["subject"],
+                      "sr-id": item["sr-id"],
+                      "session": item["session"],
+                      "cost": item["cost"],
+                      "status": status})
+
+    manifest = {"Shard index": shard_index,
+                "Shard count": shard_count,
+                "Date": datetime.datetime.now().isoformat(),
+                "Complete": exit_codes is not None and all(it["status"] == "done" for it in items),
+                "Items": items}
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return manifest_file
+
+
 if __name__ == '__main__':
 
     bids_dir = os.path.join('/fetaldata')
@@ -234,6 +705,12 @@ if __name__ == '__main__':
                                                                                 nipype_nb_of_cores)
     print(f'INFO: Number of cores used by Nipype engine set to {nipype_nb_of_cores}')
 
+    # Multithreaded steps run with openmp_nb_of_cores threads and the other steps with one thread,
+    # within a total budget of openmp_nb_of_cores * nipype_nb_of_cores cores.
+    # OMP_NUM_THREADS is kept for the steps that do not declare their number of threads.
+    total_nb_of_cores = openmp_nb_of_cores * nipype_nb_of_cores
+    print(f'INFO: Total number of cores managed by Nipype engine set to {total_nb_of_cores}')
+
     os.environ['OMP_NUM_THREADS'] = str(openmp_nb_of_cores)
     print('INFO: Environment variable OMP_NUM_THREADS set to: {}'.format(os.environ['OMP_NUM_THREADS']))
 
@@ -244,36 +721,74 @@ if __name__ == '__main__':
         print(participants_params.keys())
     print()
 
-    if len(args.participant_label) >= 1:
-        for sub in args.participant_label:
-
-            if sub in participants_params.keys():
-                sr_list = participants_params[sub]
-                print(sr_list)
-
-                for sr_params in sr_list:
-
-                    ses = sr_params["session"] if "session" in sr_params.keys() else None
-                    stacks = sr_params['stacks'] if 'stacks' in sr_params.keys() else None
-                    paramTV = sr_params['paramTV'] if 'paramTV' in sr_params.keys() else None
-
-                    dict_custom_interfaces = sr_params['custom_interfaces'] if 'custom_interfaces' in sr_params.keys() else None
-
-                    if ("sr-id" not in sr_params.keys()):
-                        print('Do not process subjects %s because of missing parameters.' % sub)
-                        continue
-
-                    res = main(bids_dir=args.bids_dir,
-                               output_dir=args.output_dir,
-                               subject=sub,
-                               p_stacks=stacks,
-                               session=ses,
-                               paramTV=paramTV,
-                               srID=sr_params['sr-id'],
-                               masks_derivatives_dir=args.masks_derivatives_dir,
-                               number_of_cores=nipype_nb_of_cores,
-                               dict_custom_interfaces = dict_custom_interfaces)
-
+    if args.participant_label is not None and len(args.participant_label) >= 1:
+        subjects = [sub for sub in args.participant_label if sub in participants_params.keys()]
     else:
-        print('ERROR: Processing of all dataset not implemented yet\n At least one participant label should be provided')
+        subjects = discover_subjects(args.bids_dir, participants_params)
+        print(f'INFO: Subjects found in the dataset: {subjects}')
+
+    if args.shard_count > 1:
+        if not 0 <= args.shard_index < args.shard_count:
+            print(f'ERROR: Shard index {args.shard_index} should be between 0 and {args.shard_count - 1}')
+            sys.exit(2)
+        work_items = get_shard_work_items(args.bids_dir, subjects, participants_params,
+                                          args.shard_index, args.shard_count)
+        # Keep only the reconstructions of the shard
+        participants_params = dict()
+        for item in work_items:
+            participants_params.setdefault(item["subject"], []).append(item["params"])
+        subjects = [sub for sub in subjects if sub in participants_params.keys()]
+        write_shard_manifest(args.output_dir, args.shard_index, args.shard_count, work_items)
+        print(f'INFO: Shard {args.shard_index}/{args.shard_count}: {len(work_items)} reconstruction(s) '
+              f'of {len(subjects)} subject(s)')
+        if len(subjects) == 0:
+            write_shard_manifest(args.output_dir, args.shard_index, args.shard_count, work_items, dict())
+            sys.exit(0)
+
+    if len(subjects) == 0:
+        print('ERROR: No subject with reconstruction parameters to be processed')
         sys.exit(2)
+
+    # Global budget shared by the subjects processed in parallel
+    dataset_nb_of_cores = args.total_nb_of_cores if args.total_nb_of_cores > 0 else multiprocessing.cpu_count()
+    if args.total_memory_gb is not None:
+        dataset_memory_gb = args.total_memory_gb
+    else:
+        from nipype.utils.profiler import get_system_total_memory_gb
+        dataset_memory_gb = 0.9 * get_system_total_memory_gb()
+    # By default, a subject gets a share of the memory proportional to its share of the cores
+    subject_memory_gb = args.memory_gb
+    if subject_memory_gb is None:
+        subject_memory_gb = dataset_memory_gb * min(1.0, float(total_nb_of_cores) / dataset_nb_of_cores)
+
+    if args.cpu_affinity and len(subjects) > 1:
+        # Ledger shared by the subjects processed in parallel such that their tools use disjoint cores
+        affinity_ledger = os.path.join(tempfile.mkdtemp(prefix='mialsrtk-'), 'cpu_affinity.json')
+        init_cpu_affinity_ledger(affinity_ledger, get_available_cores()[:dataset_nb_of_cores])
+        os.environ[CPU_AFFINITY_LEDGER_ENV] = affinity_ledger
+
+    if len(subjects) == 1:
+        item_status = dict()
+        try:
+            process_subject(args, subjects[0], participants_params[subjects[0]],
+                            total_nb_of_cores, openmp_nb_of_cores, args.memory_gb, item_status)
+            exit_codes = {subjects[0]: 0}
+        except Exception:
+            exit_codes = {subjects[0]: 1}
+            raise
+        finally:
+            if args.shard_count > 1:
+                write_shard_manifest(args.output_dir, args.shard_index, args.shard_count, work_items, exit_codes,
+                                     item_status)
+    else:
+        # Status of the reconstructions recorded by the processes of the subjects
+        item_status = multiprocessing.Manager().dict()
+        exit_codes = run_subjects(args, subjects, participants_params, total_nb_of_cores, openmp_nb_of_cores,
+                                  subject_memory_gb, dataset_nb_of_cores, dataset_memory_gb, item_status)
+        if args.shard_count > 1:
+            write_shard_manifest(args.output_dir, args.shard_index, args.shard_count, work_items, exit_codes,
+                                 dict(item_status))
+        failed = [sub for sub, code in exit_codes.items() if code != 0]
+        if failed:
+            print('ERROR: Processing failed for subject(s): {}'.format(', '.join(failed)))
+            sys.exit(1)
@@ -34,7 +34,30 @@ def create_singularity_cmd(args):
                 'participant_label': ['01', '02', '03'],
                 'openmp_nb_of_cores': 1,
                 'nipype_nb_of_cores': 1,
-                'masks_derivatives_dir': 'manual_masks'
+                'masks_derivatives_dir': 'manual_masks',
+                'hash_method': 'cached',
+                'work_dir': "/path/to/scratch/directory",
+                'prune_intermediates': False,
+                'keep_only_outputs': False,
+                'uncompressed_intermediates': False,
+                'image_ops_backend': 'mialsrtk',
+                'fused_intensity_normalization': False,
+                'crop_to_roi': False,
+                'roi_margin': 10.0,
+                'memory_gb': None,
+                'dry_run': False,
+                'execution_backend': 'nipype',
+                'dask_scheduler': None,
+                'cpu_affinity': False,
+                'tv_checkpoint_loops': 0,
+                'tv_stop_tolerance': 0.0,
+                'time_budget': None,
+                'svr_warm_start': False,
+                'pack_transforms': False,
+                'total_nb_of_cores': 0,
+                'total_memory_gb': None,
+                'shard_index': 0,
+                'shard_count': 1
             }
 
     Returns
@@ -47,22 +70,63 @@ def create_singularity_cmd(args):
     cmd += f'--bind {args.bids_dir}:/bids_dir '
     cmd += f'--bind {args.output_dir}:/output_dir '
     cmd += f'--bind {args.param_file}:/bids_dir/code/participants_params.json '
+    if args.work_dir is not None:
+        cmd += f'--bind {args.work_dir}:/work_dir '
     cmd += f'library://tourbier/mialsuperresolutiontoolkit-bidsapp:v{__version__} '
 
     # Standard BIDS App inputs
     cmd += '/bids_dir '
     cmd += '/output_dir '
     cmd += f'{args.analysis_level} '
-    cmd += '--participant_label '
-    for label in args.participant_label:
-        cmd += f'{label} '
+    if args.participant_label:
+        cmd += '--participant_label '
+        for label in args.participant_label:
+            cmd += f'{label} '
 
     # MIALSRTK BIDS App inputs
     cmd += '--param_file /bids_dir/code/participants_params.json '
     if args.masks_derivatives_dir != '':
         cmd += f'--masks_derivatives_dir {args.masks_derivatives_dir} '
     cmd += f'--openmp_nb_of_cores {args.openmp_nb_of_cores} '
-    cmd += f'--nipype_nb_of_cores {args.nipype_nb_of_cores}'
+    cmd += f'--nipype_nb_of_cores {args.nipype_nb_of_cores} '
+    if args.memory_gb is not None:
+        cmd += f'--memory_gb {args.memory_gb} '
+    if args.total_nb_of_cores > 0:
+        cmd += f'--total_nb_of_cores {args.total_nb_of_cores} '
+    if args.total_memory_gb is not None:
+        cmd += f'--total_memory_gb {args.total_memory_gb} '
+    if args.shard_count > 1:
+        cmd += f'--shard_index {args.shard_index} --shard_count {args.shard_count} '
+    if args.dry_run:
+        cmd += '--dry_run '
+    if args.execution_backend != 'nipype':
+        cmd += f'--execution_backend {args.execution_backend} '
+    if args.dask_scheduler is not None:
+        cmd += f'--dask_scheduler {args.dask_scheduler} '
+    if args.cpu_affinity:
+        cmd += '--cpu_affinity '
+    if args.tv_checkpoint_loops > 0:
+        cmd += f'--tv_checkpoint_loops {args.tv_checkpoint_loops} --tv_stop_tolerance {args.tv_stop_tolerance} '
+    if args.time_budget is not None:
+        cmd += f'--time_budget {args.time_budget} '
+    if args.svr_warm_start:
+        cmd += '--svr_warm_start '
+    if args.pack_transforms:
+        cmd += '--pack_transforms '
+    cmd += f'--hash_method {args.hash_method} '
+    cmd += f'--image_ops_backend {args.image_ops_backend}'
+    if args.work_dir is not None:
+        cmd += ' --work_dir /work_dir'
+    if args.prune_intermediates:
+        cmd += ' --prune_intermediates'
+    if args.keep_only_outputs:
+        cmd += ' --keep_only_outputs'
+    if args.uncompressed_intermediates:
+        cmd += ' --uncompressed_intermediates'
+    if args.fused_intensity_normalization:
+        cmd += ' --fused_intensity_normalization'
+    if args.crop_to_roi:
+        cmd += f' --crop_to_roi --roi_margin {args.roi_margin}'
 
     return cmd
 
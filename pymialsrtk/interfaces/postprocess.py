@@ -4,32 +4,40 @@
 
 """PyMIALSRTK postprocessing functions.
 
-It encompasses a High Resolution mask refinement and an N4 global bias field correction.
+It encompasses a High Resolution mask refinement, an N4 global bias field correction,
+in-process binarization and thresholding of images, and the atomic publication of the outputs.
 
 """
 
 import os
+import shutil
+import tempfile
 
 from glob import glob
 
+import numpy as np
+
 from traits.api import *
 
 from nipype.utils.filemanip import split_filename
 # from nipype.interfaces.base import isdefined, CommandLine, CommandLineInputSpec
-from nipype.interfaces.base import traits, \
+from nipype.interfaces.base import traits, isdefined, \
     TraitedSpec, File, InputMultiPath, OutputMultiPath, BaseInterface, BaseInterfaceInputSpec
+from nipype.interfaces.io import DataSink, DataSinkInputSpec
 
-from pymialsrtk.interfaces.utils import run
+from pymialsrtk.interfaces.utils import run, get_threads_env, CachedHashInputSpec, load_image_data, save_image_data, \
+    update_status_manifest, reorder_by_run_ids, pack_slice_transforms
 
 
 #######################
 #  Refinement HR mask
 #######################
 
-class MialsrtkRefineHRMaskByIntersectionInputSpec(BaseInterfaceInputSpec):
+class MialsrtkRefineHRMaskByIntersectionInputSpec(CachedHashInputSpec):
     """Class used to represent inputs of the MialsrtkRefineHRMaskByIntersection interface."""
 
-    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True)
+    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True, nohash=True)
+    num_threads = traits.Int(desc='Number of threads used by the tool (inherited from the environment if not set)', nohash=True)
     input_images = InputMultiPath(File(mandatory=True), desc='Image filenames used in SR reconstruction')
     input_masks = InputMultiPath(File(mandatory=True), desc='Mask filenames')
     input_transforms = InputMultiPath(File(mandatory=True), desc='Transformation filenames')
@@ -117,7 +125,7 @@ class MialsrtkRefineHRMaskByIntersection(BaseInterface):
         try:
             print('... cmd: {}'.format(cmd))
             cmd = ' '.join(cmd)
-            run(cmd, env={}, cwd=os.path.abspath(self.inputs.bids_dir))
+            run(cmd, env=get_threads_env(self.inputs.num_threads), cwd=os.path.abspath(self.inputs.bids_dir))
         except Exception as e:
             print('Failed')
             print(e)
@@ -135,10 +143,11 @@ class MialsrtkRefineHRMaskByIntersection(BaseInterface):
 # N4 Bias field correction
 ############################
 
-class MialsrtkN4BiasFieldCorrectionInputSpec(BaseInterfaceInputSpec):
+class MialsrtkN4BiasFieldCorrectionInputSpec(CachedHashInputSpec):
     """Class used to represent inputs of the MialsrtkN4BiasFieldCorrection interface."""
 
-    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True)
+    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True, nohash=True)
+    num_threads = traits.Int(desc='Number of threads used by the tool (inherited from the environment if not set)', nohash=True)
     input_image = File(desc='Input image filename to be normalized', mandatory=True)
     input_mask = File(desc='Input mask filename', mandatory=False)
 
@@ -198,7 +207,7 @@ class MialsrtkN4BiasFieldCorrection(BaseInterface):
         try:
             print('... cmd: {}'.format(cmd))
             cmd = ' '.join(cmd)
-            run(cmd, env={}, cwd=os.path.abspath(self.inputs.bids_dir))
+            run(cmd, env=get_threads_env(self.inputs.num_threads), cwd=os.path.abspath(self.inputs.bids_dir))
         except Exception as e:
             print('Failed')
             print(e)
@@ -216,11 +225,129 @@ class MialsrtkN4BiasFieldCorrection(BaseInterface):
         return outputs
 
 
+#################################
+# Image binarization/thresholding
+#################################
+
+class BinarizeImageInputSpec(CachedHashInputSpec):
+    """Class used to represent inputs of the BinarizeImage interface."""
+
+    input_image = File(desc='Input image filename to be binarized', mandatory=True)
+    threshold = traits.Float(0.01, desc='Voxels with an intensity above this threshold are set to 1 (0.01 by default)',
+                             usedefault=True)
+    out_postfix = traits.Str("_srMask", desc='Suffix to be added to input_image', usedefault=True)
+
+
+class BinarizeImageOutputSpec(TraitedSpec):
+    """Class used to represent outputs of the BinarizeImage interface."""
+
+    output_srmask = File(desc='Output binary mask (uint8)')
+
+
+class BinarizeImage(BaseInterface):
+    """Runs in-process the binarization of an image.
+
+    It is the interface equivalent of the :func:`pymialsrtk.interfaces.postprocess.binarize_image`
+    function, which does not require a Nipype ``Function`` node.
+
+    Example
+    ----------
+    >>> from pymialsrtk.interfaces.postprocess import BinarizeImage
+    >>> binarizeImg = BinarizeImage()
+    >>> binarizeImg.inputs.input_image = 'sub-01_rec-SR_T2w.nii.gz'
+    >>> binarizeImg.run() # doctest: +SKIP
+
+    """
+
+    input_spec = BinarizeImageInputSpec
+    output_spec = BinarizeImageOutputSpec
+
+    def _gen_filename(self, name):
+        if name == 'output_srmask':
+            _, name, ext = split_filename(self.inputs.input_image)
+            output = name + self.inputs.out_postfix + ext
+            return os.path.abspath(output)
+        return None
+
+    def _run_interface(self, runtime):
+        try:
+            img, data = load_image_data(self.inputs.input_image)
+            save_image_data(data > self.inputs.threshold, img, self._gen_filename('output_srmask'), 'mask')
+        except Exception as e:
+            print('Failed')
+            print(e)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output_srmask'] = self._gen_filename('output_srmask')
+        return outputs
+
+
+class ThresholdImageInputSpec(CachedHashInputSpec):
+    """Class used to represent inputs of the ThresholdImage interface."""
+
+    input_image = File(desc='Input image filename to be thresholded', mandatory=True)
+    threshold = traits.Float(desc='Voxels with an intensity below this threshold are set to outside_value',
+                             mandatory=True)
+    outside_value = traits.Float(0., desc='Value of voxels below the threshold (0 by default)', usedefault=True)
+    out_postfix = traits.Str("_thresh", desc='Suffix to be added to input_image', usedefault=True)
+
+
+class ThresholdImageOutputSpec(TraitedSpec):
+    """Class used to represent outputs of the ThresholdImage interface."""
+
+    output_image = File(desc='Output thresholded image (float32)')
+
+
+class ThresholdImage(BaseInterface):
+    """Runs in-process the thresholding of an image.
+
+    Voxels with an intensity below the threshold are set to ``outside_value``
+    while the other voxels are kept unchanged.
+
+    Example
+    ----------
+    >>> from pymialsrtk.interfaces.postprocess import ThresholdImage
+    >>> thresholdImg = ThresholdImage()
+    >>> thresholdImg.inputs.input_image = 'sub-01_rec-SR_T2w.nii.gz'
+    >>> thresholdImg.inputs.threshold = 10
+    >>> thresholdImg.run() # doctest: +SKIP
+
+    """
+
+    input_spec = ThresholdImageInputSpec
+    output_spec = ThresholdImageOutputSpec
+
+    def _gen_filename(self, name):
+        if name == 'output_image':
+            _, name, ext = split_filename(self.inputs.input_image)
+            output = name + self.inputs.out_postfix + ext
+            return os.path.abspath(output)
+        return None
+
+    def _run_interface(self, runtime):
+        try:
+            img, data = load_image_data(self.inputs.input_image)
+            data = data.astype(np.float32)
+            thresholded = np.where(data < self.inputs.threshold, np.float32(self.inputs.outside_value), data)
+            save_image_data(thresholded, img, self._gen_filename('output_image'), 'intensity')
+        except Exception as e:
+            print('Failed')
+            print(e)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output_image'] = self._gen_filename('output_image')
+        return outputs
+
+
 ############################
 # Output filenames settings
 ############################
 
-class FilenamesGenerationInputSpec(BaseInterfaceInputSpec):
+class FilenamesGenerationInputSpec(CachedHashInputSpec):
     """Class used to represent inputs of the FilenamesGeneration interface."""
 
     sub_ses = traits.Str(mandatory=True, desc='Subject and session BIDS identifier to construct output filename.')
@@ -314,6 +441,9 @@ class FilenamesGeneration(BaseInterface):
         self.m_substitutions.append(('SRTV_' + self.inputs.sub_ses + '_' + str(len(self.inputs.stacks_order)) + 'V_rad1.json',
                               self.inputs.sub_ses + '_rec-SR' + '_id-' + str(self.inputs.sr_id) + '_T2w.json'))
 
+        self.m_substitutions.append(('SRTV_' + self.inputs.sub_ses + '_' + str(len(self.inputs.stacks_order)) + 'V_rad1_convergence.json',
+                                     self.inputs.sub_ses + '_rec-SR' + '_id-' + str(self.inputs.sr_id) + '_desc-convergence_T2w.json'))
+
         # print(self.inputs.sub_ses + '_T2w_uni_bcorr_histnorm_srMask.nii.gz',
         #       '    --->     ',
         #       self.inputs.sub_ses + '_rec-SR' + '_id-' + str(self.inputs.sr_id) + '_T2w_desc-brain_mask.nii.gz')
@@ -329,19 +459,146 @@ class FilenamesGeneration(BaseInterface):
         return outputs
 
 
+#############################
+# Slice transforms packing
+#############################
+
+class PackSliceTransformsInputSpec(CachedHashInputSpec):
+    """Class used to represent inputs of the PackSliceTransforms interface."""
+
+    input_transforms = InputMultiPath(File(mandatory=True), desc='Input slice transform files')
+    stacks_order = traits.List(mandatory=True, desc='List of stack run-id that specify the order of the stacks')
+    sub_ses = traits.Str(mandatory=True, desc='Subject and session BIDS identifier to construct output filename.')
+    sr_id = traits.Int(mandatory=True, desc='Super-Resolution id')
+
+
+class PackSliceTransformsOutputSpec(TraitedSpec):
+    """Class used to represent outputs of the PackSliceTransforms interface."""
+
+    output_file = File(desc='NPZ file holding the slice transforms of all the stacks')
+
+
+class PackSliceTransforms(BaseInterface):
+    """Packs the slice transforms of all the stacks in a single NPZ file.
+
+    The stacks are packed in the order of ``stacks_order``, with the filenames of the
+    transforms saved in the ``xfm/`` derivatives such that they are restored by
+    :func:`pymialsrtk.interfaces.utils.unpack_slice_transforms`.
+    See :func:`pymialsrtk.interfaces.utils.pack_slice_transforms` for the arrays of the file.
+
+    Example
+    ----------
+    >>> from pymialsrtk.interfaces.postprocess import PackSliceTransforms
+    >>> packTransforms = PackSliceTransforms()
+    >>> packTransforms.inputs.input_transforms = ['sub-01_run-1_T2w_transform_2V.txt', 'sub-01_run-2_T2w_transform_2V.txt']
+    >>> packTransforms.inputs.stacks_order = [2,1]
+    >>> packTransforms.inputs.sub_ses = 'sub-01'
+    >>> packTransforms.inputs.sr_id = 1
+    >>> packTransforms.run() # doctest: +SKIP
+
+    """
+
+    input_spec = PackSliceTransformsInputSpec
+    output_spec = PackSliceTransformsOutputSpec
+
+    def _gen_filename(self, name):
+        if name == 'output_file':
+            return os.path.abspath(self.inputs.sub_ses + '_rec-SR_id-' + str(self.inputs.sr_id) +
+                                   '_T2w_from-origin_to-SDI_mode-image_xfm.npz')
+        return None
+
+    def _run_interface(self, runtime):
+        try:
+            transforms = reorder_by_run_ids(self.inputs.input_transforms, self.inputs.stacks_order)
+            filenames = [self.inputs.sub_ses + '_run-' + str(stack) + '_id-' + str(self.inputs.sr_id) +
+                         '_T2w_from-origin_to-SDI_mode-image_xfm.txt' for stack in self.inputs.stacks_order]
+            pack_slice_transforms(transforms, self._gen_filename('output_file'), filenames)
+        except Exception as e:
+            print('Failed')
+            print(e)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output_file'] = self._gen_filename('output_file')
+        return outputs
+
+
+#############################
+# Atomic output publication
+#############################
+
+class AtomicDataSinkInputSpec(DataSinkInputSpec):
+    """Class used to represent inputs of the AtomicDataSink interface."""
+
+    stage = traits.Str(desc='Name of the processing stage whose outputs are published')
+    manifest_file = traits.Str(desc='Status manifest in which the published outputs are recorded')
+
+
+class AtomicDataSink(DataSink):
+    """Nipype DataSink publishing each output atomically and recording it in a status manifest.
+
+    The outputs are first copied by the DataSink in a hidden staging directory of ``base_directory``,
+    and then moved to their final location with ``os.replace()``, such that a reader never sees
+    a partially written output. If ``manifest_file`` is set, the published outputs are listed under
+    the name of the ``stage`` (see :func:`~pymialsrtk.interfaces.utils.update_status_manifest`).
+
+    Example
+    ----------
+    >>> from pymialsrtk.interfaces.postprocess import AtomicDataSink
+    >>> datasink = AtomicDataSink()
+    >>> datasink.inputs.base_directory = '/path/to/derivatives/sub-01'
+    >>> datasink.inputs.stage = 'SDI'
+    >>> datasink.inputs.manifest_file = '/path/to/derivatives/sub-01/logs/sub-01_rec-SR_id-1_status.json'
+    >>> datasink.inputs.anat = 'SDI_sub-01_3V_rad1.nii.gz'
+    >>> datasink.run() # doctest: +SKIP
+
+    """
+
+    input_spec = AtomicDataSinkInputSpec
+
+    def _list_outputs(self):
+        base_directory = os.path.abspath(self.inputs.base_directory)
+        os.makedirs(base_directory, exist_ok=True)
+        staging_dir = tempfile.mkdtemp(prefix='.staging_', dir=base_directory)
+
+        self.inputs.base_directory = staging_dir
+        try:
+            outputs = super(AtomicDataSink, self)._list_outputs()
+        finally:
+            self.inputs.base_directory = base_directory
+
+        try:
+            published = []
+            for staged in outputs['out_file']:
+                relative = os.path.relpath(staged, staging_dir)
+                target = os.path.join(base_directory, relative)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(staged, target)
+                published.append(relative)
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+        outputs['out_file'] = [os.path.join(base_directory, relative) for relative in published]
+
+        if isdefined(self.inputs.manifest_file) and self.inputs.manifest_file:
+            update_status_manifest(self.inputs.manifest_file,
+                                   p_stage=self.inputs.stage if isdefined(self.inputs.stage) else 'outputs',
+                                   p_files=published)
+        return outputs
+
+
 
 def binarize_image(input_image):
-    import nibabel as nib
+    """Function that binarizes an image (threshold at 0.01) and saves it as an uint8 mask."""
     import os
     from nipype.utils.filemanip import split_filename
+    from pymialsrtk.interfaces.utils import load_image_data, save_image_data
 
-    im = nib.load(input_image)
-
-    out = nib.Nifti1Image(dataobj=(im.get_fdata() > 0.01).astype(int), affine=im.affine)
-    out._header = im.header
+    im, data = load_image_data(input_image)
 
     _,name,ext = split_filename(input_image)
-    output_mask = name + '_srMask' + ext
-    nib.save(filename=output_mask, img=out)
+    output_mask = os.path.abspath(name + '_srMask' + ext)
+    save_image_data(data > 0.01, im, output_mask, 'mask')
 
-    return os.path.abspath(output_mask)
\ No newline at end of file
+    return output_mask
\ No newline at end of file
@@ -6,11 +6,13 @@
 
 It includes BTK Non-local-mean denoising, slice intensity correction
 slice N4 bias field correction, slice-by-slice correct bias field, intensity standardization,
-histogram normalization and both manual or deep learning based automatic brain extraction.
+histogram normalization (separately or as a single in-process stage) and both manual or deep learning based automatic brain extraction.
 
 """
 
 import os
+import gzip
+import shutil
 import traceback
 from glob import glob
 
@@ -37,21 +39,25 @@ except ImportError:
 
 from traits.api import *
 
+from nipype import logging
 from nipype.utils.filemanip import split_filename
+from nipype.interfaces.base.traits_extension import isdefined
 from nipype.interfaces.base import traits, \
     TraitedSpec, File, InputMultiPath, OutputMultiPath, BaseInterface, BaseInterfaceInputSpec
 
-from pymialsrtk.interfaces.utils import run
+from pymialsrtk.interfaces.utils import run, get_threads_env, CachedHashInputSpec, load_image_data, save_image_data, \
+    resample_to_reference_grid
 
 
 ###############
 # NLM denoising
 ###############
 
-class BtkNLMDenoisingInputSpec(BaseInterfaceInputSpec):
+class BtkNLMDenoisingInputSpec(CachedHashInputSpec):
     """Class used to represent inputs of the BtkNLMDenoising interface."""
 
-    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True)
+    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True, nohash=True)
+    num_threads = traits.Int(desc='Number of threads used by the tool (inherited from the environment if not set)', nohash=True)
     in_file = File(desc='Input image filename', mandatory=True)
     in_mask = File(desc='Input mask filename', mandatory=False)
     out_postfix = traits.Str("_nlm",
@@ -111,7 +117,7 @@ class BtkNLMDenoising(BaseInterface):
 
         try:
             print('... cmd: {}'.format(cmd))
-            run(cmd , env={}, cwd=os.path.abspath(self.inputs.bids_dir))
+            run(cmd, env=get_threads_env(self.inputs.num_threads), cwd=os.path.abspath(self.inputs.bids_dir))
         except Exception as e:
             print('Failed')
             print(e)
@@ -123,10 +129,11 @@ class BtkNLMDenoising(BaseInterface):
         return outputs
 
 
-class MultipleBtkNLMDenoisingInputSpec(BaseInterfaceInputSpec):
+class MultipleBtkNLMDenoisingInputSpec(CachedHashInputSpec):
     """Class used to represent inputs of the MultipleBtkNLMDenoising interface."""
 
-    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True)
+    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True, nohash=True)
+    num_threads = traits.Int(desc='Number of threads used by the tool (inherited from the environment if not set)', nohash=True)
     input_images = InputMultiPath(File(mandatory=True), desc='Input image filenames to be denoised')
     input_masks = InputMultiPath(File(mandatory=False), desc='Input mask filenames')
     weight = traits.Float(0.1,
@@ -180,14 +187,16 @@ class MultipleBtkNLMDenoising(BaseInterface):
                                      in_file=in_image,
                                      in_mask=in_mask,
                                      out_postfix=self.inputs.out_postfix,
-                                     weight=self.inputs.weight)
+                                     weight=self.inputs.weight,
+                                     num_threads=self.inputs.num_threads)
                 ax.run()
         else:
             for in_image in self.inputs.input_images:
                 ax = BtkNLMDenoising(bids_dir=self.inputs.bids_dir,
                                      in_file=in_image,
                                      out_postfix=self.inputs.out_postfix,
-                                     weight=self.inputs.weight)
+                                     weight=self.inputs.weight,
+                                     num_threads=self.inputs.num_threads)
 
                 ax.run()
 
@@ -203,10 +212,11 @@ class MultipleBtkNLMDenoising(BaseInterface):
 # Slice intensity correction
 #############################
 
-class MialsrtkCorrectSliceIntensityInputSpec(BaseInterfaceInputSpec):
+class MialsrtkCorrectSliceIntensityInputSpec(CachedHashInputSpec):
     """Class used to represent inputs of the MialsrtkCorrectSliceIntensity interface."""
 
-    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True)
+    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True, nohash=True)
+    num_threads = traits.Int(desc='Number of threads used by the tool (inherited from the environment if not set)', nohash=True)
     in_file = File(desc='Input image filename', mandatory=True)
     in_mask = File(desc='Input mask filename', mandatory=False)
     out_postfix = traits.Str("",
@@ -252,7 +262,7 @@ class MialsrtkCorrectSliceIntensity(BaseInterface):
         cmd = 'mialsrtkCorrectSliceIntensity "{}" "{}" "{}"'.format(self.inputs.in_file, self.inputs.in_mask, out_file)
         try:
             print('... cmd: {}'.format(cmd))
-            run(cmd, env={}, cwd=os.path.abspath(self.inputs.bids_dir))
+            run(cmd, env=get_threads_env(self.inputs.num_threads), cwd=os.path.abspath(self.inputs.bids_dir))
         except Exception as e:
             print('Failed')
             print(e)
@@ -264,10 +274,10 @@ class MialsrtkCorrectSliceIntensity(BaseInterface):
         return outputs
 
 
-class MultipleMialsrtkCorrectSliceIntensityInputSpec(BaseInterfaceInputSpec):
+class MultipleMialsrtkCorrectSliceIntensityInputSpec(CachedHashInputSpec):
     """Class used to represent inputs of the MultipleMialsrtkCorrectSliceIntensity interface."""
 
-    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True)
+    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True, nohash=True)
     input_images = InputMultiPath(File(mandatory=True),
                                   desc='Input image filenames to be corrected for slice intensity')
     input_masks = InputMultiPath(File(mandatory=False),
@@ -333,10 +343,11 @@ class MultipleMialsrtkCorrectSliceIntensity(BaseInterface):
 # Slice by slice N4 bias field correction
 ##########################################
 
-class MialsrtkSliceBySliceN4BiasFieldCorrectionInputSpec(BaseInterfaceInputSpec):
+class MialsrtkSliceBySliceN4BiasFieldCorrectionInputSpec(CachedHashInputSpec):
     """Class used to represent inputs of the MialsrtkSliceBySliceN4BiasFieldCorrection interface."""
 
-    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True)
+    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True, nohash=True)
+    num_threads = traits.Int(desc='Number of threads used by the tool (inherited from the environment if not set)', nohash=True)
     in_file = File(desc='Input image', mandatory=True)
     in_mask = File(desc='Input mask', mandatory=True)
     out_im_postfix = traits.Str("_bcorr",
@@ -400,7 +411,7 @@ class MialsrtkSliceBySliceN4BiasFieldCorrection(BaseInterface):
                                                                                      out_im_file, out_fld_file)
         try:
             print('... cmd: {}'.format(cmd))
-            run(cmd, env={}, cwd=os.path.abspath(self.inputs.bids_dir))
+            run(cmd, env=get_threads_env(self.inputs.num_threads), cwd=os.path.abspath(self.inputs.bids_dir))
         except Exception as e:
             print('Failed')
             print(e)
@@ -413,10 +424,10 @@ class MialsrtkSliceBySliceN4BiasFieldCorrection(BaseInterface):
         return outputs
 
 
-class MultipleMialsrtkSliceBySliceN4BiasFieldCorrectionInputSpec(BaseInterfaceInputSpec):
+class MultipleMialsrtkSliceBySliceN4BiasFieldCorrectionInputSpec(CachedHashInputSpec):
     """Class used to represent inputs of the MultipleMialsrtkSliceBySliceN4BiasFieldCorrection interface."""
 
-    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True)
+    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True, nohash=True)
     input_images = InputMultiPath(File(mandatory=True), desc='files to be corrected for intensity')
     input_masks = InputMultiPath(File(mandatory=True), desc='mask of files to be corrected for intensity')
     out_im_postfix = traits.Str("_bcorr",
@@ -482,10 +493,11 @@ class MultipleMialsrtkSliceBySliceN4BiasFieldCorrection(BaseInterface):
 # slice by slice correct bias field
 #####################################
 
-class MialsrtkSliceBySliceCorrectBiasFieldInputSpec(BaseInterfaceInputSpec):
+class MialsrtkSliceBySliceCorrectBiasFieldInputSpec(CachedHashInputSpec):
     """Class used to represent outputs of the MialsrtkSliceBySliceCorrectBiasField interface."""
 
-    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True)
+    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True, nohash=True)
+    num_threads = traits.Int(desc='Number of threads used by the tool (inherited from the environment if not set)', nohash=True)
     in_file = File(desc='Input image file', mandatory=True)
     in_mask = File(desc='Input mask file', mandatory=True)
     in_field = File(desc='Input bias field file', mandatory=True)
@@ -532,7 +544,7 @@ class MialsrtkSliceBySliceCorrectBiasField(BaseInterface):
         cmd = 'mialsrtkSliceBySliceCorrectBiasField "{}" "{}" "{}" "{}"'.format(self.inputs.in_file, self.inputs.in_mask, self.inputs.in_field, out_im_file)
         try:
             print('... cmd: {}'.format(cmd))
-            run(cmd, env={}, cwd=os.path.abspath(self.inputs.bids_dir))
+            run(cmd, env=get_threads_env(self.inputs.num_threads), cwd=os.path.abspath(self.inputs.bids_dir))
         except Exception as e:
             print('Failed')
             print(e)
@@ -543,10 +555,10 @@ class MialsrtkSliceBySliceCorrectBiasField(BaseInterface):
         outputs['out_im_file'] = self._gen_filename('out_im_file')
         return outputs
 
-class MultipleMialsrtkSliceBySliceCorrectBiasFieldInputSpec(BaseInterfaceInputSpec):
+class MultipleMialsrtkSliceBySliceCorrectBiasFieldInputSpec(CachedHashInputSpec):
     """Class used to represent inputs of the MultipleMialsrtkSliceBySliceCorrectBiasField interface."""
 
-    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True)
+    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True, nohash=True)
     input_images = InputMultiPath(File(mandatory=True), desc='Files to be corrected for intensity')
     input_masks = InputMultiPath(File(mandatory=True), desc='Mask files to be corrected for intensity')
     input_fields = InputMultiPath(File(mandatory=True), desc='Bias field files to be removed', )
@@ -607,10 +619,11 @@ class MultipleMialsrtkSliceBySliceCorrectBiasField(BaseInterface):
 # Intensity standardization
 #############################
 
-class MialsrtkIntensityStandardizationInputSpec(BaseInterfaceInputSpec):
+class MialsrtkIntensityStandardizationInputSpec(CachedHashInputSpec):
     """Class used to represent inputs of the MialsrtkIntensityStandardization interface."""
 
-    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True)
+    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True, nohash=True)
+    num_threads = traits.Int(desc='Number of threads used by the tool (inherited from the environment if not set)', nohash=True)
     input_images = InputMultiPath(File(mandatory=True), desc='Files to be corrected for intensity')
     out_postfix = traits.Str("", desc='Suffix to be added to intensity corrected input_images', usedefault=True)
     in_max = traits.Float(desc='Maximal intensity', usedefault=False)
@@ -662,7 +675,7 @@ class MialsrtkIntensityStandardization(BaseInterface):
 
         try:
             print('... cmd: {}'.format(cmd))
-            run(cmd, env={}, cwd=os.path.abspath(self.inputs.bids_dir))
+            run(cmd, env=get_threads_env(self.inputs.num_threads), cwd=os.path.abspath(self.inputs.bids_dir))
         except Exception as e:
             print('Failed')
             print(e)
@@ -678,10 +691,11 @@ class MialsrtkIntensityStandardization(BaseInterface):
 # Histogram normalization
 ###########################
 
-class MialsrtkHistogramNormalizationInputSpec(BaseInterfaceInputSpec):
+class MialsrtkHistogramNormalizationInputSpec(CachedHashInputSpec):
     """Class used to represent outputs of the MialsrtkHistogramNormalization interface."""
 
-    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True)
+    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True, nohash=True)
+    num_threads = traits.Int(desc='Number of threads used by the tool (inherited from the environment if not set)', nohash=True)
     input_images = InputMultiPath(File(mandatory=True), desc='Input image filenames to be normalized')
     input_masks = InputMultiPath(File(mandatory=False), desc='Input mask filenames')
     out_postfix = traits.Str("_histnorm",
@@ -739,7 +753,7 @@ class MialsrtkHistogramNormalization(BaseInterface):
                 cmd = cmd + ' -i "{}" -o "{}"" '.format(in_file, out_file)
         try:
             print('... cmd: {}'.format(cmd))
-            run(cmd, env={}, cwd=os.path.abspath(self.inputs.bids_dir))
+            run(cmd, env=get_threads_env(self.inputs.num_threads), cwd=os.path.abspath(self.inputs.bids_dir))
         except Exception as e:
             print('Failed')
             print(e)
@@ -752,14 +766,209 @@ class MialsrtkHistogramNormalization(BaseInterface):
         return outputs
 
 
+#####################################################################
+# Fused intensity standardization and histogram normalization
+#####################################################################
+
+class IntensityNormalizationInputSpec(CachedHashInputSpec):
+    """Class used to represent inputs of the IntensityNormalization interface."""
+
+    input_images = InputMultiPath(File(mandatory=True), desc='Input image filenames to be normalized')
+    input_masks = InputMultiPath(File(mandatory=False), desc='Input mask filenames')
+    in_max = traits.Float(255.0, desc='Maximal intensity', usedefault=True)
+    out_postfix = traits.Str("_histnorm",
+                             desc='Suffix to be added to input image filenames to construct output normalized image filenames',
+                             usedefault=True)
+    save_intermediates = traits.Bool(False,
+                                     desc='Save the images after the first standardization ("_rescaled") and '
+                                          'after the histogram normalization ("_histnorm_unscaled") for debugging',
+                                     usedefault=True)
+
+
+class IntensityNormalizationOutputSpec(TraitedSpec):
+    """Class used to represent outputs of the IntensityNormalization interface."""
+
+    output_images = OutputMultiPath(File(), desc='Intensity-standardized histogram-normalized images')
+    intermediate_images = OutputMultiPath(File(), desc='Intermediate images (only if save_intermediates is True)')
+
+
+class IntensityNormalization(BaseInterface):
+    """Runs in-process the intensity standardization, histogram normalization and intensity standardization sequence.
+
+    It is equivalent to the successive execution of :class:`MialsrtkIntensityStandardization`,
+    :class:`MialsrtkHistogramNormalization` and :class:`MialsrtkIntensityStandardization`,
+    but the images and masks are loaded only once and all the steps are performed in memory.
+    Between the steps, the images are rounded to single precision as when they are
+    written by the separate tools.
+
+    The intensity standardization rescales linearly the intensity range of each image
+    to ``[0, max_i / max_all * in_max]``. The histogram normalization implements the
+    method proposed by Nyúl et al. [1]_ with the percentiles 25, 50 and 75 as landmarks.
+
+    References
+    ------------
+    .. [1] Nyúl et al.; Medical Imaging, IEEE Transactions, 2000. `(link to paper) <https://ieeexplore.ieee.org/document/836373>`_
+
+    Example
+    =======
+    >>> from pymialsrtk.interfaces.preprocess import IntensityNormalization
+    >>> intensityNorm = IntensityNormalization()
+    >>> intensityNorm.inputs.input_images = ['sub-01_acq-haste_run-1_T2w.nii.gz','sub-01_acq-haste_run-2_T2w.nii.gz']
+    >>> intensityNorm.inputs.input_masks = ['sub-01_acq-haste_run-1_mask.nii.gz','sub-01_acq-haste_run-2_mask.nii.gz']
+    >>> intensityNorm.run() # doctest: +SKIP
+
+    """
+
+    input_spec = IntensityNormalizationInputSpec
+    output_spec = IntensityNormalizationOutputSpec
+
+    def _gen_filename(self, orig, name):
+        if name == 'output_images':
+            _, name, ext = split_filename(orig)
+            output = name + self.inputs.out_postfix + ext
+            return os.path.abspath(output)
+        elif name == 'rescaled_images':
+            _, name, ext = split_filename(orig)
+            return os.path.abspath(name + "_rescaled" + ext)
+        elif name == 'unscaled_images':
+            _, name, ext = split_filename(orig)
+            return os.path.abspath(name + "_histnorm_unscaled" + ext)
+        return None
+
+    def _run_interface(self, runtime):
+        try:
+            references = []
+            images = []
+            for input_image in self.inputs.input_images:
+                img, data = load_image_data(input_image)
+                references.append(img)
+                images.append(np.asarray(data, dtype=np.float32))
+
+            if len(self.inputs.input_masks) > 0:
+                masks = [load_image_data(input_mask)[1] for input_mask in self.inputs.input_masks]
+            else:
+                masks = [np.ones(image.shape, dtype=np.uint8) for image in images]
+
+            images = self._standardize_intensity(images, self.inputs.in_max)
+            if self.inputs.save_intermediates:
+                for image, img, input_image in zip(images, references, self.inputs.input_images):
+                    save_image_data(image, img, self._gen_filename(input_image, 'rescaled_images'))
+
+            images = self._normalize_histogram(images, masks)
+            if self.inputs.save_intermediates:
+                for image, img, input_image in zip(images, references, self.inputs.input_images):
+                    save_image_data(image, img, self._gen_filename(input_image, 'unscaled_images'))
+
+            images = self._standardize_intensity(images, self.inputs.in_max)
+            for image, img, input_image in zip(images, references, self.inputs.input_images):
+                save_image_data(image, img, self._gen_filename(input_image, 'output_images'))
+        except Exception as e:
+            print('Failed')
+            print(e)
+        return runtime
+
+    @staticmethod
+    def _standardize_intensity(images, in_max):
+        """Rescale the intensity of each image to ``[0, max_i / max_all * in_max]``, as ``mialsrtkIntensityStandardization``."""
+        minimums = [float(np.min(image)) for image in images]
+        maximums = [float(np.max(image)) for image in images]
+        global_max = max([0.0] + maximums)
+
+        outputs = []
+        for image, im_min, im_max in zip(images, minimums, maximums):
+            new_max = (im_max / global_max) * in_max
+            # Same scaling as itk::RescaleIntensityImageFilter
+            if im_max != im_min:
+                scale = new_max / (im_max - im_min)
+            elif im_max != 0:
+                scale = new_max / im_max
+            else:
+                scale = 0.0
+            print('Old range = [0,{}],  New range = [0,{}]'.format(im_max, new_max))
+            outputs.append(((image.astype(np.float64) - im_min) * scale).astype(np.float32))
+        return outputs
+
+    @staticmethod
+    def _extract_landmarks(image, mask):
+        """Return the minimum, the 99.8th percentile and the quartiles of the non-zero intensities of the masked image."""
+        values = np.sort((image * mask).ravel())
+        values = values[values != 0]
+
+        def percentile(p):
+            return values[int(len(values) * (p / 100.0))]
+
+        return {'p1': percentile(0),
+                'p2': percentile(99.8),
+                'quartiles': [percentile(25), percentile(50), percentile(75)]}
+
+    @classmethod
+    def _normalize_histogram(cls, images, masks):
+        """Map piecewise linearly the landmarks of each image to the mean standard scale landmarks, as ``mialsrtkHistogramNormalization.py``."""
+        list_landmarks = [cls._extract_landmarks(image, mask) for image, mask in zip(images, masks)]
+
+        # Estimation of the standard scale
+        s1 = 1
+        max_ratio = None
+        for landmarks in list_landmarks:
+            quartiles = np.array(landmarks['quartiles'])
+            mup_l = np.min(quartiles - landmarks['p1'])
+            mup_L = np.max(quartiles - landmarks['p1'])
+            mup_r = np.min(landmarks['p2'] - quartiles)
+            mup_R = np.max(landmarks['p2'] - quartiles)
+            ratio = np.max([float(mup_L) / mup_l, float(mup_R) / mup_r])
+            if max_ratio is None or ratio > max_ratio:
+                max_ratio = ratio
+                dS = float(ratio * (mup_L + mup_R))
+        s2 = np.ceil(dS - s1)
+        print('Standard scale estimated: [{}, {}]'.format(s1, s2))
+
+        # Mean of the landmarks mapped to the standard scale
+        mean_landmarks = np.zeros(len(list_landmarks[0]['quartiles']))
+        for landmarks in list_landmarks:
+            for i, q in enumerate(landmarks['quartiles']):
+                mean_landmarks[i] += s1 + float((q - landmarks['p1']) / float(landmarks['p2'] - landmarks['p1'])) * float(s2 - s1)
+        mean_landmarks = mean_landmarks / len(list_landmarks)
+        print('Final landmark average : {}'.format(mean_landmarks))
+
+        outputs = []
+        for image, landmarks in zip(images, list_landmarks):
+            quartiles = landmarks['quartiles']
+            xs = [landmarks['p1']] + quartiles + [landmarks['p2']]
+            ys = [s1] + list(mean_landmarks) + [s2]
+            image_out = image.astype(np.float64)
+            for i in range(len(xs) - 1):
+                coefs = np.polyfit(np.array([int(xs[i]), int(xs[i + 1])]),
+                                   np.array([int(ys[i]), int(ys[i + 1])]), 1)
+                if i == 0:
+                    mask = np.logical_and(image > 0, image <= xs[i + 1])
+                elif i == len(xs) - 2:
+                    mask = image > xs[i]
+                else:
+                    mask = np.logical_and(image > xs[i], image <= xs[i + 1])
+                image_out[mask] = coefs[0] * image[mask] + coefs[1]
+            outputs.append(image_out.astype(np.float32))
+        return outputs
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output_images'] = [self._gen_filename(input_image, 'output_images')
+                                    for input_image in self.inputs.input_images]
+        if self.inputs.save_intermediates:
+            outputs['intermediate_images'] = [self._gen_filename(input_image, name)
+                                              for name in ['rescaled_images', 'unscaled_images']
+                                              for input_image in self.inputs.input_images]
+        return outputs
+
+
 ##############
 # Mask Image
 ##############
 
-class MialsrtkMaskImageInputSpec(BaseInterfaceInputSpec):
+class MialsrtkMaskImageInputSpec(CachedHashInputSpec):
     """Class used to represent inputs of the MialsrtkMaskImage interface."""
 
-    bids_dir = Directory(desc='BIDS root directory',mandatory=True,exists=True)
+    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True, nohash=True)
+    num_threads = traits.Int(desc='Number of threads used by the tool (inherited from the environment if not set)', nohash=True)
     in_file = File(desc='Input image filename to be masked',mandatory=True)
     in_mask = File(desc='Input mask filename',mandatory=True)
     out_im_postfix = traits.Str("", desc='Suffix to be added to masked in_file', usedefault=True)
@@ -802,7 +1011,7 @@ class MialsrtkMaskImage(BaseInterface):
         cmd = 'mialsrtkMaskImage -i "{}" -m "{}" -o "{}"'.format(self.inputs.in_file, self.inputs.in_mask, out_im_file)
         try:
             print('... cmd: {}'.format(cmd))
-            run(cmd, env={}, cwd=os.path.abspath(self.inputs.bids_dir))
+            run(cmd, env=get_threads_env(self.inputs.num_threads), cwd=os.path.abspath(self.inputs.bids_dir))
         except Exception as e:
             print('Failed')
             print(e)
@@ -814,10 +1023,10 @@ class MialsrtkMaskImage(BaseInterface):
         return outputs
 
 
-class MultipleMialsrtkMaskImageInputSpec(BaseInterfaceInputSpec):
+class MultipleMialsrtkMaskImageInputSpec(CachedHashInputSpec):
     """Class used to represent outputs of the MultipleMialsrtkMaskImage interface."""
 
-    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True)
+    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True, nohash=True)
     input_images = InputMultiPath(File(mandatory=True),
                                   desc='Input image filenames to be corrected for intensity')
     input_masks = InputMultiPath(File(mandatory=True), desc='Input mask filenames ')
@@ -871,12 +1080,244 @@ class MultipleMialsrtkMaskImage(BaseInterface):
         return outputs
 
 
+class MaskImageInputSpec(CachedHashInputSpec):
+    """Class used to represent inputs of the MaskImage interface."""
+
+    in_file = File(desc='Input image filename to be masked', mandatory=True)
+    in_mask = File(desc='Input mask filename', mandatory=True)
+    out_im_postfix = traits.Str("", desc='Suffix to be added to masked in_file', usedefault=True)
+
+
+class MaskImageOutputSpec(TraitedSpec):
+    """Class used to represent outputs of the MaskImage interface."""
+
+    out_im_file = File(desc='Masked image')
+
+
+class MaskImage(BaseInterface):
+    """Runs in-process the masking of an image.
+
+    This is a vectorized NumPy equivalent of :class:`pymialsrtk.interfaces.preprocess.MialsrtkMaskImage`
+    that writes the same output: the image, read as float32, is multiplied by the mask,
+    read as uint8 and resampled onto the image grid by nearest neighbor interpolation.
+
+    Example
+    =======
+    >>> from pymialsrtk.interfaces.preprocess import MaskImage
+    >>> maskImg = MaskImage()
+    >>> maskImg.inputs.in_file = 'sub-01_acq-haste_run-1_T2w.nii.gz'
+    >>> maskImg.inputs.in_mask = 'sub-01_acq-haste_run-1_mask.nii.gz'
+    >>> maskImg.inputs.out_im_postfix = '_masked'
+    >>> maskImg.run() # doctest: +SKIP
+
+    """
+
+    input_spec = MaskImageInputSpec
+    output_spec = MaskImageOutputSpec
+
+    def _gen_filename(self, name):
+        if name == 'out_im_file':
+            _, name, ext = split_filename(self.inputs.in_file)
+            output = name + self.inputs.out_im_postfix + ext
+            return os.path.abspath(output)
+        return None
+
+    def _run_interface(self, runtime):
+        out_im_file = self._gen_filename('out_im_file')
+
+        try:
+            img, data = load_image_data(self.inputs.in_file)
+            mask_img, mask = load_image_data(self.inputs.in_mask)
+            mask = resample_to_reference_grid(mask.astype(np.uint8), mask_img.affine, data.shape, img.affine)
+            save_image_data(data.astype(np.float32) * mask, img, out_im_file, 'intensity')
+        except Exception as e:
+            print('Failed')
+            print(e)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_im_file'] = self._gen_filename('out_im_file')
+        return outputs
+
+
+##########################
+# Crop image using mask
+##########################
+
+class CropImageUsingMaskInputSpec(CachedHashInputSpec):
+    """Class used to represent inputs of the CropImageUsingMask interface."""
+
+    in_file = File(desc='Input image filename to be cropped', mandatory=True)
+    in_mask = File(desc='Input mask filename', mandatory=True)
+    margin = traits.Float(0.0, desc='Margin (in mm) added around the bounding box of the mask', usedefault=True)
+    out_postfix = traits.Str("_crop", desc='Suffix to be added to cropped in_file', usedefault=True)
+
+
+class CropImageUsingMaskOutputSpec(TraitedSpec):
+    """Class used to represent outputs of the CropImageUsingMask interface."""
+
+    out_file = File(desc='Cropped image')
+
+
+class CropImageUsingMask(BaseInterface):
+    """Runs in-process the cropping of an image to the bounding box of a mask.
+
+    This is a vectorized NumPy equivalent of the ``mialsrtkCropImageUsingMask`` tool:
+    the mask is resampled onto the image grid by nearest neighbor interpolation and the
+    image is cropped to the axis-aligned bounding box of the non-zero mask voxels,
+    optionally enlarged by a margin in mm (no margin as in the C++ tool by default).
+    If the mask is empty, the image is not cropped. The data type of the image is preserved and the affine of the cropped image
+    is translated such that the world coordinates of the voxels are kept.
+
+    Example
+    =======
+    >>> from pymialsrtk.interfaces.preprocess import CropImageUsingMask
+    >>> cropImg = CropImageUsingMask()
+    >>> cropImg.inputs.in_file = 'sub-01_acq-haste_run-1_T2w.nii.gz'
+    >>> cropImg.inputs.in_mask = 'sub-01_acq-haste_run-1_mask.nii.gz'
+    >>> cropImg.inputs.margin = 10.0
+    >>> cropImg.run() # doctest: +SKIP
+
+    """
+
+    input_spec = CropImageUsingMaskInputSpec
+    output_spec = CropImageUsingMaskOutputSpec
+
+    def _gen_filename(self, name):
+        if name == 'out_file':
+            _, name, ext = split_filename(self.inputs.in_file)
+            output = name + self.inputs.out_postfix + ext
+            return os.path.abspath(output)
+        return None
+
+    def _run_interface(self, runtime):
+        out_file = self._gen_filename('out_file')
+
+        try:
+            img, data = load_image_data(self.inputs.in_file)
+            mask_img, mask = load_image_data(self.inputs.in_mask)
+            mask = resample_to_reference_grid(mask.astype(np.uint8), mask_img.affine, data.shape, img.affine)
+
+            start, stop = self._compute_bounding_box(mask, self.inputs.margin, img.header.get_zooms()[:3])
+            cropped = np.asarray(data[start[0]:stop[0], start[1]:stop[1], start[2]:stop[2]])
+
+            affine = img.affine.copy()
+            affine[:3, 3] = img.affine[:3, :3].dot(start) + img.affine[:3, 3]
+            save_image_data(cropped, img, out_file, None, affine)
+        except Exception as e:
+            print('Failed')
+            print(e)
+        return runtime
+
+    @staticmethod
+    def _compute_bounding_box(mask, margin=0.0, zooms=None):
+        """Return the first and last+1 voxel indices of the bounding box of the non-zero mask voxels.
+
+        The bounding box is enlarged by ``margin`` mm on each side, converted to a number
+        of voxels with the voxel sizes ``zooms``, and clipped to the extent of the mask.
+        """
+        indices = np.nonzero(mask)
+        if len(indices[0]) == 0:
+            return np.zeros(3, dtype=int), np.array(mask.shape[:3])
+
+        if margin > 0 and zooms is not None:
+            pad = np.array([int(np.ceil(margin / float(zoom))) for zoom in zooms])
+        else:
+            pad = np.zeros(3, dtype=int)
+
+        start = np.array([int(np.min(ind)) for ind in indices]) - pad
+        stop = np.array([int(np.max(ind)) + 1 for ind in indices]) + pad
+        return np.maximum(start, 0), np.minimum(stop, np.array(mask.shape[:3]))
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._gen_filename('out_file')
+        return outputs
+
+
+###########################
+# NIfTI format conversion
+###########################
+
+class NiftiConversionInputSpec(CachedHashInputSpec):
+    """Class used to represent inputs of the NiftiConversion interface."""
+
+    input_images = InputMultiPath(File(mandatory=True), desc='Input NIfTI image filenames')
+    out_ext = traits.Enum('.nii', '.nii.gz',
+                          desc='Extension of the output images: uncompressed (.nii) or gzip-compressed (.nii.gz)',
+                          usedefault=True)
+    compress_level = traits.Range(low=1, high=9, value=1, usedefault=True,
+                                  desc='gzip compression level used for .nii.gz outputs (1 by default, as in nibabel)')
+
+
+class NiftiConversionOutputSpec(TraitedSpec):
+    """Class used to represent outputs of the NiftiConversion interface."""
+
+    output_images = OutputMultiPath(File(), desc='Converted images')
+
+
+class NiftiConversion(BaseInterface):
+    """Runs the conversion of NIfTI images between the uncompressed (.nii) and gzip-compressed (.nii.gz) formats.
+
+    It is used to process intermediate images in the uncompressed format,
+    which avoid their compression and decompression by each processing step and
+    can be memory-mapped by nibabel, and to compress the final outputs.
+    Images already in the target format are passed through without copy.
+
+    Example
+    =======
+    >>> from pymialsrtk.interfaces.preprocess import NiftiConversion
+    >>> niftiConversion = NiftiConversion()
+    >>> niftiConversion.inputs.input_images = ['sub-01_acq-haste_run-1_T2w.nii.gz', 'sub-01_acq-haste_run-2_T2w.nii.gz']
+    >>> niftiConversion.inputs.out_ext = '.nii'
+    >>> niftiConversion.run() # doctest: +SKIP
+
+    """
+
+    input_spec = NiftiConversionInputSpec
+    output_spec = NiftiConversionOutputSpec
+
+    def _gen_filename(self, orig, name):
+        if name == 'output_images':
+            _, name, ext = split_filename(orig)
+            if ext == self.inputs.out_ext:
+                return orig
+            output = name + self.inputs.out_ext
+            return os.path.abspath(output)
+        return None
+
+    def _run_interface(self, runtime):
+
+        for input_image in self.inputs.input_images:
+            out_file = self._gen_filename(input_image, 'output_images')
+            if out_file == input_image:
+                continue
+            try:
+                if self.inputs.out_ext == '.nii':
+                    with gzip.open(input_image, 'rb') as f_in, open(out_file, 'wb') as f_out:
+                        shutil.copyfileobj(f_in, f_out, 8 * 1024 * 1024)
+                else:
+                    with open(input_image, 'rb') as f_in, \
+                            gzip.open(out_file, 'wb', compresslevel=self.inputs.compress_level) as f_out:
+                        shutil.copyfileobj(f_in, f_out, 8 * 1024 * 1024)
+            except Exception as e:
+                print('Failed')
+                print(e)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output_images'] = [self._gen_filename(input_image, 'output_images') for input_image in self.inputs.input_images]
+        return outputs
+
+
 ###############################
 # Stacks ordering and filtering
 ###############################
 
 
-class FilteringByRunidInputSpec(BaseInterfaceInputSpec):
+class FilteringByRunidInputSpec(CachedHashInputSpec):
     """Class used to represent inputs of the FilteringByRunid interface."""
 
     input_files = InputMultiPath(File(mandatory=True),
@@ -932,17 +1373,22 @@ class FilteringByRunid(BaseInterface):
         return outputs
 
 
-class StacksOrderingInputSpec(BaseInterfaceInputSpec):
+class StacksOrderingInputSpec(CachedHashInputSpec):
     """Class used to represent inputs of the StacksOrdering interface."""
 
     input_masks = InputMultiPath(File(mandatory=True),
                                  desc='Input brain masks on which motion is computed')
+    max_motion_index = traits.Float(desc='Motion index above which a stack is dropped (the stack with '
+                                         'the lowest motion index is always kept)')
+    max_stacks = traits.Int(0, desc='Maximal number of stacks kept (0: no limit)', usedefault=True)
 
 
 class StacksOrderingOutputSpec(TraitedSpec):
     """Class used to represent outputs of the StacksOrdering interface."""
 
     stacks_order = traits.List(desc='Order of image `run-id` to be used for reconstruction')
+    motion_indices = traits.Dict(desc='Motion index of each stack, indexed by `run-id`')
+    dropped_stacks = traits.List(desc='`run-id` of the stacks dropped by the selection')
 
 
 class StacksOrdering(BaseInterface):
@@ -950,12 +1396,21 @@ class StacksOrdering(BaseInterface):
 
     This module is based on the tracking of the brain mask centroid slice by slice.
 
+    Stacks can be dropped according to their motion index, either above ``max_motion_index``,
+    or beyond the ``max_stacks`` first stacks of the order. When the view plane is specified in
+    the filenames (tag `vp`), the order starts with the least moving stack of each orientation,
+    and these 3 stacks are always kept, such that the orientation coverage is preserved. Only if
+    ``max_stacks`` is lower than 3 an orientation is dropped, with a warning.
+
     Examples
     --------
     >>> from pymialsrtk.interfaces.preprocess import StacksOrdering
     >>> stacksOrdering = StacksOrdering()
     >>> stacksOrdering.inputs.input_masks = ['sub-01_run-1_mask.nii.gz', 'sub-01_run-4_mask.nii.gz', 'sub-01_run-2_mask.nii.gz']
     >>> stacksOrdering.run() # doctest: +SKIP
+    >>> # Keep the 2 stacks with the lowest motion index
+    >>> stacksOrdering.inputs.max_stacks = 2
+    >>> stacksOrdering.run() # doctest: +SKIP
 
     """
 
@@ -963,10 +1418,15 @@ class StacksOrdering(BaseInterface):
     output_spec = StacksOrderingOutputSpec
 
     m_stack_order = []
+    m_motion_indices = {}
+    m_dropped_stacks = []
 
     def _run_interface(self, runtime):
         try:
-            self.m_stack_order = self._compute_stack_order(self.inputs.input_masks)
+            stack_order = self._compute_stack_order(self.inputs.input_masks)
+            vp_defined = -1 not in [f.find('vp') for f in self.inputs.input_masks]
+            self.m_stack_order, self.m_dropped_stacks = self._select_stacks(stack_order, self.m_motion_indices,
+                                                                            vp_defined)
         except Exception as e:
             print('Failed')
             print(e)
@@ -975,8 +1435,41 @@ class StacksOrdering(BaseInterface):
     def _list_outputs(self):
         outputs = self._outputs().get()
         outputs['stacks_order'] = self.m_stack_order
+        outputs['motion_indices'] = self.m_motion_indices
+        outputs['dropped_stacks'] = self.m_dropped_stacks
         return outputs
 
+    def _select_stacks(self, p_stack_order, p_motion_indices, p_vp_defined=False):
+        """Function to drop the stacks above the maximal motion index and beyond the maximal number of stacks.
+
+        When the view plane is specified (``p_vp_defined``), the 3 first stacks of the order,
+        one per orientation, are kept before the other stacks are selected.
+
+        Returns the order of the kept stacks and the list of the dropped ones.
+        """
+        iflogger = logging.getLogger('nipype.interface')
+        orientation_stacks = list(p_stack_order[:3]) if p_vp_defined else []
+        kept = [run_id for run_id in p_stack_order if run_id not in orientation_stacks]
+
+        if isdefined(self.inputs.max_motion_index):
+            kept = [run_id for run_id in kept if p_motion_indices[run_id] <= self.inputs.max_motion_index]
+            if not kept and not orientation_stacks:
+                kept = [min(p_stack_order, key=lambda run_id: p_motion_indices[run_id])]
+
+        kept = orientation_stacks + kept
+        if self.inputs.max_stacks > 0:
+            if self.inputs.max_stacks < len(orientation_stacks):
+                iflogger.warning('Only {} stack(s) kept (max_stacks): the orientation(s) of the stack(s) {} '
+                                 'are not covered'.format(self.inputs.max_stacks,
+                                                          orientation_stacks[self.inputs.max_stacks:]))
+            kept = kept[:self.inputs.max_stacks]
+
+        dropped = [run_id for run_id in p_stack_order if run_id not in kept]
+        if dropped:
+            print('Stacks dropped by the selection (run-id: motion index): {}'.format(
+                {run_id: p_motion_indices[run_id] for run_id in dropped}))
+        return kept, dropped
+
     def _compute_motion_index(self, in_file):
         """Function to compute the motion index.
 
@@ -984,11 +1477,9 @@ class StacksOrdering(BaseInterface):
         """
         central_third = True
 
-        img = nibabel.load(in_file)
-
         # Todo: Compute centroid displacement as a distance instead of a number of voxel
         # voxelspacing = img.header['pixdim'][2]
-        data = img.get_fdata()
+        _, data = load_image_data(in_file)
 
         z = np.where(data)[2]
         data = data[..., int(min(z)):int(max(z) + 1)]
@@ -1002,7 +1493,7 @@ class StacksOrdering(BaseInterface):
         centroid_coord = np.zeros((data.shape[2], 2))
 
         for i in range(data.shape[2]):
-            moments = skimage.measure.moments(data[..., i])
+            moments = skimage.measure.moments(data[..., i].astype(np.float64))
             centroid_coord[i, :] = [moments[0, 1] / moments[0, 0], moments[1, 0] / moments[0, 0]]
 
         centroid_coord = centroid_coord[~np.isnan(centroid_coord)]
@@ -1025,6 +1516,8 @@ class StacksOrdering(BaseInterface):
         for f in in_files:
             motion_ind.append(self._compute_motion_index(f))
 
+        self.m_motion_indices = {int(f.split('run-')[1].split('_')[0]): float(m) for f, m in zip(in_files, motion_ind)}
+
         vp_defined = -1 not in [f.find('vp') for f in in_files]
         if vp_defined:
             orientations_ = []
@@ -1067,10 +1560,11 @@ class StacksOrdering(BaseInterface):
 ####################
 
 
-class BrainExtractionInputSpec(BaseInterfaceInputSpec):
+class BrainExtractionInputSpec(CachedHashInputSpec):
     """Class used to represent outputs of the BrainExtraction interface."""
 
-    bids_dir = Directory(desc='Root directory', mandatory=True, exists=True)
+    bids_dir = Directory(desc='Root directory', mandatory=True, exists=True, nohash=True)
+    num_threads = traits.Int(desc='Number of threads used by the tool (inherited from the environment if not set)', nohash=True)
     in_file = File(desc='Input image', mandatory=True)
     in_ckpt_loc = File(desc='Network_checkpoint for localization', mandatory=True)
     threshold_loc = traits.Float(0.49, desc='Threshold determining cutoff probability (0.49 by default)')
@@ -1130,6 +1624,13 @@ class BrainExtraction(BaseInterface):
             print(traceback.format_exc())
         return runtime
 
+    def _get_session_config(self):
+        """Return the configuration of the TensorFlow sessions limiting the number of threads to ``num_threads`` if set."""
+        if not isdefined(self.inputs.num_threads) or self.inputs.num_threads < 1:
+            return None
+        return tf.ConfigProto(intra_op_parallelism_threads=self.inputs.num_threads,
+                              inter_op_parallelism_threads=self.inputs.num_threads)
+
     def _extractBrain(self, dataPath, modelCkptLoc, thresholdLoc, modelCkptSeg, thresholdSeg): #, bidsDir, out_postfix):
         """Generate a brain mask by passing the input image(s) through two networks.
 
@@ -1170,8 +1671,7 @@ class BrainExtraction(BaseInterface):
         border_y = 15
         n_channels = 1
 
-        img_nib = nibabel.load(os.path.join(dataPath))
-        image_data = img_nib.get_data()
+        img_nib, image_data = load_image_data(os.path.join(dataPath))
         images = np.zeros((image_data.shape[2], width, height, n_channels))
         pred3dFinal = np.zeros((image_data.shape[2], image_data.shape[0], image_data.shape[1], n_channels))
 
@@ -1247,7 +1747,7 @@ class BrainExtraction(BaseInterface):
 
         im = np.zeros((1, width, height, n_channels))
         pred3d = []
-        with tf.Session(graph=g) as sess_test_loc:
+        with tf.Session(graph=g, config=self._get_session_config()) as sess_test_loc:
             # Restore the model
             tf_saver = tf.train.Saver()
             tf_saver.restore(sess_test_loc, modelCkptLoc)
@@ -1366,7 +1866,7 @@ class BrainExtraction(BaseInterface):
 
             pred = conv_2d(conv9, 2, 1,  activation='linear', padding='valid')
 
-        with tf.Session(graph=g) as sess_test_seg:
+        with tf.Session(graph=g, config=self._get_session_config()) as sess_test_seg:
             # Restore the model
             tf_saver = tf.train.Saver()
             tf_saver.restore(sess_test_seg, modelCkptSeg)
@@ -1389,11 +1889,9 @@ class BrainExtraction(BaseInterface):
             pred3d = [cv2.resize(elem, dsize=(image_data.shape[1], image_data.shape[0]), interpolation=cv2.INTER_NEAREST) for elem in pred3dFinal]
             pred3d = np.asarray(pred3d)
             upsampled = np.swapaxes(np.swapaxes(pred3d,1,2),0,2) #if Orient module applied, no need for this line(?)
-            up_mask = nibabel.Nifti1Image(upsampled,img_nib.affine)
-            # Save output mask
-
+            # Save output mask (uint8)
             save_file = self._gen_filename('out_file')
-            nibabel.save(up_mask, save_file)
+            save_image_data(upsampled, img_nib, save_file, 'mask')
 
     def _extractLargestCC(self, image):
         """Function returning largest connected component of an object."""
@@ -1584,10 +2082,11 @@ class BrainExtraction(BaseInterface):
         return outputs
 
 
-class MultipleBrainExtractionInputSpec(BaseInterfaceInputSpec):
+class MultipleBrainExtractionInputSpec(CachedHashInputSpec):
     """Class used to represent outputs of the MultipleBrainExtraction interface."""
 
-    bids_dir = Directory(desc='Root directory', mandatory=True, exists=True)
+    bids_dir = Directory(desc='Root directory', mandatory=True, exists=True, nohash=True)
+    num_threads = traits.Int(desc='Number of threads used by the tool (inherited from the environment if not set)', nohash=True)
     input_images = InputMultiPath(File(mandatory=True), desc='MRI Images')
     in_ckpt_loc = File(desc='Network_checkpoint for localization', mandatory=True)
     threshold_loc = traits.Float(0.49, desc='Threshold determining cutoff probability (0.49 by default)')
@@ -1632,7 +2131,8 @@ class MultipleBrainExtraction(BaseInterface):
                                      threshold_loc=self.inputs.threshold_loc,
                                      in_ckpt_seg=self.inputs.in_ckpt_seg,
                                      threshold_seg=self.inputs.threshold_seg,
-                                     out_postfix=self.inputs.out_postfix)
+                                     out_postfix=self.inputs.out_postfix,
+                                     num_threads=self.inputs.num_threads)
                 ax.run()
         return runtime
 
@@ -5,6 +5,10 @@
 """PyMIALSRTK reconstruction functions."""
 
 import os
+import re
+import shutil
+import hashlib
+import datetime
 
 from glob import glob
 import json
@@ -12,22 +16,26 @@ import json
 from traits.api import *
 
 from nipype.utils.filemanip import split_filename
+from nipype.interfaces.base.traits_extension import isdefined
 from nipype.interfaces.base import traits, \
     TraitedSpec, File, InputMultiPath, OutputMultiPath, BaseInterface, BaseInterfaceInputSpec
 
-from pymialsrtk.interfaces.utils import run, reorder_by_run_ids
+from pymialsrtk.interfaces.utils import run, get_threads_env, reorder_by_run_ids, CachedHashInputSpec, \
+    load_image_data, save_image_data, get_scaled_grid, resample_linear, hash_file_cached
 
 
 ########################
 # Image Reconstruction
 ########################
 
-class MialsrtkImageReconstructionInputSpec(BaseInterfaceInputSpec):
+class MialsrtkImageReconstructionInputSpec(CachedHashInputSpec):
     """Class used to represent inputs of the MialsrtkImageReconstruction interface."""
 
     bids_dir = Directory(desc='BIDS root directory',
                          mandatory=True,
-                         exists=True)
+                         exists=True,
+                         nohash=True)
+    num_threads = traits.Int(desc='Number of threads used by the tool (inherited from the environment if not set)', nohash=True)
     in_roi = traits.Enum('mask', "all", "box", "mask",
                          desc="""Define region of interest (required):
                                    - `box`: Use intersections for roi calculation
@@ -55,6 +63,29 @@ class MialsrtkImageReconstructionInputSpec(BaseInterfaceInputSpec):
                                desc='List of stack run-id that specify the order of the stacks')
 
     no_reg = traits.Bool(default=False, desc="Skip slice-to-volume registration.")
+    in_iter = traits.Int(desc='Number of slice-to-volume registration / SDI iterations (default of the tool: 10)')
+    in_epsilon = traits.Float(desc='Minimal percent change between two iterations to stop the registration '
+                                   '(default of the tool: 1e-4)')
+
+    input_reference = File(desc='Reference image, e.g. a previous super-resolution image, against which the slices '
+                                'are registered and on whose grid the SDI is computed (global rigid average of '
+                                'the stacks if not set)')
+
+    transforms_cache_dir = Directory(desc='Directory where the estimated slice transforms are cached by stack. '
+                                          'The cached transforms of the unchanged stacks initialize the '
+                                          'slice-to-volume registration (no warm start if not set)',
+                                     nohash=True)
+    init_transforms = InputMultiPath(File(), desc='Slice transforms initializing the registration of the stacks '
+                                                  'with the same run-id, e.g. the ones of a previous reconstruction '
+                                                  '(used instead of the cached transforms)')
+    raw_images = InputMultiPath(File(), desc='Input images before preprocessing, whose content keys the cached '
+                                             'transforms (``input_images`` if not set)', nohash=True)
+    raw_masks = InputMultiPath(File(), desc='Masks of the input images before preprocessing, whose content keys '
+                                            'the cached transforms (``input_masks`` if not set)', nohash=True)
+    refine_iterations = traits.Int(200,
+                                   desc='Maximal number of optimizer iterations of the slice-by-slice registration '
+                                        'of the stacks initialized with cached transforms (0: keep them)',
+                                   usedefault=True)
 
 
 class MialsrtkImageReconstructionOutputSpec(TraitedSpec):
@@ -67,6 +98,17 @@ class MialsrtkImageReconstructionOutputSpec(TraitedSpec):
 class MialsrtkImageReconstruction(BaseInterface):
     """Creates a high resolution image from a set of low resolution images [1]_.
 
+    If ``transforms_cache_dir`` is set, the slice transforms estimated for each stack are cached,
+    keyed by the content of the stack, of its mask and of the target stack (the first one of
+    ``stacks_order``), which defines the space of the reconstruction. The keys are computed from
+    the stacks and masks before preprocessing (``raw_images`` and ``raw_masks``), as the intensity
+    standardization and histogram normalization of every preprocessed stack depend on all the
+    stacks. When the interface is run again, e.g. with a stack added or removed, the stacks found
+    in the cache are initialized with their transforms and only refined with ``refine_iterations``
+    optimizer iterations per slice, while the other stacks are registered from the global rigid
+    registration. The cache is not used if the target stack changes. The stacks whose run-id
+    matches one of the ``init_transforms`` are initialized with this transform instead.
+
     References
     ------------
     .. [1] Tourbier et al.; NeuroImage, 2015. `(link to paper) <https://doi.org/10.1016/j.neuroimage.2015.06.018>`_
@@ -108,6 +150,19 @@ class MialsrtkImageReconstruction(BaseInterface):
             return os.path.abspath(output)
         return None
 
+    def _get_transform_keys(self, p_images, p_masks):
+        """Return the keys of the transforms of the stacks in the cache, from the content digests of the files."""
+        target = hash_file_cached(p_images[0])
+        keys = []
+        for i, in_image in enumerate(p_images):
+            key = hashlib.sha1()
+            key.update(target.encode())
+            key.update(hash_file_cached(in_image).encode())
+            if self.inputs.in_roi == "mask":
+                key.update(hash_file_cached(p_masks[i]).encode())
+            keys.append(key.hexdigest())
+        return keys
+
     def _run_interface(self, runtime):
         params = []
         params.append(''.join(["--", self.inputs.in_roi]))
@@ -137,16 +192,60 @@ class MialsrtkImageReconstruction(BaseInterface):
         if self.inputs.no_reg:
             params.append("--noreg")
 
+        if isdefined(self.inputs.in_iter):
+            params += ["-n", str(self.inputs.in_iter)]
+
+        if isdefined(self.inputs.in_epsilon):
+            params += ["-e", str(self.inputs.in_epsilon)]
+
+        if isdefined(self.inputs.input_reference):
+            params += ["-r", self.inputs.input_reference]
+
+        # Warm start of the stacks whose transforms are given or cached
+        init_transforms = [None] * len(input_images)
+        if isdefined(self.inputs.init_transforms) and not self.inputs.no_reg:
+            by_run_id = {int(f.split('_run-')[1].split('_')[0]): f for f in self.inputs.init_transforms}
+            init_transforms = [by_run_id.get(int(f.split('_run-')[1].split('_')[0])) for f in input_images]
+
+        cache_keys = None
+        if isdefined(self.inputs.transforms_cache_dir) and not self.inputs.no_reg:
+            os.makedirs(self.inputs.transforms_cache_dir, exist_ok=True)
+            key_images = reorder_by_run_ids(self.inputs.raw_images, self.inputs.stacks_order) \
+                if isdefined(self.inputs.raw_images) else input_images
+            key_masks = reorder_by_run_ids(self.inputs.raw_masks, self.inputs.stacks_order) \
+                if isdefined(self.inputs.raw_masks) else input_masks
+            cache_keys = self._get_transform_keys(key_images, key_masks)
+            for i, key in enumerate(cache_keys):
+                cached = os.path.join(self.inputs.transforms_cache_dir, key + '.txt')
+                if init_transforms[i] is None and os.path.exists(cached):
+                    init_transforms[i] = cached
+
+        if any(f is not None for f in init_transforms):
+            for f in init_transforms:
+                params += ["--init-transform", f if f is not None else "none"]
+            params += ["--refine-iter", str(self.inputs.refine_iterations)]
+            print('Warm start of {} of {} stacks from given or cached transforms'.format(
+                sum(f is not None for f in init_transforms), len(init_transforms)))
+
         cmd = ["mialsrtkImageReconstruction"]
         cmd += params
 
         try:
             print('... cmd: {}'.format(cmd))
             cmd = ' '.join(cmd)
-            run(cmd, env={}, cwd=os.path.abspath(self.inputs.bids_dir))
+            run(cmd, env=get_threads_env(self.inputs.num_threads), cwd=os.path.abspath(self.inputs.bids_dir))
         except Exception as e:
             print('Failed')
             print(e)
+
+        # The transforms are copied in the cache and renamed atomically
+        if cache_keys is not None:
+            for in_image, key in zip(input_images, cache_keys):
+                transf_file = self._gen_filename(in_image, 'output_transforms')
+                if os.path.exists(transf_file):
+                    cached = os.path.join(self.inputs.transforms_cache_dir, key + '.txt')
+                    shutil.copyfile(transf_file, cached + '.tmp')
+                    os.replace(cached + '.tmp', cached)
         return runtime
 
     def _list_outputs(self):
@@ -160,10 +259,11 @@ class MialsrtkImageReconstruction(BaseInterface):
 #  Total Variation Super Resolution
 #####################################
 
-class MialsrtkTVSuperResolutionInputSpec(BaseInterfaceInputSpec):
+class MialsrtkTVSuperResolutionInputSpec(CachedHashInputSpec):
     """Class used to represent inputs of the MialsrtkTVSuperResolution interface."""
 
-    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True)
+    bids_dir = Directory(desc='BIDS root directory', mandatory=True, exists=True, nohash=True)
+    num_threads = traits.Int(desc='Number of threads used by the tool (inherited from the environment if not set)', nohash=True)
     input_images = InputMultiPath(File(mandatory=True),
                                   desc='Input image filenames for super-resolution')
     input_masks = InputMultiPath(File(mandatory=True),
@@ -173,6 +273,9 @@ class MialsrtkTVSuperResolutionInputSpec(BaseInterfaceInputSpec):
     input_sdi = File(desc='Reconstructed image for initialization. '
                           'Typically the output of MialsrtkImageReconstruction is used',
                      mandatory=True)
+    input_init = File(desc='Image initializing the optimization instead of ``input_sdi``, e.g. a previous '
+                           'super-resolution image. It is resampled on the grid of the reconstruction if needed')
+    lineage = traits.Dict(desc='Reconstruction(s) from which this one is derived, saved in the JSON sidecar')
     deblurring = traits.Bool(False,
                              desc='Flag to set deblurring PSF during SR (double the neighborhood)',
                              usedefault=True)
@@ -203,11 +306,42 @@ class MialsrtkTVSuperResolutionInputSpec(BaseInterfaceInputSpec):
                                    desc='Outer loop convergence threshold',
                                    usedefault=True)
 
+    multiresolution_levels = traits.List(traits.Float(),
+                                         desc='Voxel size factors of the coarse levels run before the full-resolution '
+                                              'optimization, from the coarsest to the finest (e.g. [2.0])')
+    multiresolution_loops = traits.List(traits.Int(),
+                                        desc='Number of loops (SR/denoising) of each coarse level')
+    multiresolution_inner_thresh = traits.List(traits.Float(),
+                                               desc='Inner loop convergence threshold of each coarse level '
+                                                    '(``in_inner_thresh`` if not set)')
+    multiresolution_outer_thresh = traits.List(traits.Float(),
+                                               desc='Outer loop convergence threshold of each coarse level '
+                                                    '(``in_outer_thresh`` if not set)')
+
+    hr_voxel_factor = traits.Float(1.0,
+                                   desc='Factor scaling the voxel size of the high-resolution grid of ``input_sdi`` '
+                                        'on which the image is reconstructed (1.0: grid of ``input_sdi``)',
+                                   usedefault=True)
+
+    checkpoint_loops = traits.Int(0,
+                                  desc='Number of loops of each segment of the full-resolution optimization. '
+                                       'A checkpoint is saved after each segment (0: no segmentation)',
+                                  usedefault=True)
+    checkpoint_dir = Directory(desc='Directory where the checkpoint and its state are saved '
+                                    '(working directory of the interface if not set)',
+                               nohash=True)
+    stop_tolerance = traits.Float(0.0,
+                                  desc='Relative change between the outputs of two segments below which '
+                                       'the optimization is stopped (0: run all the loops)',
+                                  usedefault=True)
+
     out_prefix = traits.Str("SRTV_",
                             desc='Prefix added to construct output super-resolution filename',
                             usedefault=True)
     stacks_order = traits.List(mandatory=False,
                                desc='List of stack run-id that specify the order of the stacks')
+    stacks_motion_index = traits.Dict(desc='Motion index of each stack run-id computed by the stacks ordering, '
+                                           'the stacks not in ``stacks_order`` being reported as dropped')
 
     input_rad_dilatation = traits.Float(1.0,
                                         desc='Radius dilatation used in prior step to construct output filename',
@@ -227,11 +361,45 @@ class MialsrtkTVSuperResolutionOutputSpec(TraitedSpec):
     output_sr = File(desc='Output super-resolution image file')
     # output_dict = Dict(desc='Super-resolution reconstruction parameters summarized in a python dictionary')
     output_json_path = File(desc='Output path where `output_dict` should be saved ')
+    output_convergence = File(desc='Output JSON file with the time series of the convergence criteria '
+                                   'and the duration of the loops')
 
 
 class MialsrtkTVSuperResolution(BaseInterface):
     """Apply super-resolution algorithm using one or multiple input images [1]_.
 
+    If ``multiresolution_levels`` is set, the optimization is run coarse-to-fine.
+    For each level, the current initialization is smoothed and resampled on a grid whose
+    voxel size is scaled by the factor of the level, ``multiresolution_loops`` loops are run
+    on this grid, and the result is upsampled by trilinear interpolation on the grid of
+    ``input_sdi`` to initialize the next level. The last level is the full-resolution
+    optimization with ``in_loop`` loops, which can then be reduced.
+
+    If ``input_init`` is set, e.g. to the output of a previous reconstruction when a stack is added,
+    it replaces ``input_sdi`` as initialization of the optimization, whose grid remains the one of
+    ``input_sdi``. A few loops then refine the previous image with all the stacks.
+
+    If ``hr_voxel_factor`` is greater than 1, the image is reconstructed on a coarser grid:
+    ``input_sdi`` is smoothed and resampled on a grid whose voxel size is scaled by this
+    factor, and is used as initialization and reference grid of all the optimizations.
+    The number of unknowns is divided by the cube of the factor.
+
+    If ``checkpoint_loops`` is set, the full-resolution optimization is run in segments
+    of ``checkpoint_loops`` loops, each segment being initialized with the output of the
+    previous one. After each segment, its output is saved as a checkpoint in ``checkpoint_dir``
+    with a JSON state recording the number of loops done. If the interface is run again with
+    the same inputs, e.g. after the job was killed, it resumes from the last checkpoint.
+    The checkpoint and its state are deleted once the optimization is complete.
+    The optimization stops early when the relative change between the outputs of two
+    segments falls below ``stop_tolerance``. Note that the parameters of the primal-dual
+    optimizer are reset at the beginning of each segment.
+
+    The output of ``mialsrtkTVSuperResolution`` is parsed to save, in ``output_convergence``,
+    the inner and outer loop criteria of each Bregman and outer loop with the duration of the
+    loops. The JSON sidecar summarizes them with the number of outer loops and of inner
+    iterations needed to reach a range of convergence thresholds, which helps to choose
+    ``in_loop``, ``in_iter`` and the thresholds of a protocol.
+
     References
     ------------
     .. [1] Tourbier et al.; NeuroImage, 2015. `(link to paper) <https://doi.org/10.1016/j.neuroimage.2015.06.018>`_
@@ -254,6 +422,11 @@ class MialsrtkTVSuperResolution(BaseInterface):
     >>> srtkTVSuperResolution.inputs.in_deltat = 0.01
     >>> srtkTVSuperResolution.inputs.in_lambda = 0.75
     >>> srtkTVSuperResolution.run()  # doctest: +SKIP
+    >>> # Coarse-to-fine optimization: 5 loops at twice the voxel size, then 3 loops at full resolution
+    >>> srtkTVSuperResolution.inputs.multiresolution_levels = [2.0]
+    >>> srtkTVSuperResolution.inputs.multiresolution_loops = [5]
+    >>> srtkTVSuperResolution.inputs.in_loop = 3
+    >>> srtkTVSuperResolution.run()  # doctest: +SKIP
 
     """
 
@@ -279,10 +452,23 @@ class MialsrtkTVSuperResolution(BaseInterface):
 
             return os.path.abspath(output)
 
-        return None
+        elif name == 'output_convergence':
+            output = ''.join([self.inputs.out_prefix, self.inputs.sub_ses, '_',
+                                                      str(len(self.inputs.stacks_order)), 'V_rad',
+                                                      str(int(self.inputs.input_rad_dilatation)), '_convergence.json'])
 
-    def _run_interface(self, runtime):
+            return os.path.abspath(output)
+
+        elif name == 'output_log':
+            output = ''.join([self.inputs.out_prefix, self.inputs.sub_ses, '_',
+                                                      str(len(self.inputs.stacks_order)), 'V_rad',
+                                                      str(int(self.inputs.input_rad_dilatation)), '.log'])
+
+            return os.path.abspath(output)
+
+        return None
 
+    def _get_tv_cmd(self, p_init_image, p_output, p_loops, p_inner_thresh, p_outer_thresh):
         cmd = ['mialsrtkTVSuperResolution']
 
         input_images = reorder_by_run_ids(self.inputs.input_images, self.inputs.stacks_order)
@@ -294,15 +480,13 @@ class MialsrtkTVSuperResolution(BaseInterface):
             cmd += ['-m', in_mask]
             cmd += ['-t', in_transform]
 
-        out_sr = self._gen_filename('output_sr')
-
-        cmd += ['-r', self.inputs.input_sdi]
-        cmd += ['-o', out_sr]
+        cmd += ['-r', p_init_image]
+        cmd += ['-o', p_output]
 
         if self.inputs.deblurring:
             cmd += ['--debluring']
 
-        cmd += ['--loop', str(self.inputs.in_loop)]
+        cmd += ['--loop', str(p_loops)]
         cmd += ['--deltat', str(self.inputs.in_deltat)]
         cmd += ['--lambda', str(self.inputs.in_lambda)]
 
@@ -310,8 +494,236 @@ class MialsrtkTVSuperResolution(BaseInterface):
         cmd += ['--iter', str(self.inputs.in_iter)]
         cmd += ['--step-scale', str(self.inputs.in_step_scale)]
         cmd += ['--gamma', str(self.inputs.in_gamma)]
-        cmd += ['--inner-thresh', str(self.inputs.in_inner_thresh)]
-        cmd += ['--outer-thresh', str(self.inputs.in_outer_thresh)]
+        cmd += ['--inner-thresh', str(p_inner_thresh)]
+        cmd += ['--outer-thresh', str(p_outer_thresh)]
+
+        return ' '.join(cmd)
+
+    def _run_stage(self, p_cmd, p_stage):
+        """Run one optimization of the interface, its output being appended to the log of the stage."""
+        log_file = self._gen_filename('output_log')
+        with open(log_file, 'a') as log:
+            log.write('#stage\t{}\n'.format(p_stage))
+        run(p_cmd, env=get_threads_env(self.inputs.num_threads), cwd=os.path.abspath(self.inputs.bids_dir),
+            log_file=log_file)
+
+    @staticmethod
+    def _parse_convergence_log(p_log_file):
+        """Parse the timed output of the optimizations and return the records of their loops.
+
+        Each stage (coarse level, segment or full-resolution optimization) has one record
+        per outer loop, the loop 0 being the initial optimization run after the initialization
+        of each Bregman loop.
+        """
+        stages = []
+        stage = None
+        loop = None
+        with open(p_log_file, 'r') as log:
+            for raw in log:
+                elapsed, _, line = raw.rstrip('\n').partition('\t')
+                if elapsed == '#stage':
+                    stage = {"Stage": line, "Loops": [], "Duration (s)": 0.0}
+                    stages.append(stage)
+                    loop = None
+                    continue
+                try:
+                    elapsed = float(elapsed)
+                except ValueError:
+                    continue
+                if stage is None:
+                    stage = {"Stage": "full-resolution", "Loops": [], "Duration (s)": 0.0}
+                    stages.append(stage)
+                stage["Duration (s)"] = elapsed
+
+                match = re.match(r'\s*Bregman loop init : (\d+)', line)
+                if match is None:
+                    match = re.match(r'\s*Bregman loop : (\d+) / TV Loop : (\d+)', line)
+                if match is not None:
+                    if loop is not None and "Duration (s)" not in loop:
+                        loop["Duration (s)"] = elapsed - loop["Start (s)"]
+                    loop = {"Bregman loop": int(match.group(1)),
+                            "Loop": int(match.group(2)) if match.lastindex > 1 else 0,
+                            "Start (s)": elapsed,
+                            "Inner criteria": [],
+                            "Inner converged": False}
+                    stage["Loops"].append(loop)
+                    continue
+                if loop is None:
+                    continue
+
+                match = re.match(r'\s*Inner loop criterion \(iter = (\d+)\) : (\S+)', line)
+                if match is not None:
+                    loop["Inner criteria"].append(float(match.group(2)))
+                elif line.strip().startswith('Inner loop has converged'):
+                    loop["Inner converged"] = True
+                else:
+                    match = re.match(r'\s*Outer loop criterion = (\S+)', line)
+                    if match is not None:
+                        loop["Outer criterion"] = float(match.group(1))
+                        loop["Duration (s)"] = elapsed - loop["Start (s)"]
+
+        for stage in stages:
+            if stage["Loops"] and "Duration (s)" not in stage["Loops"][-1]:
+                stage["Loops"][-1]["Duration (s)"] = stage["Duration (s)"] - stage["Loops"][-1]["Start (s)"]
+        return stages
+
+    @staticmethod
+    def _summarize_convergence(p_stages, p_thresholds=(1e-2, 1e-3, 1e-4, 1e-5, 1e-6)):
+        """Summarize the loops of the full-resolution stages parsed by ``_parse_convergence_log``."""
+        loops = [loop for stage in p_stages if not stage["Stage"].startswith('level-') for loop in stage["Loops"]]
+        outer = [loop["Outer criterion"] for loop in loops if "Outer criterion" in loop]
+        durations = [loop["Duration (s)"] for loop in loops if "Outer criterion" in loop]
+
+        outer_loops_to_threshold = dict()
+        inner_iterations_to_threshold = dict()
+        for threshold in sorted(p_thresholds, reverse=True):
+            met = [i + 1 for i, criterion in enumerate(outer) if criterion < threshold]
+            outer_loops_to_threshold[str(threshold)] = met[0] if met else None
+            # Largest number of inner iterations needed by a loop, if all the loops reached the threshold
+            needed = []
+            for loop in loops:
+                met = [i + 1 for i, criterion in enumerate(loop["Inner criteria"]) if criterion < threshold]
+                needed.append(met[0] if met else None)
+            inner_iterations_to_threshold[str(threshold)] = \
+                max(needed) if needed and None not in needed else None
+
+        return {"Outer loops": len(outer),
+                "Inner iterations": sum(len(loop["Inner criteria"]) for loop in loops),
+                "Final outer criterion": outer[-1] if outer else None,
+                "Mean duration of an outer loop (s)": sum(durations) / len(durations) if durations else None,
+                "Duration of the optimization (s)": sum(stage["Duration (s)"] for stage in p_stages),
+                "Outer loops to reach criterion": outer_loops_to_threshold,
+                "Inner iterations to reach criterion": inner_iterations_to_threshold}
+
+    def _get_reference_image(self):
+        """Return the reference image defining the grid of the reconstruction."""
+        if self.inputs.hr_voxel_factor == 1.0:
+            return self.inputs.input_sdi
+
+        _, _, ext = split_filename(self.inputs.input_sdi)
+        reference = os.path.abspath(''.join([self.inputs.out_prefix, self.inputs.sub_ses, '_hr-grid', ext]))
+        sdi_img, sdi = load_image_data(self.inputs.input_sdi)
+        shape, affine = get_scaled_grid(sdi.shape, sdi_img.affine, self.inputs.hr_voxel_factor)
+        save_image_data(resample_linear(sdi, sdi_img.affine, shape, affine, p_smooth=True),
+                        sdi_img, reference, p_kind=None, p_affine=affine)
+        return reference
+
+    def _get_init_image(self, p_reference_image):
+        """Return the image initializing the optimization, on the grid of the reference image."""
+        import numpy as np
+
+        if not isdefined(self.inputs.input_init):
+            return p_reference_image
+
+        ref_img, ref = load_image_data(p_reference_image)
+        init_img, init = load_image_data(self.inputs.input_init)
+        if init.shape == ref.shape and np.allclose(init_img.affine, ref_img.affine, atol=1e-4):
+            return self.inputs.input_init
+
+        _, _, ext = split_filename(self.inputs.input_sdi)
+        init_image = os.path.abspath(''.join([self.inputs.out_prefix, self.inputs.sub_ses, '_init', ext]))
+        save_image_data(resample_linear(init, init_img.affine, ref.shape, ref_img.affine),
+                        ref_img, init_image, p_kind=None)
+        return init_image
+
+    def _run_coarse_level(self, p_level, p_factor, p_init_image, p_reference_image):
+        """Run the optimization on a coarse grid and return the result upsampled on the grid of the reference."""
+        _, _, ext = split_filename(self.inputs.input_sdi)
+        basename = ''.join([self.inputs.out_prefix, self.inputs.sub_ses, '_level-', str(p_level)])
+
+        sdi_img, sdi = load_image_data(p_reference_image)
+        init_img, init = load_image_data(p_init_image)
+
+        # Smoothed and downsampled initialization defining the coarse grid
+        shape, affine = get_scaled_grid(sdi.shape, sdi_img.affine, p_factor)
+        coarse_init = os.path.abspath(basename + '_init' + ext)
+        save_image_data(resample_linear(init, init_img.affine, shape, affine, p_smooth=True),
+                        sdi_img, coarse_init, p_kind=None, p_affine=affine)
+
+        coarse_sr = os.path.abspath(basename + '_sr' + ext)
+        inner_thresh = self.inputs.multiresolution_inner_thresh[p_level] \
+            if len(self.inputs.multiresolution_inner_thresh) > p_level else self.inputs.in_inner_thresh
+        outer_thresh = self.inputs.multiresolution_outer_thresh[p_level] \
+            if len(self.inputs.multiresolution_outer_thresh) > p_level else self.inputs.in_outer_thresh
+        cmd = self._get_tv_cmd(coarse_init, coarse_sr, self.inputs.multiresolution_loops[p_level],
+                               inner_thresh, outer_thresh)
+        self._run_stage(cmd, 'level-{}'.format(p_level))
+
+        # Coarse result upsampled on the grid of the reference
+        sr_img, sr = load_image_data(coarse_sr)
+        upsampled = os.path.abspath(basename + '_upsampled' + ext)
+        save_image_data(resample_linear(sr, sr_img.affine, sdi.shape, sdi_img.affine),
+                        sdi_img, upsampled, p_kind=None)
+        return upsampled
+
+    def _run_checkpointed(self, p_init_image, p_output):
+        """Run the full-resolution optimization in segments saved as checkpoints and return the state."""
+        import numpy as np
+
+        _, _, ext = split_filename(self.inputs.input_sdi)
+        checkpoint_dir = os.path.abspath(self.inputs.checkpoint_dir) if isdefined(self.inputs.checkpoint_dir) \
+            else os.getcwd()
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        basename = ''.join([self.inputs.out_prefix, self.inputs.sub_ses, '_rad',
+                            str(int(self.inputs.input_rad_dilatation))])
+        checkpoint = os.path.join(checkpoint_dir, basename + '_checkpoint' + ext)
+        state_file = os.path.join(checkpoint_dir, basename + '_checkpoint.json')
+
+        # A checkpoint is only resumed if it was computed from the same inputs
+        _, inputs_hash = self.inputs.get_hashval()
+        state = None
+        if os.path.exists(state_file) and os.path.exists(checkpoint):
+            with open(state_file, 'r') as f:
+                state = json.load(f)
+            if state.get("Inputs hash") != inputs_hash:
+                state = None
+
+        if state is not None:
+            print('Resume from checkpoint {} ({} loops done)'.format(checkpoint, state["Loops done"]))
+            init_image = checkpoint
+        else:
+            state = {"Inputs hash": inputs_hash, "Loops done": 0, "Relative changes": [], "Converged": False}
+            init_image = p_init_image
+
+        while state["Loops done"] < self.inputs.in_loop and not state["Converged"]:
+            loops = min(self.inputs.checkpoint_loops, self.inputs.in_loop - state["Loops done"])
+            segment = os.path.join(checkpoint_dir, basename + '_segment' + ext)
+            cmd = self._get_tv_cmd(init_image, segment, loops,
+                                   self.inputs.in_inner_thresh, self.inputs.in_outer_thresh)
+            self._run_stage(cmd, 'segment-{}'.format(len(state["Relative changes"])))
+
+            _, previous = load_image_data(init_image)
+            _, current = load_image_data(segment)
+            previous = np.asarray(previous, dtype=np.float64)
+            norm = np.linalg.norm(previous)
+            change = float(np.linalg.norm(np.asarray(current, dtype=np.float64) - previous) / norm) \
+                if norm > 0 else 0.0
+
+            # The checkpoint is replaced atomically before the state is updated
+            os.replace(segment, checkpoint)
+            state["Loops done"] += loops
+            state["Relative changes"].append(change)
+            state["Converged"] = change < self.inputs.stop_tolerance
+            state["Date"] = datetime.datetime.now().isoformat()
+            with open(state_file, 'w') as f:
+                json.dump(state, f, indent=4)
+            init_image = checkpoint
+
+        shutil.copyfile(checkpoint, p_output)
+        # The reconstruction is complete, the checkpoint is not needed anymore
+        os.remove(checkpoint)
+        os.remove(state_file)
+        return state
+
+    def _run_interface(self, runtime):
+
+        if len(self.inputs.multiresolution_loops) != len(self.inputs.multiresolution_levels):
+            raise ValueError('multiresolution_loops should give the number of loops of each of the {} '
+                             'multiresolution_levels'.format(len(self.inputs.multiresolution_levels)))
+
+        out_sr = self._gen_filename('output_sr')
+        if os.path.exists(self._gen_filename('output_log')):
+            os.remove(self._gen_filename('output_log'))
 
         # JSON file SRTV
         self.m_output_dict["Description"] = "Isotropic high-resolution image reconstructed using the Total-Variation" \
@@ -320,24 +732,61 @@ class MialsrtkTVSuperResolution(BaseInterface):
         self.m_output_dict["CustomMetaData"] = {}
         self.m_output_dict["CustomMetaData"]["Number of scans used"] = str(len(self.inputs.stacks_order))
         self.m_output_dict["CustomMetaData"]["Masks used"] = 'Manual' if self.inputs.use_manual_masks else 'Automatic'
+        if self.inputs.stacks_motion_index:
+            self.m_output_dict["CustomMetaData"]["Motion index of the stacks used"] = \
+                {str(run_id): self.inputs.stacks_motion_index[run_id] for run_id in self.inputs.stacks_order}
+            self.m_output_dict["CustomMetaData"]["Stacks dropped (motion index)"] = \
+                {str(run_id): index for run_id, index in sorted(self.inputs.stacks_motion_index.items())
+                 if run_id not in self.inputs.stacks_order}
         self.m_output_dict["CustomMetaData"]["TV regularization weight lambda"] = self.inputs.in_lambda
         self.m_output_dict["CustomMetaData"]["Optimization time step"] = self.inputs.in_deltat
         self.m_output_dict["CustomMetaData"]["Primal/dual loops"] = self.inputs.in_loop
+        if self.inputs.hr_voxel_factor != 1.0:
+            self.m_output_dict["CustomMetaData"]["High-resolution voxel size factor"] = self.inputs.hr_voxel_factor
+        if self.inputs.lineage:
+            self.m_output_dict["CustomMetaData"]["Lineage"] = self.inputs.lineage
+        if self.inputs.multiresolution_levels:
+            self.m_output_dict["CustomMetaData"]["Multi-resolution voxel size factors"] = \
+                self.inputs.multiresolution_levels
+            self.m_output_dict["CustomMetaData"]["Multi-resolution primal/dual loops"] = \
+                self.inputs.multiresolution_loops
 
+        try:
+            reference_image = self._get_reference_image()
+            init_image = self._get_init_image(reference_image)
+            for level, factor in enumerate(self.inputs.multiresolution_levels):
+                init_image = self._run_coarse_level(level, factor, init_image, reference_image)
+
+            if self.inputs.checkpoint_loops > 0:
+                state = self._run_checkpointed(init_image, out_sr)
+                self.m_output_dict["CustomMetaData"]["Primal/dual loops done"] = state["Loops done"]
+                self.m_output_dict["CustomMetaData"]["Relative change between segments"] = state["Relative changes"]
+            else:
+                cmd = self._get_tv_cmd(init_image, out_sr, self.inputs.in_loop,
+                                       self.inputs.in_inner_thresh, self.inputs.in_outer_thresh)
+                self._run_stage(cmd, 'full-resolution')
 
-        output_json_path = self._gen_filename('output_json_path')
-        with open(output_json_path, 'w') as outfile:
-            json.dump(self.m_output_dict, outfile, indent=4)
-            print('json dumped.')
+        except Exception as e:
+            print('Failed')
+            print(e)
 
+        # Convergence time series and summary
         try:
-            cmd = ' '.join(cmd)
-            run(cmd, env={}, cwd=os.path.abspath(self.inputs.bids_dir))
-
+            stages = self._parse_convergence_log(self._gen_filename('output_log'))
+            with open(self._gen_filename('output_convergence'), 'w') as outfile:
+                json.dump({"Stages": stages}, outfile, indent=4)
+            self.m_output_dict["CustomMetaData"]["Convergence"] = self._summarize_convergence(
+                stages, sorted(set([1e-2, 1e-3, 1e-4, 1e-5, 1e-6,
+                                    self.inputs.in_inner_thresh, self.inputs.in_outer_thresh])))
         except Exception as e:
             print('Failed')
             print(e)
 
+        output_json_path = self._gen_filename('output_json_path')
+        with open(output_json_path, 'w') as outfile:
+            json.dump(self.m_output_dict, outfile, indent=4)
+            print('json dumped.')
+
         return runtime
 
     def _list_outputs(self):
@@ -346,5 +795,6 @@ class MialsrtkTVSuperResolution(BaseInterface):
         outputs['output_sr'] = self._gen_filename('output_sr')
         # outputs['output_dict'] = self.m_output_dict
         outputs['output_json_path'] = self._gen_filename('output_json_path')
+        outputs['output_convergence'] = self._gen_filename('output_convergence')
 
         return outputs
@@ -5,13 +5,63 @@
 """PyMIALSRTK utils functions."""
 
 import os
+import json
+import sys
+import math
+import time
+import hashlib
+import sqlite3
+import datetime
 import subprocess
 
+try:
+    from nipype import config, logging
+    from nipype.interfaces.base import BaseInterfaceInputSpec
+except ImportError:
+    # The docker/singularity wrappers only need run() and are
+    # installed on the host without the Nipype dependency.
+    config = None
+    logging = None
+    BaseInterfaceInputSpec = object
 
-def run(command, env=None, cwd=None):
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows hosts running the wrappers
+    fcntl = None
+
+
+HASH_CACHE_ENV = 'MIALSRTK_HASH_CACHE'
+"""Environment variable giving the path of the persistent file digest cache.
+
+When it is set and Nipype uses ``content`` hashing, the input files
+of the MIALSRTK interfaces are hashed via :func:`hash_file_cached`.
+"""
+
+_digest_memo = {}
+
+CPU_AFFINITY_LEDGER_ENV = 'MIALSRTK_CPU_AFFINITY_LEDGER'
+"""Environment variable giving the path of the ledger of the cores assigned to the running tools.
+
+When it is set, :func:`run` pins each tool to a set of cores not used by the other
+running tools (see :func:`acquire_cores`). A tool started when fewer cores than its
+number of threads are free is pinned to the free ones, and a tool started when no
+core is free runs unpinned; both cases are logged and recorded in the ledger.
+"""
+
+
+def run(command, env=None, cwd=None, log_file=None):
     """Function calls by each MIALSRTK interface.
 
     It runs the command specified as input via ``subprocess.run()``.
+    If ``log_file`` is given, the output of the command is still printed but
+    also appended to the log file, each line being prefixed by the time in seconds
+    elapsed since the start of the command and a tab.
 
     Parameters
     ----------
@@ -24,6 +74,9 @@ def run(command, env=None, cwd=None):
     cwd <Directory>
         Specify a custom current working directory
 
+    log_file <string>
+        Path of the file where the timed output of the command is appended (optional)
+
     Examples
     --------
     >>> cmd = 'btkNLMDenoising -i "/path/to/in_file" -o "/path/to/out_file" -b 0.1'
@@ -31,7 +84,8 @@ def run(command, env=None, cwd=None):
 
     """
 
-    merged_env = os.environ
+    # Copy to not modify the environment of the calling process
+    merged_env = os.environ.copy()
 
     if cwd is None:
         cwd = os.getcwd()
@@ -43,14 +97,374 @@ def run(command, env=None, cwd=None):
     # process = subprocess.run(command, shell=True,
     # 	env=merged_env, cwd=cwd, capture_output=True)
 
+    # Pin the tool to cores not used by the other running tools
+    allocation = None
+    ledger_file = merged_env.get(CPU_AFFINITY_LEDGER_ENV)
+    if ledger_file and fcntl is not None and hasattr(os, 'sched_setaffinity'):
+        try:
+            num_threads = int(merged_env.get('OMP_NUM_THREADS', 1))
+        except ValueError:
+            num_threads = 1
+        allocation = acquire_cores(ledger_file, num_threads, command.split()[0])
+        if allocation is not None and len(allocation[1]) < num_threads and logging is not None:
+            iflogger = logging.getLogger('nipype.interface')
+            if allocation[1]:
+                iflogger.warning('Only {} of the {} requested cores are free, {} is pinned to '
+                                 'cores {}'.format(len(allocation[1]), num_threads, command.split()[0], allocation[1]))
+            else:
+                iflogger.warning('No core is free, {} runs unpinned'.format(command.split()[0]))
+
+    preexec_fn = None
+    if allocation is not None and allocation[1]:
+        cores = allocation[1]
+        preexec_fn = lambda: os.sched_setaffinity(0, cores)
+
     # Python 3.6 (No capture_output)
-    process = subprocess.run(command,
-                             shell=True,
-                             env=merged_env,
-                             cwd=cwd)
+    try:
+        if log_file is None:
+            process = subprocess.run(command,
+                                     shell=True,
+                                     env=merged_env,
+                                     cwd=cwd,
+                                     preexec_fn=preexec_fn)
+        else:
+            start = time.time()
+            with open(log_file, 'a') as log, subprocess.Popen(command,
+                                                              shell=True,
+                                                              env=merged_env,
+                                                              cwd=cwd,
+                                                              preexec_fn=preexec_fn,
+                                                              stdout=subprocess.PIPE,
+                                                              stderr=subprocess.STDOUT,
+                                                              universal_newlines=True) as proc:
+                for line in proc.stdout:
+                    sys.stdout.write(line)
+                    log.write('{:.3f}\t{}'.format(time.time() - start, line))
+                returncode = proc.wait()
+            process = subprocess.CompletedProcess(command, returncode)
+    finally:
+        if allocation is not None:
+            release_cores(ledger_file, allocation[0])
     return process
 
 
+def get_threads_env(p_num_threads):
+    """Function that returns the environment variables limiting the number of threads of a tool.
+
+    It sets the number of threads used by OpenMP and by the ITK filters.
+
+    Parameters
+    ----------
+    p_num_threads <int>
+        Number of threads. If it is not a positive integer (e.g. an undefined
+        ``num_threads`` input), an empty dictionary is returned such that
+        the tool inherits the settings of the calling process.
+
+    Returns
+    -------
+    env <dict>
+        Environment variables to be passed to :func:`run`
+
+    Examples
+    --------
+    >>> from pymialsrtk.interfaces.utils import get_threads_env
+    >>> get_threads_env(4)
+    {'OMP_NUM_THREADS': '4', 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS': '4'}
+
+    """
+    if not isinstance(p_num_threads, int) or p_num_threads < 1:
+        return {}
+    return {'OMP_NUM_THREADS': str(p_num_threads),
+            'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS': str(p_num_threads)}
+
+
+def get_available_cores():
+    """Function that returns the cores available to the calling process.
+
+    The cores are the ones of its CPU affinity (e.g. restricted by a cpuset),
+    limited to the number of cores allowed by its cgroup CPU quota if any.
+
+    Returns
+    -------
+    cores list<int>
+        Indices of the available cores
+
+    Examples
+    --------
+    >>> from pymialsrtk.interfaces.utils import get_available_cores
+    >>> get_available_cores() # doctest: +SKIP
+    [0, 1, 2, 3]
+
+    """
+    try:
+        cores = sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = list(range(os.cpu_count()))
+
+    quota = None
+    try:
+        # cgroup v2
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            values = f.read().split()
+        if values[0] != 'max':
+            quota = int(values[0]) / int(values[1])
+    except (OSError, ValueError, IndexError):
+        try:
+            # cgroup v1
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as f:
+                cfs_quota = int(f.read())
+            with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as f:
+                cfs_period = int(f.read())
+            if cfs_quota > 0:
+                quota = cfs_quota / cfs_period
+        except (OSError, ValueError):
+            pass
+
+    if quota is not None:
+        cores = cores[:max(1, int(math.ceil(quota)))]
+    return cores
+
+
+def _update_ledger(p_ledger_file, p_update):
+    """Apply a function to the content of a ledger file while holding an exclusive lock on it."""
+    with open(p_ledger_file, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            content = f.read()
+            ledger = json.loads(content) if content else None
+            ledger, value = p_update(ledger)
+            f.seek(0)
+            f.truncate()
+            json.dump(ledger, f, indent=4)
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    return value
+
+
+def init_cpu_affinity_ledger(p_ledger_file, p_cores=None):
+    """Function that creates the ledger of the cores assigned to the running tools if it does not exist.
+
+    Parameters
+    ----------
+    p_ledger_file <string>
+        Path of the ledger file
+
+    p_cores list<int>
+        Cores that can be assigned. If None, the cores available to the
+        calling process are used (see :func:`get_available_cores`).
+
+    Examples
+    --------
+    >>> from pymialsrtk.interfaces.utils import init_cpu_affinity_ledger
+    >>> init_cpu_affinity_ledger('/path/to/work_dir/_cpu_affinity.json') # doctest: +SKIP
+
+    """
+    def update(ledger):
+        if ledger is None:
+            ledger = {"cores": list(p_cores) if p_cores is not None else get_available_cores(),
+                      "allocations": {},
+                      "history": []}
+        return ledger, None
+
+    _update_ledger(p_ledger_file, update)
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def acquire_cores(p_ledger_file, p_num_threads, p_label=None):
+    """Function that assigns to the calling process a set of cores not used by the other running tools.
+
+    The assignments of the processes that do not exist anymore are released first.
+    If fewer cores than requested are free, only the free ones are assigned, and if
+    no core is free, no core is assigned and the calling process runs unpinned.
+    The assignment is recorded in the history of the ledger with the working
+    directory of the calling process and the number of requested cores, the
+    unpinned runs being flagged with ``"unpinned": true``.
+
+    Parameters
+    ----------
+    p_ledger_file <string>
+        Path of the ledger file created by :func:`init_cpu_affinity_ledger`
+
+    p_num_threads <int>
+        Number of cores to assign
+
+    p_label <string>
+        Label of the assignment in the history, e.g. the name of the tool (optional)
+
+    Returns
+    -------
+    allocation tuple<string, list<int>>
+        Identifier of the assignment, to be passed to :func:`release_cores`,
+        and assigned cores (empty if no core is free), or None if there is no ledger
+
+    """
+    if not os.path.exists(p_ledger_file):
+        return None
+
+    def update(ledger):
+        if ledger is None:
+            return ledger, None
+        for key, allocation in list(ledger["allocations"].items()):
+            if not _pid_exists(allocation["pid"]):
+                del ledger["allocations"][key]
+
+        used = set(core for allocation in ledger["allocations"].values() for core in allocation["cores"])
+        free = [core for core in ledger["cores"] if core not in used]
+
+        cores = free[:max(1, p_num_threads)]
+        key = str(len(ledger["history"]))
+        if cores:
+            ledger["allocations"][key] = {"pid": os.getpid(), "cores": cores}
+        ledger["history"].append({"label": p_label,
+                                  "directory": os.getcwd(),
+                                  "cores": cores,
+                                  "requested": max(1, p_num_threads),
+                                  "unpinned": not cores,
+                                  "start": datetime.datetime.now().isoformat()})
+        return ledger, (key, cores)
+
+    return _update_ledger(p_ledger_file, update)
+
+
+def release_cores(p_ledger_file, p_key):
+    """Function that releases a set of cores assigned by :func:`acquire_cores`.
+
+    Parameters
+    ----------
+    p_ledger_file <string>
+        Path of the ledger file
+
+    p_key <string>
+        Identifier of the assignment returned by :func:`acquire_cores`
+
+    """
+    def update(ledger):
+        if ledger is not None:
+            ledger["allocations"].pop(p_key, None)
+            ledger["history"][int(p_key)]["end"] = datetime.datetime.now().isoformat()
+        return ledger, None
+
+    _update_ledger(p_ledger_file, update)
+
+
+def get_core_assignments(p_ledger_file, p_directory=None):
+    """Function that returns the history of the cores assigned to the tools.
+
+    Parameters
+    ----------
+    p_ledger_file <string>
+        Path of the ledger file
+
+    p_directory <string>
+        If given, only the assignments of the tools run in this directory
+        or in one of its sub-directories are returned (optional)
+
+    Returns
+    -------
+    history list<dict>
+        Assignments with the label, the working directory, the cores, and the start
+        and end times of the tools
+
+    """
+    if not os.path.exists(p_ledger_file):
+        return []
+
+    def update(ledger):
+        return ledger, (ledger["history"] if ledger is not None else [])
+
+    history = _update_ledger(p_ledger_file, update)
+    if p_directory is not None:
+        prefix = os.path.abspath(p_directory)
+        history = [h for h in history
+                   if h["directory"] == prefix or h["directory"].startswith(prefix + os.sep)]
+    return history
+
+
+def update_status_manifest(p_manifest_file, p_status=None, p_stage=None, p_files=None,
+                           p_metadata=None, p_reset=False):
+    """Function that updates the status manifest of a reconstruction, listing its published outputs.
+
+    The manifest is updated while holding an exclusive lock on the directory of the manifest
+    (no lock file is left next to it), such that the outputs published concurrently are all recorded, and it is replaced atomically, such
+    that a reader polling it never sees a partially written file.
+
+    Parameters
+    ----------
+    p_manifest_file <string>
+        Path of the manifest file
+
+    p_status <string>
+        Status of the reconstruction, e.g. ``"running"``, ``"done"`` or ``"failed"`` (optional)
+
+    p_stage <string>
+        Name of the processing stage whose outputs were published (optional)
+
+    p_files list<string>
+        Paths of the published outputs of the stage, relative to the derivatives of the subject
+
+    p_metadata <dict>
+        Entries added to the manifest (optional)
+
+    p_reset <bool>
+        Weither the outputs published by a previous run are removed from the manifest
+
+    Returns
+    -------
+    manifest <dict>
+        Updated content of the manifest
+
+    Examples
+    --------
+    >>> from pymialsrtk.interfaces.utils import update_status_manifest
+    >>> update_status_manifest('/path/to/logs/sub-01_rec-SR_id-1_status.json',
+                               p_stage='SDI', p_files=['anat/sub-01_rec-SDI_id-1_T2w.nii.gz']) # doctest: +SKIP
+
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(p_manifest_file)), exist_ok=True)
+    now = datetime.datetime.now().isoformat()
+
+    lock = None
+    if fcntl is not None:
+        lock = os.open(os.path.dirname(os.path.abspath(p_manifest_file)), os.O_RDONLY)
+        fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        manifest = None
+        if not p_reset and os.path.exists(p_manifest_file):
+            with open(p_manifest_file, 'r') as f:
+                manifest = json.load(f)
+        if manifest is None:
+            manifest = {"Status": "running", "Published": {}}
+
+        if p_metadata is not None:
+            manifest.update(p_metadata)
+        if p_status is not None:
+            manifest["Status"] = p_status
+        if p_stage is not None:
+            manifest["Published"][p_stage] = {"Files": list(p_files) if p_files is not None else [],
+                                              "Date": now}
+        manifest["Updated"] = now
+
+        tmp_file = '{}.{}.tmp'.format(p_manifest_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(tmp_file, p_manifest_file)
+    finally:
+        if lock is not None:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            os.close(lock)
+    return manifest
+
+
 def sort_ascending(p_files):
     """Function used to sort images at the input of a nipype node.
 
@@ -103,3 +517,628 @@ def reorder_by_run_ids(p_files, p_order):
     #     id_and_files_ordered = id_and_files_ordered + remainings
 
     return [i[1] for i in id_and_files_ordered]
+
+
+SLICE_TRANSFORMS_FORMAT_VERSION = 1
+"""Version of the layout of the NPZ files written by :func:`pack_slice_transforms`."""
+
+
+def read_slice_transforms(p_transform_file):
+    """Function that reads the slice transforms of a stack saved in an ITK text transform file.
+
+    The file holds a single slice-by-slice transform, as written by ``mialsrtkImageReconstruction``,
+    whose fixed parameters are the number of slices followed by the center of rotation of each slice.
+
+    Parameters
+    ----------
+    p_transform_file <string>
+        Path of the ITK text transform file
+
+    Returns
+    -------
+    transform <string>
+        Type of the transform, e.g. ``SliceBySliceTransform_double_3_3``
+
+    parameters <numpy.ndarray>
+        Array of shape (number of slices, parameters per slice) with the parameters of each slice,
+        i.e. the versor and the translation of its rigid transform
+
+    centers <numpy.ndarray>
+        Array of shape (number of slices, 3) with the center of rotation of each slice
+
+    """
+    import numpy as np
+
+    fields = {}
+    with open(p_transform_file, 'r') as f:
+        for line in f:
+            if line.startswith('#') or ':' not in line:
+                continue
+            key, value = line.split(':', 1)
+            if key.strip() in fields:
+                raise ValueError('{} holds more than one transform'.format(p_transform_file))
+            fields[key.strip()] = value.strip()
+
+    parameters = np.array(fields['Parameters'].split(), dtype=np.float64)
+    fixed_parameters = np.array(fields['FixedParameters'].split(), dtype=np.float64)
+    number_of_slices = int(fixed_parameters[0])
+    return (fields['Transform'],
+            parameters.reshape(number_of_slices, -1),
+            fixed_parameters[1:].reshape(number_of_slices, -1))
+
+
+def write_slice_transforms(p_transform_file, p_transform, p_parameters, p_centers):
+    """Function that writes the slice transforms of a stack in an ITK text transform file.
+
+    It is the inverse of :func:`read_slice_transforms`. The values are written with the shortest
+    representation preserving them, such that a file read and written again is unchanged numerically.
+
+    Parameters
+    ----------
+    p_transform_file <string>
+        Path of the ITK text transform file
+
+    p_transform <string>
+        Type of the transform, e.g. ``SliceBySliceTransform_double_3_3``
+
+    p_parameters <numpy.ndarray>
+        Array of shape (number of slices, parameters per slice) with the parameters of each slice
+
+    p_centers <numpy.ndarray>
+        Array of shape (number of slices, 3) with the center of rotation of each slice
+
+    """
+    import numpy as np
+
+    parameters = np.asarray(p_parameters, dtype=np.float64)
+    fixed_parameters = np.concatenate([[parameters.shape[0]], np.asarray(p_centers, dtype=np.float64).ravel()])
+    with open(p_transform_file, 'w') as f:
+        f.write('#Insight Transform File V1.0\n')
+        f.write('#Transform 0\n')
+        f.write('Transform: {}\n'.format(p_transform))
+        f.write('Parameters: {}\n'.format(' '.join(repr(float(v)) for v in parameters.ravel())))
+        f.write('FixedParameters: {}\n'.format(' '.join(repr(float(v)) for v in fixed_parameters)))
+
+
+def pack_slice_transforms(p_transform_files, p_npz_file, p_filenames=None):
+    """Function that packs the slice transforms of the stacks of a subject in a single NPZ file.
+
+    The slices of all the stacks are concatenated in the order of ``p_transform_files`` such
+    that motion analytics can load the parameters of many subjects without parsing text.
+    The arrays of the file are:
+
+    * ``parameters``: (number of slices, parameters per slice) parameters of the slices
+    * ``centers``: (number of slices, 3) centers of rotation of the slices
+    * ``slice_offsets``: (number of stacks + 1) index of the first slice of each stack,
+      the slices of the stack ``i`` being ``slice_offsets[i]:slice_offsets[i + 1]``
+    * ``run_ids``, ``transforms`` and ``filenames``: run-id, transform type and filename of each stack
+    * ``format_version``: version of the layout (:data:`SLICE_TRANSFORMS_FORMAT_VERSION`)
+
+    The text transform files remain the format used by the MIALSRTK tools, and are
+    restored by :func:`unpack_slice_transforms`.
+
+    Parameters
+    ----------
+    p_transform_files <list<string>>
+        Paths of the ITK text transform files of the stacks, containing a 'run-' id tag
+
+    p_npz_file <string>
+        Path of the NPZ file
+
+    p_filenames <list<string>>
+        Filenames of the text transform files restored by :func:`unpack_slice_transforms`
+        (default is None, the filenames of ``p_transform_files``)
+
+    Examples
+    --------
+    >>> transforms = ['sub-01_run-1_T2w_transform_2V.txt', 'sub-01_run-2_T2w_transform_2V.txt']
+    >>> pack_slice_transforms(transforms, 'sub-01_rec-SR_id-1_T2w_from-origin_to-SDI_mode-image_xfm.npz') # doctest: +SKIP
+
+    """
+    import numpy as np
+
+    slices = [read_slice_transforms(f) for f in p_transform_files]
+    offsets = np.cumsum([0] + [len(parameters) for _, parameters, _ in slices])
+    np.savez(p_npz_file,
+             format_version=np.array(SLICE_TRANSFORMS_FORMAT_VERSION),
+             parameters=np.concatenate([parameters for _, parameters, _ in slices]),
+             centers=np.concatenate([centers for _, _, centers in slices]),
+             slice_offsets=offsets.astype(np.int64),
+             run_ids=np.array([int(os.path.basename(f).split('_run-')[1].split('_')[0]) for f in p_transform_files]),
+             transforms=np.array([transform for transform, _, _ in slices]),
+             filenames=np.array(p_filenames if p_filenames is not None
+                                else [os.path.basename(f) for f in p_transform_files]))
+
+
+def load_slice_transforms(p_npz_file):
+    """Function that loads the arrays of an NPZ file written by :func:`pack_slice_transforms`.
+
+    Parameters
+    ----------
+    p_npz_file <string>
+        Path of the NPZ file
+
+    Returns
+    -------
+    transforms <dict<string, numpy.ndarray>>
+        Arrays of the file, by name
+
+    """
+    import numpy as np
+
+    with np.load(p_npz_file, allow_pickle=False) as npz:
+        transforms = {name: npz[name] for name in npz.files}
+    if int(transforms['format_version']) > SLICE_TRANSFORMS_FORMAT_VERSION:
+        raise ValueError('Unsupported version {} of the slice transforms in {}'.format(
+            int(transforms['format_version']), p_npz_file))
+    return transforms
+
+
+def unpack_slice_transforms(p_npz_file, p_output_dir=None):
+    """Function that writes back the ITK text transform files packed by :func:`pack_slice_transforms`.
+
+    Parameters
+    ----------
+    p_npz_file <string>
+        Path of the NPZ file
+
+    p_output_dir <string>
+        Directory where the text transform files are written with their original filenames
+        (default is None, the directory of the NPZ file)
+
+    Returns
+    -------
+    transform_files <list<string>>
+        Paths of the text transform files, in the order of the stacks in the NPZ file
+
+    """
+    transforms = load_slice_transforms(p_npz_file)
+    output_dir = p_output_dir if p_output_dir is not None else os.path.dirname(os.path.abspath(p_npz_file))
+
+    transform_files = []
+    offsets = transforms['slice_offsets']
+    for i, filename in enumerate(transforms['filenames']):
+        transform_file = os.path.join(output_dir, str(filename))
+        write_slice_transforms(transform_file, str(transforms['transforms'][i]),
+                               transforms['parameters'][offsets[i]:offsets[i + 1]],
+                               transforms['centers'][offsets[i]:offsets[i + 1]])
+        transform_files.append(transform_file)
+    return transform_files
+
+
+def _compute_file_digest(p_file, p_chunk_size=8 * 1024 * 1024):
+    """Compute the content digest of a file (xxh3-128 if ``xxhash`` is available, md5 otherwise)."""
+    hasher = xxhash.xxh3_128() if xxhash is not None else hashlib.md5()
+    with open(p_file, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(p_chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def hash_file_cached(p_file, p_cache_file=None):
+    """Function that returns the content digest of a file, using a persistent digest cache.
+
+    The digest of a file is computed only once for a given
+    ``(path, size, modification time)`` and is stored in a SQLite
+    database shared by all processes of a run, so that the input
+    images are not re-read every time Nipype checks a node hash.
+
+    Parameters
+    ----------
+    p_file <string>
+        Path of the file to hash
+
+    p_cache_file <string>
+        Path of the SQLite digest cache (Default: value of the
+        ``MIALSRTK_HASH_CACHE`` environment variable). If ``None``,
+        only the in-process cache is used.
+
+    Examples
+    --------
+    >>> hash_file_cached('sub-01_run-1_T2w.nii.gz', '/work/nipype/sub-01/rec-1/hash_cache.sqlite')
+
+    """
+    if p_cache_file is None:
+        p_cache_file = os.environ.get(HASH_CACHE_ENV)
+
+    path = os.path.realpath(p_file)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+
+    digest = _digest_memo.get(key)
+    if digest is not None:
+        return digest
+
+    conn = None
+    if p_cache_file:
+        try:
+            conn = sqlite3.connect(p_cache_file, timeout=60)
+            conn.execute('CREATE TABLE IF NOT EXISTS digests '
+                         '(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT)')
+            row = conn.execute('SELECT digest FROM digests WHERE path=? AND size=? AND mtime_ns=?',
+                               key).fetchone()
+            if row is not None:
+                digest = row[0]
+        except sqlite3.Error as e:
+            print('Warning: digest cache {} unavailable ({})'.format(p_cache_file, e))
+            conn = None
+
+    if digest is None:
+        digest = _compute_file_digest(path)
+        if conn is not None:
+            try:
+                with conn:
+                    conn.execute('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)',
+                                 key + (digest,))
+            except sqlite3.Error as e:
+                print('Warning: digest of {} not cached ({})'.format(path, e))
+
+    if conn is not None:
+        conn.close()
+
+    _digest_memo[key] = digest
+    return digest
+
+
+class CachedHashInputSpec(BaseInterfaceInputSpec):
+    """Base class of the inputs of the MIALSRTK interfaces.
+
+    With ``content`` hashing, input files are hashed via :func:`hash_file_cached`
+    whenever a digest cache is configured (see ``HASH_CACHE_ENV``).
+    Otherwise, it falls back to the default Nipype behavior.
+    """
+
+    def _get_sorteddict(self, objekt, dictwithhash=False, hash_method=None, hash_files=True):
+        if (hash_files and os.environ.get(HASH_CACHE_ENV)
+                and isinstance(objekt, str) and os.path.isfile(objekt)):
+            if hash_method is None:
+                hash_method = config.get('execution', 'hash_method')
+            if hash_method.lower() == 'content':
+                digest = hash_file_cached(objekt)
+                return (objekt, digest) if dictwithhash else digest
+        return super(CachedHashInputSpec, self)._get_sorteddict(objekt,
+                                                                dictwithhash=dictwithhash,
+                                                                hash_method=hash_method,
+                                                                hash_files=hash_files)
+
+
+def load_image_data(p_image):
+    """Function that loads a NIfTI image and its data preserving the on-disk data type.
+
+    Contrary to ``get_fdata()`` which always returns a float64 array, the data is
+    obtained via ``np.asanyarray(img.dataobj)`` and an uncompressed image is memory-mapped.
+
+    Parameters
+    ----------
+    p_image <string>
+        Path of the image to be loaded
+
+    Returns
+    -------
+    img <nibabel.Nifti1Image>
+        Loaded image
+
+    data <numpy.ndarray>
+        Image data with the data type stored in the file (if no scaling is defined in the header)
+
+    Examples
+    --------
+    >>> img, data = load_image_data('sub-01_run-1_mask.nii.gz')
+
+    """
+    import numpy as np
+    import nibabel
+
+    img = nibabel.load(p_image, mmap=True)
+    return img, np.asanyarray(img.dataobj)
+
+
+def cast_to_storage_dtype(p_data, p_kind='intensity'):
+    """Function that casts image data to the data type used to store intermediate images.
+
+    The storage data types are chosen such that the C++ MIALSRTK tools, which read
+    intensity images with a ``float`` pixel type and masks with an ``unsigned char``
+    pixel type, read exactly the same values as before the cast:
+
+        * intensity images are stored as float32,
+
+        * masks are stored as uint8.
+
+    Parameters
+    ----------
+    p_data <numpy.ndarray>
+        Image data to be cast
+
+    p_kind <string>
+        Kind of image, either ``'intensity'`` or ``'mask'``
+
+    Returns
+    -------
+    data <numpy.ndarray>
+        Image data cast to the storage data type
+
+    Raises
+    ------
+    ValueError
+        If the values of a mask are not integers in [0, 255], or
+        if intensities overflow the float32 range.
+
+    Examples
+    --------
+    >>> mask = cast_to_storage_dtype(prediction > 0.5, 'mask')
+
+    """
+    import numpy as np
+
+    data = np.asanyarray(p_data)
+
+    if p_kind == 'mask':
+        if data.dtype == np.uint8:
+            return data
+        out = data.astype(np.uint8)
+        if not np.array_equal(out, data):
+            raise ValueError('Mask values should be integers in [0, 255] to be stored as uint8')
+        return out
+    elif p_kind == 'intensity':
+        if data.dtype == np.float32:
+            return data
+        out = data.astype(np.float32)
+        if np.count_nonzero(np.isinf(out)) != np.count_nonzero(np.isinf(data)):
+            raise ValueError('Intensities overflow the float32 range')
+        return out
+
+    raise ValueError('Unknown kind of image "{}" (should be "intensity" or "mask")'.format(p_kind))
+
+
+def save_image_data(p_data, p_reference, p_filename, p_kind='intensity', p_affine=None):
+    """Function that saves image data with the data type of the storage policy.
+
+    The data is cast by :func:`cast_to_storage_dtype` and saved with the affine and
+    header of a reference image, without intensity scaling.
+    If ``p_kind`` is ``None``, the data type of the data is kept.
+
+    Parameters
+    ----------
+    p_data <numpy.ndarray>
+        Image data to be saved
+
+    p_reference <nibabel.Nifti1Image>
+        Image from which the affine and header are taken
+
+    p_filename <string>
+        Path of the output image
+
+    p_kind <string>
+        Kind of image, either ``'intensity'``, ``'mask'`` or ``None``
+
+    p_affine <numpy.ndarray>
+        Affine of the output image if different from the one of the reference image
+
+    Returns
+    -------
+    filename <string>
+        Path of the saved image
+
+    Examples
+    --------
+    >>> img, data = load_image_data('sub-01_run-1_T2w.nii.gz')
+    >>> save_image_data(data > 0, img, 'sub-01_run-1_mask.nii.gz', 'mask')
+
+    """
+    import nibabel
+
+    data = cast_to_storage_dtype(p_data, p_kind) if p_kind is not None else p_data
+    affine = p_affine if p_affine is not None else p_reference.affine
+
+    out = nibabel.Nifti1Image(data, affine, p_reference.header)
+    out.set_data_dtype(data.dtype)
+    out.header.set_slope_inter(1, 0)
+    nibabel.save(out, p_filename)
+    return p_filename
+
+
+def check_image_equivalence(p_image, p_reference, p_kind='intensity', p_tolerance=0.0):
+    """Function that checks that two images are read identically by the C++ MIALSRTK tools.
+
+    Both images are read as the tools do, i.e. with their values cast
+    to ``float`` (intensity images) or ``unsigned char`` (masks).
+    It can be used to verify that an image saved by :func:`save_image_data`
+    is equivalent to an image saved with a larger data type (e.g. float64),
+    or, with a tolerance, that an image computed in-process matches the
+    output of the C++ tool it replaces up to the float32 rounding errors.
+
+    Parameters
+    ----------
+    p_image <string>
+        Path of the image to check
+
+    p_reference <string>
+        Path of the reference image
+
+    p_kind <string>
+        Kind of image, either ``'intensity'`` or ``'mask'``
+
+    p_tolerance <float>
+        Maximal absolute difference between the intensities, relative to the
+        maximal absolute intensity of the reference (Default: 0.0, identical values)
+
+    Returns
+    -------
+    equivalent <bool>
+        True if the C++ tools read the same values in both images (up to the tolerance)
+
+    Examples
+    --------
+    >>> check_image_equivalence('sub-01_srMask_uint8.nii.gz', 'sub-01_srMask_int64.nii.gz', 'mask')
+
+    """
+    import numpy as np
+
+    pixel_type = np.uint8 if p_kind == 'mask' else np.float32
+
+    img, data = load_image_data(p_image)
+    ref_img, ref_data = load_image_data(p_reference)
+
+    data = data.astype(pixel_type)
+    ref_data = ref_data.astype(pixel_type)
+    if data.shape != ref_data.shape or not np.allclose(img.affine, ref_img.affine):
+        return False
+    if p_tolerance > 0 and p_kind != 'mask':
+        atol = p_tolerance * float(np.max(np.abs(ref_data))) if ref_data.size else 0.0
+        return np.allclose(data, ref_data, rtol=0, atol=atol)
+    return np.array_equal(data, ref_data)
+
+
+def resample_to_reference_grid(p_data, p_affine, p_ref_shape, p_ref_affine):
+    """Function that resamples image data onto the grid of a reference image by nearest neighbor interpolation.
+
+    It reproduces the resampling of masks performed by the C++ MIALSRTK tools
+    (``itk::ResampleImageFilter`` with an identity transform and
+    ``itk::NearestNeighborInterpolateImageFunction``): continuous indices are
+    rounded half up and voxels falling outside the input image are set to 0.
+    If both grids are identical, the data is returned unchanged.
+
+    Parameters
+    ----------
+    p_data <numpy.ndarray>
+        Image data to be resampled
+
+    p_affine <numpy.ndarray>
+        Voxel-to-world affine of the image
+
+    p_ref_shape <tuple<int>>
+        Shape of the reference grid
+
+    p_ref_affine <numpy.ndarray>
+        Voxel-to-world affine of the reference grid
+
+    Returns
+    -------
+    data <numpy.ndarray>
+        Resampled data with the shape of the reference grid
+
+    Examples
+    --------
+    >>> mask_img, mask = load_image_data('sub-01_run-1_mask.nii.gz')
+    >>> img, data = load_image_data('sub-01_run-1_T2w.nii.gz')
+    >>> mask = resample_to_reference_grid(mask, mask_img.affine, data.shape, img.affine)
+
+    """
+    import numpy as np
+
+    ref_shape = tuple(p_ref_shape[:3])
+    if tuple(p_data.shape[:3]) == ref_shape and np.allclose(p_affine, p_ref_affine):
+        return p_data
+
+    transform = np.linalg.inv(p_affine).dot(p_ref_affine)
+    bounds = np.array(p_data.shape[:3])[:, None]
+
+    out = np.zeros(ref_shape, dtype=p_data.dtype)
+    i, j = np.meshgrid(np.arange(ref_shape[0]), np.arange(ref_shape[1]), indexing='ij')
+    # Processed slice by slice to bound the memory used by the voxel coordinates
+    for k in range(ref_shape[2]):
+        ijk = np.stack([i.ravel(), j.ravel(), np.full(i.size, k)])
+        idx = np.floor(transform[:3, :3].dot(ijk) + transform[:3, 3:4] + 0.5).astype(int)
+        inside = np.all((idx >= 0) & (idx < bounds), axis=0)
+        values = np.zeros(i.size, dtype=p_data.dtype)
+        values[inside] = p_data[idx[0, inside], idx[1, inside], idx[2, inside]]
+        out[..., k] = values.reshape(i.shape)
+    return out
+
+
+def get_scaled_grid(p_shape, p_affine, p_factor):
+    """Function that returns a grid covering the same field of view as an image grid with a scaled voxel size.
+
+    Parameters
+    ----------
+    p_shape <tuple<int>>
+        Shape of the image grid
+
+    p_affine <numpy.ndarray>
+        Voxel-to-world affine of the image grid
+
+    p_factor <float>
+        Factor applied to the voxel size (e.g. 2.0 for a grid twice coarser)
+
+    Returns
+    -------
+    shape <tuple<int>>
+        Shape of the scaled grid
+
+    affine <numpy.ndarray>
+        Voxel-to-world affine of the scaled grid
+
+    Examples
+    --------
+    >>> img, data = load_image_data('sdi.nii.gz')
+    >>> shape, affine = get_scaled_grid(data.shape, img.affine, 2.0)
+
+    """
+    import numpy as np
+
+    shape = tuple(max(1, int(np.ceil(s / float(p_factor)))) for s in p_shape[:3])
+    affine = np.array(p_affine, dtype=float)
+    affine[:3, :3] = affine[:3, :3] * p_factor
+    # Shift the origin such that the first scaled voxel covers the first voxels of the image grid
+    affine[:3, 3] = np.array(p_affine)[:3, :3].dot(np.full(3, (p_factor - 1) / 2.0)) + np.array(p_affine)[:3, 3]
+    return shape, affine
+
+
+def resample_linear(p_data, p_affine, p_ref_shape, p_ref_affine, p_smooth=False):
+    """Function that resamples intensity data onto the grid of a reference image by trilinear interpolation.
+
+    Voxels falling outside the input image are set to 0.
+
+    Parameters
+    ----------
+    p_data <numpy.ndarray>
+        Image data to be resampled
+
+    p_affine <numpy.ndarray>
+        Voxel-to-world affine of the image
+
+    p_ref_shape <tuple<int>>
+        Shape of the reference grid
+
+    p_ref_affine <numpy.ndarray>
+        Voxel-to-world affine of the reference grid
+
+    p_smooth <bool>
+        Weither the data is smoothed before being resampled onto a coarser grid,
+        with a Gaussian kernel of standard deviation ``(factor - 1) / 2`` voxels
+        along each axis to avoid aliasing. (default is False)
+
+    Returns
+    -------
+    data <numpy.ndarray>
+        Resampled float32 data with the shape of the reference grid
+
+    Examples
+    --------
+    >>> img, data = load_image_data('sdi.nii.gz')
+    >>> shape, affine = get_scaled_grid(data.shape, img.affine, 2.0)
+    >>> coarse = resample_linear(data, img.affine, shape, affine, p_smooth=True)
+
+    """
+    import numpy as np
+    from scipy import ndimage
+
+    data = np.asarray(p_data, dtype=np.float32)
+    transform = np.linalg.inv(p_affine).dot(p_ref_affine)
+
+    if p_smooth:
+        factors = np.linalg.norm(transform[:3, :3], axis=1)
+        sigma = [max(0.0, (f - 1) / 2.0) for f in factors]
+        if any(s > 0 for s in sigma):
+            data = ndimage.gaussian_filter(data, sigma)
+
+    ref_shape = tuple(p_ref_shape[:3])
+    out = np.zeros(ref_shape, dtype=np.float32)
+    i, j = np.meshgrid(np.arange(ref_shape[0]), np.arange(ref_shape[1]), indexing='ij')
+    # Processed slice by slice to bound the memory used by the voxel coordinates
+    for k in range(ref_shape[2]):
+        ijk = np.stack([i.ravel(), j.ravel(), np.full(i.size, k)])
+        coords = transform[:3, :3].dot(ijk) + transform[:3, 3:4]
+        values = ndimage.map_coordinates(data, coords, order=1, mode='constant', cval=0.0)
+        out[..., k] = values.reshape(i.shape)
+    return out
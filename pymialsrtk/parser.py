@@ -46,6 +46,8 @@ def get_parser():
     p.add_argument('--openmp_nb_of_cores',
                    help='Specify number of cores used by OpenMP threads '
                         'Especially useful for NLM denoising and slice-to-volume registration. '
+                        'The multithreaded steps (NLM denoising, brain extraction, SDI and SR '
+                        'reconstructions) use this number of threads, the other steps one thread each. '
                         '(Default: 0, meaning it will be determined automatically)',
                    default=0,
                    type=int)
@@ -55,13 +57,157 @@ def get_parser():
                         'the execution of independent processing workflow nodes (i.e. interfaces) '
                         '(Especially useful in the case of slice-by-slice bias field correction and '
                         'intensity standardization steps for example). '
+                        'The steps running in parallel never use more than a total of '
+                        'openmp_nb_of_cores x nipype_nb_of_cores threads. '
                         '(Default: 0, meaning it will be determined automatically)',
                    default=0,
                    type=int)
 
+    p.add_argument('--total_nb_of_cores',
+                   help='Number of cores available to all the subjects processed in parallel, each subject '
+                        'using openmp_nb_of_cores x nipype_nb_of_cores cores. '
+                        '(Default: 0, meaning all the cores of the machine)',
+                   default=0,
+                   type=int)
+
+    p.add_argument('--total_memory_gb',
+                   help='Memory in GB available to all the subjects processed in parallel, each subject '
+                        'using --memory_gb. (Default: 90%% of the system memory)',
+                   type=float)
+
+    p.add_argument('--shard_index',
+                   help='Index (from 0) of the subset of reconstructions processed by this run, '
+                        'when the reconstructions are split over --shard_count independent runs. '
+                        '(Default: 0)',
+                   default=0,
+                   type=int)
+
+    p.add_argument('--shard_count',
+                   help='Number of independent runs (e.g. jobs of an array) over which the '
+                        'reconstructions are split deterministically, balancing the number of '
+                        'voxels of their stacks. Each run writes a manifest of its reconstructions. '
+                        '(Default: 1, meaning no split)',
+                   default=1,
+                   type=int)
+
+    p.add_argument('--memory_gb',
+                   help='Memory in GB available to the Nipype workflow library. Processing steps '
+                        'are started in parallel only if the sum of their estimated memory fits in it. '
+                        '(Default: 90%% of the system memory)',
+                   type=float)
+
+    p.add_argument('--dry_run',
+                   help='Only predict the number of processing steps, their execution time and memory, '
+                        'the total wall time and the critical path for the given number of cores, '
+                        'from the headers of the stacks and the timing of past runs, without running '
+                        'the reconstructions.',
+                   action='store_true')
+
+    p.add_argument('--execution_backend',
+                   help='Execution backend of the workflows: "nipype" runs the processing steps with '
+                        'the Nipype MultiProc plugin, "dask" runs them as tasks of a dask.distributed '
+                        'cluster, with a dashboard showing the progress, "native" runs them without the '
+                        'Nipype execution engine, its result files and reports. (Default: nipype)',
+                   choices=['nipype', 'dask', 'native'],
+                   default='nipype')
+
+    p.add_argument('--dask_scheduler',
+                   help='Address of the scheduler of an existing Dask cluster (e.g. tcp://host:8786) '
+                        'used with --execution_backend dask. Its workers must declare the "threads" '
+                        'and "memory_gb" resources. (Default: a local cluster is started)')
+
+    p.add_argument('--tv_checkpoint_loops',
+                   help='Run the TV super-resolution in segments of this number of loops, each one saved '
+                        'as a checkpoint in the working directory, such that a reconstruction interrupted '
+                        '(e.g. by a wall-time limit) resumes from its last checkpoint when the BIDS App is '
+                        'run again. (Default: 0, no checkpoint)',
+                   default=0,
+                   type=int)
+
+    p.add_argument('--tv_stop_tolerance',
+                   help='With --tv_checkpoint_loops, stop the TV super-resolution when the relative change '
+                        'between two checkpoints falls below this tolerance. (Default: 0.0, all the loops are run)',
+                   default=0.0,
+                   type=float)
+
+    p.add_argument('--svr_warm_start',
+                   help='Cache the slice transforms estimated for each stack in the working directory, and '
+                        'initialize the slice-to-volume registration of the unchanged stacks with them when a '
+                        'subject is reconstructed again (e.g. with a stack added or removed). The cached '
+                        'transforms are only refined, and are not used if the first stack of the order changes.',
+                   action='store_true')
+
+    p.add_argument('--pack_transforms',
+                   help='Save in xfm/ the slice transforms of all the stacks of each reconstruction in a single '
+                        'NPZ file, in addition to the ITK text transform files, for fast loading by motion '
+                        'quality control and analytics.',
+                   action='store_true')
+
+    p.add_argument('--time_budget',
+                   help='Wall-clock time budget in minutes of each reconstruction for the given number of cores. '
+                        'The TV and SVR iterations, the NLM denoising, the SVR and the HR resolution are '
+                        'degraded step by step until the wall time predicted from the headers of the stacks '
+                        'and the timing of past runs fits in the budget. (Default: no budget)',
+                   type=float)
+
+    p.add_argument('--cpu_affinity',
+                   help='Pin each running MIALSRTK tool to a set of cores sized by its number of threads '
+                        'and disjoint from the cores of the other running tools, within the cores allowed '
+                        'to the container (cpuset and CPU quota). The core assignments are saved in the '
+                        'provenance file of each reconstruction.',
+                   action='store_true')
+
     p.add_argument('--masks_derivatives_dir',
                    help='Use manual brain masks found in '
                         '``<output_dir>/<masks_derivatives_dir>/ directory`` directory')
+    p.add_argument('--hash_method',
+                   help='Method used to detect changes in the input files of the workflow nodes: '
+                        '"cached" hashes the content of files only once and stores the digests '
+                        'in a persistent cache (``<work_dir>/nipype/sub-<label>/rec-<id>/hash_cache.sqlite``), '
+                        '"content" and "timestamp" use the Nipype content and timestamp hashing. '
+                        '(Default: cached)',
+                   choices=['cached', 'content', 'timestamp'],
+                   default='cached')
+    p.add_argument('--work_dir',
+                   help='Directory where the Nipype working directories are created, '
+                        'e.g. a local SSD or tmpfs scratch directory. '
+                        '(Default: ``<output_dir>/nipype``)',
+                   default=None,
+                   type=str)
+    p.add_argument('--prune_intermediates',
+                   help='Delete the intermediate outputs of a processing step as soon as '
+                        'all the steps using them have finished.',
+                   action='store_true')
+    p.add_argument('--keep_only_outputs',
+                   help='At the end of a successful run, keep only the final derivatives, '
+                        'the logs and a compact provenance file, and delete the working directory.',
+                   action='store_true')
+    p.add_argument('--uncompressed_intermediates',
+                   help='Write intermediate images uncompressed (.nii) to save the time spent '
+                        'in gzip compression and decompression by each processing step. '
+                        'Final outputs are always compressed (.nii.gz).',
+                   action='store_true')
+    p.add_argument('--image_ops_backend',
+                   help='Implementation of the simple image operations (masking, binarization): '
+                        '"mialsrtk" runs the C++ MIALSRTK tools, "numpy" runs in-process NumPy '
+                        'equivalents that write the same outputs. (Default: mialsrtk)',
+                   choices=['mialsrtk', 'numpy'],
+                   default='mialsrtk')
+    p.add_argument('--fused_intensity_normalization',
+                   help='Run the intensity standardization, histogram normalization and intensity '
+                        'standardization sequence as a single in-process stage that reads and '
+                        'writes the images only once.',
+                   action='store_true')
+    p.add_argument('--crop_to_roi',
+                   help='Crop each stack and its mask to the bounding box of the brain mask, '
+                        'enlarged by --roi_margin, so that all the processing steps run on '
+                        'the cropped stacks.',
+                   action='store_true')
+    p.add_argument('--roi_margin',
+                   help='Margin in mm added around the bounding box of the brain mask when '
+                        'cropping the stacks with --crop_to_roi. (Default: 10.0)',
+                   type=float,
+                   default=10.0)
     p.add_argument('-v', '--version',
                    action='version',
                    version=f'BIDS-App MIALSRTK version {__version__} (Released: {__release_date__})')
@@ -5,12 +5,18 @@
 """Module for the super-resolution reconstruction pipeline."""
 
 import os
+import re
+import copy
+import json
+import time
+import shutil
+from glob import glob
 
 import pkg_resources
 
 from nipype import config, logging
 # from nipype.interfaces.io import BIDSDataGrabber
-from nipype.interfaces.io import DataGrabber, DataSink
+from nipype.interfaces.io import DataGrabber
 from nipype.pipeline import Node, MapNode, Workflow
 from nipype.interfaces.utility import IdentityInterface, Function
 
@@ -20,10 +26,39 @@ import pymialsrtk.interfaces.preprocess as preprocess
 import pymialsrtk.interfaces.reconstruction as reconstruction
 import pymialsrtk.interfaces.postprocess as postprocess
 import pymialsrtk.interfaces.utils as utils
+from pymialsrtk.pipelines.execution import StatusCallbacks, IntermediatesPruner, ProvenanceRecorder, \
+    allocate_threads
+from pymialsrtk.pipelines.resources import get_stacks_geometry, set_memory_estimates, \
+    calibrate_timing_models, plan_workflow
 
 # Get pymialsrtk version
 from pymialsrtk.info import __version__
 
+# Settings successively degraded to fit the time budget, by decreasing impact on the quality.
+# Each step is applied on top of the previous ones: iterations are capped (``"tv_iterations"``,
+# ``"svr_iterations"``), steps are skipped (``"skip_nlm_denoising"``, ``"skip_svr"``), the number of
+# primal/dual loops is scaled (``"tv_loops_factor"``) and the HR voxel size is enlarged (``"hr_voxel_factor"``).
+TIME_BUDGET_LADDER = [
+    ("TV inner iterations reduced to 30", {"tv_iterations": 30}),
+    ("SVR iterations reduced to 5", {"svr_iterations": 5}),
+    ("NLM denoising skipped", {"skip_nlm_denoising": True}),
+    ("TV inner iterations reduced to 20 and primal/dual loops halved", {"tv_iterations": 20, "tv_loops_factor": 0.5}),
+    ("SVR skipped", {"skip_svr": True}),
+    ("HR voxel size enlarged by 1.5", {"hr_voxel_factor": 1.5}),
+    ("HR voxel size enlarged by 2", {"hr_voxel_factor": 2.0}),
+]
+
+# Settings of the preview reconstruction: no NLM denoising, a short SVR (or none if it is skipped)
+# and a short TV super-resolution on an HR grid with a voxel size enlarged by ``"hr_voxel_factor"``.
+PREVIEW_SETTINGS = {"svr_iterations": 2,
+                    "primal_dual_loops": 3,
+                    "tv_iterations": 20,
+                    "hr_voxel_factor": 2.0}
+
+# Number of primal/dual loops of the TV super-resolution refining a previous reconstruction
+# when stacks are added (see ``m_incremental_from``), if not set in ``paramTV``.
+INCREMENTAL_PRIMAL_DUAL_LOOPS = 3
+
 
 class AnatomicalPipeline:
     """Class used to represent the workflow of the Super-Resolution reconstruction pipeline.
@@ -56,6 +91,13 @@ class AnatomicalPipeline:
         Number of primal/dual loops used in the optimization of the total-variation
         super-resolution algorithm.
 
+    multiresolutionTV <dict>
+        Coarse-to-fine schedule of the total-variation super-resolution, run before the
+        ``primal_dual_loops`` at full resolution, with the voxel size factor (``"levels"``),
+        the number of loops (``"loops"``) and optionally the inner and outer convergence
+        thresholds (``"inner_thresh"``, ``"outer_thresh"``) of each coarse level
+        (e.g. ``{"levels": [2.0], "loops": [5]}``). (default is None, no coarse level)
+
     sr_id <string>
         ID of the reconstruction useful to distinguish when multiple reconstructions
         with different order of stacks are run on the same subject
@@ -81,6 +123,127 @@ class AnatomicalPipeline:
     m_skip_stacks_ordering <bool> (optional)
         Weither the automatic stacks ordering should be skipped. (default is False)
 
+    m_max_motion_index <float> (optional)
+        Motion index above which a stack is dropped by the automatic stacks ordering. (default is None, no threshold)
+
+    m_max_stacks <int> (optional)
+        Maximal number of stacks, with the lowest motion index, kept by the automatic stacks ordering. The
+        orientation coverage is preserved if the view plane is given in the filenames. (default is None, no limit)
+
+    m_hash_method <string>
+        Method used by Nipype to hash the input files of each node. It can be
+        ``"cached"`` (content digests stored in a persistent digest cache),
+        ``"content"`` (Nipype content hashing) or ``"timestamp"``
+        (Nipype timestamp hashing). (default is ``"cached"``)
+
+    m_work_dir <string>
+        Directory where the Nipype working directories are created, e.g. a local scratch disk.
+        (default is ``None``, meaning ``<output_dir>/nipype``)
+
+    m_prune_intermediates <bool>
+        Weither the working directory of a node should be deleted as soon as all the nodes
+        using its outputs have finished. (default is False)
+
+    m_keep_only_outputs <bool>
+        Weither only the outputs saved by the datasink, the logs and a compact provenance file
+        should be kept at the end of a successful execution. The working directory, the TV
+        checkpoints and the SVR transforms cache of the subject are deleted. (default is False)
+
+    m_uncompressed_intermediates <bool>
+        Weither intermediate images should be written uncompressed (``.nii``). Only the
+        images saved by the datasink are then gzip-compressed. (default is False)
+
+    m_image_ops_backend <string>
+        Implementation of the simple image operations (masking and binarization):
+        ``"mialsrtk"`` for the C++ MIALSRTK tools and Nipype function nodes, or ``"numpy"``
+        for the in-process NumPy interfaces writing the same outputs. (default is ``"mialsrtk"``)
+
+    m_fused_intensity_normalization <bool>
+        Weither the intensity standardization, histogram normalization and intensity standardization
+        sequence is run as a single in-process stage that reads and writes the images only once.
+        (default is False)
+
+    m_crop_to_roi <bool>
+        Weither each stack and its mask are cropped to the bounding box of the mask, enlarged
+        by ``m_roi_margin``, before the preprocessing. All the following steps then run on the
+        cropped stacks. (default is False)
+
+    m_roi_margin <float>
+        Margin in mm added around the bounding box of the mask when ``m_crop_to_roi`` is True.
+        (default is 10.0)
+
+    m_openmp_number_of_cores <int>
+        Number of threads of the multithreaded steps (NLM denoising, brain extraction, SDI and
+        SR reconstructions). The other steps run with one thread each. If None, the steps inherit
+        the number of threads of the environment (``OMP_NUM_THREADS``). (default is None)
+
+    m_execution_backend <string>
+        Execution backend of the workflow: ``"nipype"`` for the Nipype Linear / MultiProc plugins,
+        ``"dask"`` to run the nodes as tasks of a ``dask.distributed`` cluster
+        (see :class:`~pymialsrtk.pipelines.executors.DaskPlugin`), or ``"native"`` to run the
+        interfaces without the Nipype execution engine, its result files and reports
+        (see :class:`~pymialsrtk.pipelines.executors.NativeExecutor`). (default is ``"nipype"``)
+
+    m_dask_scheduler <string>
+        Address of the scheduler of an existing Dask cluster used when ``m_execution_backend``
+        is ``"dask"``. If None, a local cluster is started for the execution. (default is None)
+
+    m_cpu_affinity <bool>
+        Weither each running MIALSRTK tool is pinned to a set of cores, sized by its number of threads
+        and disjoint from the cores of the other running tools. The core assignments are saved in the
+        provenance file. (default is False)
+
+    m_tv_checkpoint_loops <int>
+        Number of loops of each segment of the TV super-resolution, saved as a checkpoint
+        in the ``tv_checkpoints`` folder of the working directory such that an interrupted
+        reconstruction resumes from its last checkpoint (0: no checkpoint). (default is 0)
+
+    m_tv_stop_tolerance <float>
+        Relative change between two checkpoints below which the TV super-resolution is
+        stopped early (0: all the loops are run). (default is 0.0)
+
+    m_svr_warm_start <bool>
+        Weither the slice transforms estimated for each stack are cached in the ``svr_transforms`` folder
+        of the working directory of the subject, to initialize the slice-to-volume registration of the
+        unchanged stacks when the subject is reconstructed again, e.g. with a stack added or removed.
+        (default is False)
+
+    m_pack_transforms <bool>
+        Weither the slice transforms of all the stacks are also saved in a single NPZ file in ``xfm/``
+        (see :func:`pymialsrtk.interfaces.utils.pack_slice_transforms`). (default is False)
+
+    m_time_budget <float>
+        Wall-clock time budget of the reconstruction in minutes. Before the execution, the
+        settings are degraded following :data:`TIME_BUDGET_LADDER` until the wall time predicted
+        for the given number of cores fits in the budget. (default is None, no budget)
+
+    m_svr_iterations <int>
+        Number of iterations of the slice-to-volume registration. (default is None, default of the tool)
+
+    m_tv_iterations <int>
+        Number of inner iterations of the TV super-resolution. (default is None, i.e. 50)
+
+    m_hr_voxel_factor <float>
+        Factor enlarging the voxel size of the high-resolution grid of the reconstruction. (default is 1.0)
+
+    m_preview <bool>
+        Weither a fast preview reconstruction (see :meth:`create_preview_pipeline`) is run and published
+        in the ``pymialsrtk-<version>-preview`` derivatives before the full reconstruction. (default is False)
+
+    m_preview_only <bool>
+        Weither only the preview reconstruction is run, the full reconstruction being run separately. (default is False)
+
+    m_is_preview <bool>
+        Weither the pipeline is the preview reconstruction of another pipeline. (default is False)
+
+    m_incremental_from <int>
+        ``sr-id`` of a previous reconstruction of the subject updated with new stacks, set by the
+        ``incremental_from`` key of the custom interfaces (see :meth:`_setup_incremental`).
+        (default is None, full reconstruction)
+
+    m_lineage <dict>
+        Previous reconstruction, stacks and added stacks of an incremental reconstruction,
+        saved in the JSON sidecar of the SR image. (default is None)
 
     Examples
     --------
@@ -110,6 +273,7 @@ class AnatomicalPipeline:
     deltatTV = "0.75"
     lambdaTV = "0.001"
     primal_dual_loops = "20"
+    multiresolutionTV = None
     sr_id = 1
     session = None
 
@@ -120,13 +284,49 @@ class AnatomicalPipeline:
     m_skip_nlm_denoising = None
     m_skip_stacks_ordering = None
     m_do_refine_hr_mask = None
+    m_max_motion_index = None
+    m_max_stacks = None
+    m_preview = None
+    m_preview_only = None
+    m_incremental_from = None
 
     m_masks_derivatives_dir = None
     use_manual_masks = False
 
+    m_hash_method = "cached"
+    m_work_dir = None
+    m_prune_intermediates = False
+    m_keep_only_outputs = False
+    m_uncompressed_intermediates = False
+    m_image_ops_backend = "mialsrtk"
+    m_fused_intensity_normalization = False
+    m_crop_to_roi = False
+    m_roi_margin = 10.0
+    m_openmp_number_of_cores = None
+    m_execution_backend = "nipype"
+    m_dask_scheduler = None
+    m_cpu_affinity = False
+    m_tv_checkpoint_loops = 0
+    m_tv_stop_tolerance = 0.0
+    m_svr_warm_start = False
+    m_pack_transforms = False
+    m_time_budget = None
+    m_svr_iterations = None
+    m_tv_iterations = None
+    m_hr_voxel_factor = 1.0
+    m_time_budget_choice = None
+    m_is_preview = False
+    m_lineage = None
+
     def __init__(self, bids_dir, output_dir, subject, p_stacks=None, sr_id=1,
                  session=None, paramTV=None, p_masks_derivatives_dir=None,
-                 p_dict_custom_interfaces = None):
+                 p_dict_custom_interfaces = None, p_hash_method="cached", p_work_dir=None,
+                 p_prune_intermediates=False, p_keep_only_outputs=False,
+                 p_uncompressed_intermediates=False, p_image_ops_backend="mialsrtk",
+                 p_fused_intensity_normalization=False, p_crop_to_roi=False, p_roi_margin=10.0,
+                 p_openmp_number_of_cores=None, p_execution_backend="nipype", p_dask_scheduler=None,
+                 p_cpu_affinity=False, p_tv_checkpoint_loops=0, p_tv_stop_tolerance=0.0,
+                 p_time_budget=None, p_svr_warm_start=False, p_pack_transforms=False):
         """Constructor of AnatomicalPipeline class instance."""
 
         # BIDS processing parameters
@@ -143,12 +343,42 @@ class AnatomicalPipeline:
         self.deltatTV = paramTV["deltatTV"] if "deltatTV" in paramTV.keys() else 0.01
         self.lambdaTV = paramTV["lambdaTV"] if "lambdaTV" in paramTV.keys() else 0.75
         self.primal_dual_loops = paramTV["primal_dual_loops"] if "primal_dual_loops" in paramTV.keys() else 10
+        self.multiresolutionTV = paramTV["multiresolution"] if "multiresolution" in paramTV.keys() else None
 
         # Use manual/custom brain masks
         # If masks directory is not specified use the automated brain extraction method.
         self.m_masks_derivatives_dir = p_masks_derivatives_dir
         self.use_manual_masks = True if self.m_masks_derivatives_dir is not None else False
 
+        if p_hash_method not in ["cached", "content", "timestamp"]:
+            raise ValueError('Invalid hash method "{}" (should be "cached", "content" or "timestamp")'.format(p_hash_method))
+        self.m_hash_method = p_hash_method
+
+        # Working directory and intermediate outputs management
+        self.m_work_dir = p_work_dir
+        self.m_prune_intermediates = p_prune_intermediates
+        self.m_keep_only_outputs = p_keep_only_outputs
+        self.m_uncompressed_intermediates = p_uncompressed_intermediates
+
+        if p_image_ops_backend not in ["mialsrtk", "numpy"]:
+            raise ValueError('Invalid image operations backend "{}" (should be "mialsrtk" or "numpy")'.format(p_image_ops_backend))
+        self.m_image_ops_backend = p_image_ops_backend
+        self.m_fused_intensity_normalization = p_fused_intensity_normalization
+        self.m_crop_to_roi = p_crop_to_roi
+        self.m_roi_margin = p_roi_margin
+        self.m_openmp_number_of_cores = p_openmp_number_of_cores
+
+        if p_execution_backend not in ["nipype", "dask", "native"]:
+            raise ValueError('Invalid execution backend "{}" (should be "nipype", "dask" or "native")'.format(p_execution_backend))
+        self.m_execution_backend = p_execution_backend
+        self.m_dask_scheduler = p_dask_scheduler
+        self.m_cpu_affinity = p_cpu_affinity
+        self.m_tv_checkpoint_loops = p_tv_checkpoint_loops
+        self.m_tv_stop_tolerance = p_tv_stop_tolerance
+        self.m_time_budget = p_time_budget
+        self.m_svr_warm_start = p_svr_warm_start
+        self.m_pack_transforms = p_pack_transforms
+
         # Custom interfaces and default values.
         if p_dict_custom_interfaces is not None:
             self.m_skip_svr = p_dict_custom_interfaces['skip_svr'] if 'skip_svr' in  p_dict_custom_interfaces.keys() else False
@@ -157,11 +387,27 @@ class AnatomicalPipeline:
 
             self.m_skip_stacks_ordering = p_dict_custom_interfaces['skip_stacks_ordering'] if \
                 ((self.m_stacks is not None) and ('skip_stacks_ordering' in p_dict_custom_interfaces.keys())) else False
+
+            self.m_max_motion_index = p_dict_custom_interfaces['max_motion_index'] if 'max_motion_index' in p_dict_custom_interfaces.keys() else None
+            self.m_max_stacks = p_dict_custom_interfaces['max_stacks'] if 'max_stacks' in p_dict_custom_interfaces.keys() else None
+
+            self.m_preview_only = p_dict_custom_interfaces['preview_only'] if 'preview_only' in p_dict_custom_interfaces.keys() else False
+            self.m_preview = (p_dict_custom_interfaces['preview'] if 'preview' in p_dict_custom_interfaces.keys() else False) \
+                or self.m_preview_only
+
+            self.m_incremental_from = p_dict_custom_interfaces['incremental_from'] if 'incremental_from' in p_dict_custom_interfaces.keys() else None
+            if self.m_incremental_from is not None and "primal_dual_loops" not in paramTV.keys():
+                self.primal_dual_loops = INCREMENTAL_PRIMAL_DUAL_LOOPS
         else:
             self.m_skip_svr = False
             self.m_do_refine_hr_mask = False
             self.m_skip_nlm_denoising =  False
             self.m_skip_stacks_ordering = False
+            self.m_max_motion_index = None
+            self.m_max_stacks = None
+            self.m_preview = False
+            self.m_preview_only = False
+            self.m_incremental_from = None
 
     def create_workflow(self):
         """Create the Niype workflow of the super-resolution pipeline.
@@ -175,46 +421,76 @@ class AnatomicalPipeline:
         if self.session is not None:
             sub_ses = ''.join([sub_ses, '_', self.session])
 
+        # Nipype working directories are created in the scratch directory if specified,
+        # while the logs are always kept in the output directory.
+        work_dir = self.m_work_dir if self.m_work_dir is not None else self.output_dir
+
+        # The preview is published in its own derivatives
+        derivatives = '-'.join(["pymialsrtk", __version__] + (["preview"] if self.m_is_preview else []))
+
         if self.session is None:
-            wf_base_dir = os.path.join(self.output_dir,
+            wf_base_dir = os.path.join(work_dir,
                                        "nipype",
                                        self.subject,
                                        "rec-{}".format(self.sr_id))
+            log_dir = os.path.join(self.output_dir,
+                                   "nipype",
+                                   self.subject,
+                                   "rec-{}".format(self.sr_id))
             final_res_dir = os.path.join(self.output_dir,
-                                         '-'.join(["pymialsrtk", __version__]),
+                                         derivatives,
                                          self.subject)
         else:
-            wf_base_dir = os.path.join(self.output_dir,
+            wf_base_dir = os.path.join(work_dir,
                                        "nipype",
                                        self.subject,
                                        self.session,
                                        "rec-{}".format(self.sr_id))
+            log_dir = os.path.join(self.output_dir,
+                                   "nipype",
+                                   self.subject,
+                                   self.session,
+                                   "rec-{}".format(self.sr_id))
             final_res_dir = os.path.join(self.output_dir,
-                                         '-'.join(["pymialsrtk", __version__]),
+                                         derivatives,
                                          self.subject,
                                          self.session)
 
         # #if self.sr_id is not None:
         # wf_base_dir = os.path.join(wf_base_dir, self.sr_id)
 
-        if not os.path.exists(wf_base_dir):
-            os.makedirs(wf_base_dir)
+        previous_sr = None
+        previous_transforms = []
+        if self.m_incremental_from is not None:
+            previous_sr, previous_transforms = self._setup_incremental(sub_ses, final_res_dir)
+
+        for directory in [wf_base_dir, log_dir]:
+            if not os.path.exists(directory):
+                os.makedirs(directory)
         print("Process directory: {}".format(wf_base_dir))
 
         # Workflow name cannot begin with a number (oterhwise ValueError)
-        pipeline_name = "srr_pipeline"
+        pipeline_name = "srr_preview_pipeline" if self.m_is_preview else "srr_pipeline"
 
         self.wf = Workflow(name=pipeline_name,base_dir=wf_base_dir)
         # srr_nipype_dir = os.path.join(self.wf.base_dir, self.wf.name )
 
         # Initialization (Not sure we can control the name of nipype log)
-        if os.path.isfile(os.path.join(wf_base_dir, "pypeline_" + sub_ses + ".log")):
-            os.unlink(os.path.join(wf_base_dir, "pypeline_" + sub_ses + ".log"))
+        if os.path.isfile(os.path.join(log_dir, "pypeline_" + sub_ses + ".log")):
+            os.unlink(os.path.join(log_dir, "pypeline_" + sub_ses + ".log"))
             # open(os.path.join(self.output_dir,"pypeline.log"), 'a').close()
 
-        config.update_config({'logging': {'log_directory': os.path.join(wf_base_dir),
+        # Input files are hashed by content (digests being cached on disk
+        # with the "cached" method, next to the working directory) or by timestamp.
+        if self.m_hash_method == "cached":
+            os.environ[utils.HASH_CACHE_ENV] = os.path.join(wf_base_dir, "hash_cache.sqlite")
+        else:
+            os.environ.pop(utils.HASH_CACHE_ENV, None)
+
+        config.update_config({'logging': {'log_directory': os.path.join(log_dir),
                                           'log_to_file': True},
                               'execution': {
+                                  'hash_method': 'timestamp' if self.m_hash_method == "timestamp" else 'content',
                                   'remove_unnecessary_outputs': False,
                                   'stop_on_first_crash': True,
                                   'stop_on_first_rerun': False,
@@ -296,12 +572,47 @@ class AnatomicalPipeline:
                                                                                         "Unet.ckpt-20000.index")).split('.index')[0]
             brainMask.inputs.threshold_seg = 0.5
 
+        # Input images are decompressed once such that all intermediate images are written uncompressed
+        if self.m_uncompressed_intermediates:
+            t2wsDecompression = Node(interface=preprocess.NiftiConversion(), name='t2ws_decompression')
+            t2wsDecompression.inputs.out_ext = '.nii'
+            self.wf.connect(dg, "T2ws", t2wsDecompression, "input_images")
+            t2ws_source = (t2wsDecompression, "output_images")
+
+            if self.use_manual_masks:
+                masksDecompression = Node(interface=preprocess.NiftiConversion(), name='masks_decompression')
+                masksDecompression.inputs.out_ext = '.nii'
+                self.wf.connect(dg, "masks", masksDecompression, "input_images")
+                masks_source = (masksDecompression, "output_images")
+        else:
+            t2ws_source = (dg, "T2ws")
+            if self.use_manual_masks:
+                masks_source = (dg, "masks")
+
         t2ws_filtered = Node(interface=preprocess.FilteringByRunid(), name='t2ws_filtered')
         masks_filtered = Node(interface=preprocess.FilteringByRunid(), name='masks_filtered')
 
+        if self.m_crop_to_roi:
+            # Stacks and masks are cropped to the same box and keep their filenames
+            t2wsCrop = MapNode(interface=preprocess.CropImageUsingMask(),
+                               name='t2ws_crop',
+                               iterfield=['in_file', 'in_mask'])
+            t2wsCrop.inputs.margin = self.m_roi_margin
+            t2wsCrop.inputs.out_postfix = ''
+
+            masksCrop = MapNode(interface=preprocess.CropImageUsingMask(),
+                                name='masks_crop',
+                                iterfield=['in_file', 'in_mask'])
+            masksCrop.inputs.margin = self.m_roi_margin
+            masksCrop.inputs.out_postfix = ''
+
 
         if not self.m_skip_stacks_ordering:
             stacksOrdering = Node(interface=preprocess.StacksOrdering(), name='stackOrdering')
+            if self.m_max_motion_index is not None:
+                stacksOrdering.inputs.max_motion_index = self.m_max_motion_index
+            if self.m_max_stacks is not None:
+                stacksOrdering.inputs.max_stacks = self.m_max_stacks
         else:
             stacksOrdering = Node(interface=IdentityInterface(fields=['stacks_order']), name='stackOrdering')
             stacksOrdering.inputs.stacks_order = self.m_stacks
@@ -343,14 +654,18 @@ class AnatomicalPipeline:
                                                       iterfield=['in_file','in_mask'])
             srtkCorrectSliceIntensity02_nlm.inputs.bids_dir = self.bids_dir
 
-            srtkIntensityStandardization01_nlm = Node(interface=preprocess.MialsrtkIntensityStandardization(), name='srtkIntensityStandardization01_nlm')
-            srtkIntensityStandardization01_nlm.inputs.bids_dir = self.bids_dir
+            if self.m_fused_intensity_normalization:
+                # Single stage replacing the last three nodes of the sequence
+                srtkIntensityStandardization02_nlm = Node(interface=preprocess.IntensityNormalization(), name='srtkIntensityNormalization_nlm')
+            else:
+                srtkIntensityStandardization01_nlm = Node(interface=preprocess.MialsrtkIntensityStandardization(), name='srtkIntensityStandardization01_nlm')
+                srtkIntensityStandardization01_nlm.inputs.bids_dir = self.bids_dir
 
-            srtkHistogramNormalization_nlm = Node(interface=preprocess.MialsrtkHistogramNormalization(), name='srtkHistogramNormalization_nlm')
-            srtkHistogramNormalization_nlm.inputs.bids_dir = self.bids_dir
+                srtkHistogramNormalization_nlm = Node(interface=preprocess.MialsrtkHistogramNormalization(), name='srtkHistogramNormalization_nlm')
+                srtkHistogramNormalization_nlm.inputs.bids_dir = self.bids_dir
 
-            srtkIntensityStandardization02_nlm = Node(interface=preprocess.MialsrtkIntensityStandardization(), name='srtkIntensityStandardization02_nlm')
-            srtkIntensityStandardization02_nlm.inputs.bids_dir = self.bids_dir
+                srtkIntensityStandardization02_nlm = Node(interface=preprocess.MialsrtkIntensityStandardization(), name='srtkIntensityStandardization02_nlm')
+                srtkIntensityStandardization02_nlm.inputs.bids_dir = self.bids_dir
 
 
     # 4-modules sequence to be defined as a stage.
@@ -359,25 +674,45 @@ class AnatomicalPipeline:
                                           iterfield=['in_file', 'in_mask'])
         srtkCorrectSliceIntensity02.inputs.bids_dir = self.bids_dir
 
-        srtkIntensityStandardization01 = Node(interface=preprocess.MialsrtkIntensityStandardization(), name='srtkIntensityStandardization01')
-        srtkIntensityStandardization01.inputs.bids_dir = self.bids_dir
+        if self.m_fused_intensity_normalization:
+            # Single stage replacing the last three nodes of the sequence
+            srtkIntensityStandardization02 = Node(interface=preprocess.IntensityNormalization(), name='srtkIntensityNormalization')
+        else:
+            srtkIntensityStandardization01 = Node(interface=preprocess.MialsrtkIntensityStandardization(), name='srtkIntensityStandardization01')
+            srtkIntensityStandardization01.inputs.bids_dir = self.bids_dir
 
-        srtkHistogramNormalization = Node(interface=preprocess.MialsrtkHistogramNormalization(), name='srtkHistogramNormalization')
-        srtkHistogramNormalization.inputs.bids_dir = self.bids_dir
+            srtkHistogramNormalization = Node(interface=preprocess.MialsrtkHistogramNormalization(), name='srtkHistogramNormalization')
+            srtkHistogramNormalization.inputs.bids_dir = self.bids_dir
 
-        srtkIntensityStandardization02 = Node(interface=preprocess.MialsrtkIntensityStandardization(), name='srtkIntensityStandardization02')
-        srtkIntensityStandardization02.inputs.bids_dir = self.bids_dir
+            srtkIntensityStandardization02 = Node(interface=preprocess.MialsrtkIntensityStandardization(), name='srtkIntensityStandardization02')
+            srtkIntensityStandardization02.inputs.bids_dir = self.bids_dir
 
 
-        srtkMaskImage01 = MapNode(interface=preprocess.MialsrtkMaskImage(),
-                                  name='srtkMaskImage01',
-                                  iterfield=['in_file', 'in_mask'])
-        srtkMaskImage01.inputs.bids_dir = self.bids_dir
+        if self.m_image_ops_backend == "numpy":
+            srtkMaskImage01 = MapNode(interface=preprocess.MaskImage(),
+                                      name='srtkMaskImage01',
+                                      iterfield=['in_file', 'in_mask'])
+        else:
+            srtkMaskImage01 = MapNode(interface=preprocess.MialsrtkMaskImage(),
+                                      name='srtkMaskImage01',
+                                      iterfield=['in_file', 'in_mask'])
+            srtkMaskImage01.inputs.bids_dir = self.bids_dir
 
         srtkImageReconstruction = Node(interface=reconstruction.MialsrtkImageReconstruction(), name='srtkImageReconstruction')
         srtkImageReconstruction.inputs.bids_dir = self.bids_dir
         srtkImageReconstruction.inputs.sub_ses = sub_ses
         srtkImageReconstruction.inputs.no_reg = self.m_skip_svr
+        if self.m_svr_iterations is not None:
+            srtkImageReconstruction.inputs.in_iter = self.m_svr_iterations
+        if self.m_svr_warm_start:
+            # Shared by the reconstructions of the subject (and session)
+            srtkImageReconstruction.inputs.transforms_cache_dir = os.path.join(os.path.dirname(self.wf.base_dir),
+                                                                               'svr_transforms')
+        if previous_sr is not None:
+            # The slices are registered against the previous SR image, on whose grid the SDI is computed
+            srtkImageReconstruction.inputs.input_reference = previous_sr
+        if previous_transforms:
+            srtkImageReconstruction.inputs.init_transforms = previous_transforms
 
         srtkTVSuperResolution = Node(interface=reconstruction.MialsrtkTVSuperResolution(), name='srtkTVSuperResolution')
         srtkTVSuperResolution.inputs.bids_dir = self.bids_dir
@@ -386,6 +721,24 @@ class AnatomicalPipeline:
         srtkTVSuperResolution.inputs.in_deltat = self.deltatTV
         srtkTVSuperResolution.inputs.in_lambda = self.lambdaTV
         srtkTVSuperResolution.inputs.use_manual_masks = self.use_manual_masks
+        srtkTVSuperResolution.inputs.hr_voxel_factor = self.m_hr_voxel_factor
+        if self.m_tv_iterations is not None:
+            srtkTVSuperResolution.inputs.in_iter = self.m_tv_iterations
+        if previous_sr is not None:
+            srtkTVSuperResolution.inputs.input_init = previous_sr
+            srtkTVSuperResolution.inputs.lineage = self.m_lineage
+        if self.multiresolutionTV is not None:
+            srtkTVSuperResolution.inputs.multiresolution_levels = self.multiresolutionTV["levels"]
+            srtkTVSuperResolution.inputs.multiresolution_loops = self.multiresolutionTV["loops"]
+            if "inner_thresh" in self.multiresolutionTV.keys():
+                srtkTVSuperResolution.inputs.multiresolution_inner_thresh = self.multiresolutionTV["inner_thresh"]
+            if "outer_thresh" in self.multiresolutionTV.keys():
+                srtkTVSuperResolution.inputs.multiresolution_outer_thresh = self.multiresolutionTV["outer_thresh"]
+        if self.m_tv_checkpoint_loops > 0:
+            # Outside of the node directory, which is emptied when the node is rerun
+            srtkTVSuperResolution.inputs.checkpoint_loops = self.m_tv_checkpoint_loops
+            srtkTVSuperResolution.inputs.checkpoint_dir = os.path.join(self.wf.base_dir, 'tv_checkpoints')
+            srtkTVSuperResolution.inputs.stop_tolerance = self.m_tv_stop_tolerance
 
         srtkN4BiasFieldCorrection = Node(interface=postprocess.MialsrtkN4BiasFieldCorrection(), name='srtkN4BiasFieldCorrection')
         srtkN4BiasFieldCorrection.inputs.bids_dir = self.bids_dir
@@ -393,102 +746,138 @@ class AnatomicalPipeline:
         if self.m_do_refine_hr_mask:
             srtkHRMask = Node(interface=postprocess.MialsrtkRefineHRMaskByIntersection(), name='srtkHRMask')
             srtkHRMask.inputs.bids_dir = self.bids_dir
+        elif self.m_image_ops_backend == "numpy":
+            srtkHRMask = Node(interface=postprocess.BinarizeImage(), name='srtkHRMask')
         else:
             srtkHRMask = Node(interface=Function(input_names=["input_image"], output_names=["output_srmask"],
                                     function=postprocess.binarize_image), name='srtkHRMask')
 
-        srtkMaskImage02 = Node(interface=preprocess.MialsrtkMaskImage(), name='srtkMaskImage02')
-        srtkMaskImage02.inputs.bids_dir = self.bids_dir
+        if self.m_image_ops_backend == "numpy":
+            srtkMaskImage02 = Node(interface=preprocess.MaskImage(), name='srtkMaskImage02')
+        else:
+            srtkMaskImage02 = Node(interface=preprocess.MialsrtkMaskImage(), name='srtkMaskImage02')
+            srtkMaskImage02.inputs.bids_dir = self.bids_dir
 
         finalFilenamesGeneration = Node(postprocess.FilenamesGeneration(), name='filenames_gen')
         finalFilenamesGeneration.inputs.sub_ses = sub_ses
         finalFilenamesGeneration.inputs.sr_id = self.sr_id
         finalFilenamesGeneration.inputs.use_manual_masks = self.use_manual_masks
 
-        datasink = Node(DataSink(), name='data_sinker')
-        datasink.inputs.base_directory = final_res_dir
+        # One datasink per stage, such that each output is published as soon as it is
+        # available, and recorded in the status manifest of the reconstruction
+        manifest_file = os.path.join(final_res_dir, 'logs', sub_ses + '_rec-SR_id-' + str(self.sr_id) + '_status.json')
+        datasinks = {}
+        for stage in ['masks', 'preproc', 'transforms', 'SDI', 'SR']:
+            datasinks[stage] = Node(postprocess.AtomicDataSink(), name='data_sinker_' + stage)
+            datasinks[stage].inputs.base_directory = final_res_dir
+            datasinks[stage].inputs.stage = stage
+            datasinks[stage].inputs.manifest_file = manifest_file
 
 
         # - Build workflow : connections of the nodes
 
         # Nodes ready - Linking now
         if self.use_manual_masks:
-            self.wf.connect(dg, "masks", brainMask, "out_file")
+            self.wf.connect(masks_source[0], masks_source[1], brainMask, "out_file")
         else:
             if self.m_stacks is not None:
-                self.wf.connect(dg, "T2ws", t2ws_filter_prior_masks, "input_files")
+                self.wf.connect(t2ws_source[0], t2ws_source[1], t2ws_filter_prior_masks, "input_files")
                 self.wf.connect(t2ws_filter_prior_masks, "output_files", brainMask, "in_file")
             else:
-                self.wf.connect(dg, "T2ws", brainMask, "in_file")
+                self.wf.connect(t2ws_source[0], t2ws_source[1], brainMask, "in_file")
 
         if not self.m_skip_stacks_ordering:
             self.wf.connect(brainMask, "out_file", stacksOrdering, "input_masks")
 
         self.wf.connect(stacksOrdering, "stacks_order", t2ws_filtered, "stacks_id")
-        self.wf.connect(dg, "T2ws", t2ws_filtered, "input_files")
+        self.wf.connect(t2ws_source[0], t2ws_source[1], t2ws_filtered, "input_files")
 
         self.wf.connect(stacksOrdering, "stacks_order", masks_filtered, "stacks_id")
         self.wf.connect(brainMask, "out_file", masks_filtered, "input_files")
-        self.wf.connect(t2ws_filtered, ("output_files", utils.sort_ascending), nlmDenoise, "in_file")
-        self.wf.connect(masks_filtered, ("output_files", utils.sort_ascending), nlmDenoise, "in_mask")  ## Comment to match docker process
+
+        if self.m_crop_to_roi:
+            self.wf.connect(t2ws_filtered, ("output_files", utils.sort_ascending), t2wsCrop, "in_file")
+            self.wf.connect(masks_filtered, ("output_files", utils.sort_ascending), t2wsCrop, "in_mask")
+            self.wf.connect(masks_filtered, ("output_files", utils.sort_ascending), masksCrop, "in_file")
+            self.wf.connect(masks_filtered, ("output_files", utils.sort_ascending), masksCrop, "in_mask")
+            t2ws_roi = (t2wsCrop, "out_file")
+            masks_roi = (masksCrop, "out_file")
+        else:
+            t2ws_roi = (t2ws_filtered, "output_files")
+            masks_roi = (masks_filtered, "output_files")
 
         if not self.m_skip_nlm_denoising:
+            self.wf.connect(t2ws_roi[0], (t2ws_roi[1], utils.sort_ascending), nlmDenoise, "in_file")
+            self.wf.connect(masks_roi[0], (masks_roi[1], utils.sort_ascending), nlmDenoise, "in_mask")  ## Comment to match docker process
+
             self.wf.connect(nlmDenoise, ("out_file", utils.sort_ascending), srtkCorrectSliceIntensity01_nlm, "in_file")
-            self.wf.connect(masks_filtered, ("output_files", utils.sort_ascending), srtkCorrectSliceIntensity01_nlm, "in_mask")
+            self.wf.connect(masks_roi[0], (masks_roi[1], utils.sort_ascending), srtkCorrectSliceIntensity01_nlm, "in_mask")
 
-            self.wf.connect(t2ws_filtered, ("output_files", utils.sort_ascending), srtkCorrectSliceIntensity01, "in_file")
-            self.wf.connect(masks_filtered, ("output_files", utils.sort_ascending), srtkCorrectSliceIntensity01, "in_mask")
+        self.wf.connect(t2ws_roi[0], (t2ws_roi[1], utils.sort_ascending), srtkCorrectSliceIntensity01, "in_file")
+        self.wf.connect(masks_roi[0], (masks_roi[1], utils.sort_ascending), srtkCorrectSliceIntensity01, "in_mask")
 
         if not self.m_skip_nlm_denoising:
             self.wf.connect(srtkCorrectSliceIntensity01_nlm, ("out_file", utils.sort_ascending), srtkSliceBySliceN4BiasFieldCorrection, "in_file")
         else:
             self.wf.connect(srtkCorrectSliceIntensity01, ("out_file", utils.sort_ascending),srtkSliceBySliceN4BiasFieldCorrection, "in_file")
-        self.wf.connect(masks_filtered, ("output_files", utils.sort_ascending), srtkSliceBySliceN4BiasFieldCorrection, "in_mask")
+        self.wf.connect(masks_roi[0], (masks_roi[1], utils.sort_ascending), srtkSliceBySliceN4BiasFieldCorrection, "in_mask")
 
         self.wf.connect(srtkCorrectSliceIntensity01, ("out_file", utils.sort_ascending), srtkSliceBySliceCorrectBiasField, "in_file")
         self.wf.connect(srtkSliceBySliceN4BiasFieldCorrection, ("out_fld_file", utils.sort_ascending), srtkSliceBySliceCorrectBiasField, "in_field")
-        self.wf.connect(masks_filtered, ("output_files", utils.sort_ascending), srtkSliceBySliceCorrectBiasField, "in_mask")
+        self.wf.connect(masks_roi[0], (masks_roi[1], utils.sort_ascending), srtkSliceBySliceCorrectBiasField, "in_mask")
 
         if not self.m_skip_nlm_denoising:
             self.wf.connect(srtkSliceBySliceN4BiasFieldCorrection, ("out_im_file", utils.sort_ascending), srtkCorrectSliceIntensity02_nlm, "in_file")
-            self.wf.connect(masks_filtered, ("output_files", utils.sort_ascending), srtkCorrectSliceIntensity02_nlm, "in_mask")
-            self.wf.connect(srtkCorrectSliceIntensity02_nlm, ("out_file", utils.sort_ascending), srtkIntensityStandardization01_nlm, "input_images")
-            self.wf.connect(srtkIntensityStandardization01_nlm, ("output_images", utils.sort_ascending), srtkHistogramNormalization_nlm, "input_images")
-            self.wf.connect(masks_filtered, ("output_files", utils.sort_ascending), srtkHistogramNormalization_nlm, "input_masks")
-            self.wf.connect(srtkHistogramNormalization_nlm, ("output_images", utils.sort_ascending), srtkIntensityStandardization02_nlm, "input_images")
+            self.wf.connect(masks_roi[0], (masks_roi[1], utils.sort_ascending), srtkCorrectSliceIntensity02_nlm, "in_mask")
+            if self.m_fused_intensity_normalization:
+                self.wf.connect(srtkCorrectSliceIntensity02_nlm, ("out_file", utils.sort_ascending), srtkIntensityStandardization02_nlm, "input_images")
+                self.wf.connect(masks_roi[0], (masks_roi[1], utils.sort_ascending), srtkIntensityStandardization02_nlm, "input_masks")
+            else:
+                self.wf.connect(srtkCorrectSliceIntensity02_nlm, ("out_file", utils.sort_ascending), srtkIntensityStandardization01_nlm, "input_images")
+                self.wf.connect(srtkIntensityStandardization01_nlm, ("output_images", utils.sort_ascending), srtkHistogramNormalization_nlm, "input_images")
+                self.wf.connect(masks_roi[0], (masks_roi[1], utils.sort_ascending), srtkHistogramNormalization_nlm, "input_masks")
+                self.wf.connect(srtkHistogramNormalization_nlm, ("output_images", utils.sort_ascending), srtkIntensityStandardization02_nlm, "input_images")
 
         self.wf.connect(srtkSliceBySliceCorrectBiasField, ("out_im_file", utils.sort_ascending), srtkCorrectSliceIntensity02, "in_file")
-        self.wf.connect(masks_filtered, ("output_files", utils.sort_ascending), srtkCorrectSliceIntensity02, "in_mask")
-        self.wf.connect(srtkCorrectSliceIntensity02, ("out_file", utils.sort_ascending), srtkIntensityStandardization01, "input_images")
-
-
-        self.wf.connect(srtkIntensityStandardization01, ("output_images", utils.sort_ascending), srtkHistogramNormalization, "input_images")
-        self.wf.connect(masks_filtered, ("output_files", utils.sort_ascending), srtkHistogramNormalization, "input_masks")
-        self.wf.connect(srtkHistogramNormalization, ("output_images", utils.sort_ascending), srtkIntensityStandardization02, "input_images")
+        self.wf.connect(masks_roi[0], (masks_roi[1], utils.sort_ascending), srtkCorrectSliceIntensity02, "in_mask")
+        if self.m_fused_intensity_normalization:
+            self.wf.connect(srtkCorrectSliceIntensity02, ("out_file", utils.sort_ascending), srtkIntensityStandardization02, "input_images")
+            self.wf.connect(masks_roi[0], (masks_roi[1], utils.sort_ascending), srtkIntensityStandardization02, "input_masks")
+        else:
+            self.wf.connect(srtkCorrectSliceIntensity02, ("out_file", utils.sort_ascending), srtkIntensityStandardization01, "input_images")
+            self.wf.connect(srtkIntensityStandardization01, ("output_images", utils.sort_ascending), srtkHistogramNormalization, "input_images")
+            self.wf.connect(masks_roi[0], (masks_roi[1], utils.sort_ascending), srtkHistogramNormalization, "input_masks")
+            self.wf.connect(srtkHistogramNormalization, ("output_images", utils.sort_ascending), srtkIntensityStandardization02, "input_images")
 
 
         if not self.m_skip_nlm_denoising:
             self.wf.connect(srtkIntensityStandardization02_nlm, ("output_images", utils.sort_ascending), srtkMaskImage01, "in_file")
-            self.wf.connect(masks_filtered, ("output_files", utils.sort_ascending), srtkMaskImage01, "in_mask")
+            self.wf.connect(masks_roi[0], (masks_roi[1], utils.sort_ascending), srtkMaskImage01, "in_mask")
         else:
             self.wf.connect(srtkIntensityStandardization02, ("output_images", utils.sort_ascending), srtkMaskImage01, "in_file")
-            self.wf.connect(masks_filtered, ("output_files", utils.sort_ascending), srtkMaskImage01, "in_mask")
+            self.wf.connect(masks_roi[0], (masks_roi[1], utils.sort_ascending), srtkMaskImage01, "in_mask")
 
         self.wf.connect(srtkMaskImage01, "out_im_file", srtkImageReconstruction, "input_images")
-        self.wf.connect(masks_filtered, "output_files", srtkImageReconstruction, "input_masks")
+        self.wf.connect(masks_roi[0], masks_roi[1], srtkImageReconstruction, "input_masks")
         self.wf.connect(stacksOrdering, "stacks_order", srtkImageReconstruction, "stacks_order")
+        if self.m_svr_warm_start:
+            # The cached transforms are keyed by the stacks and masks before preprocessing
+            self.wf.connect(t2ws_filtered, "output_files", srtkImageReconstruction, "raw_images")
+            self.wf.connect(masks_filtered, "output_files", srtkImageReconstruction, "raw_masks")
 
         self.wf.connect(srtkIntensityStandardization02, "output_images", srtkTVSuperResolution, "input_images")
         self.wf.connect(srtkImageReconstruction, ("output_transforms", utils.sort_ascending), srtkTVSuperResolution, "input_transforms")
-        self.wf.connect(masks_filtered, ("output_files", utils.sort_ascending), srtkTVSuperResolution, "input_masks")
+        self.wf.connect(masks_roi[0], (masks_roi[1], utils.sort_ascending), srtkTVSuperResolution, "input_masks")
         self.wf.connect(stacksOrdering, "stacks_order", srtkTVSuperResolution, "stacks_order")
+        if not self.m_skip_stacks_ordering:
+            self.wf.connect(stacksOrdering, "motion_indices", srtkTVSuperResolution, "stacks_motion_index")
 
         self.wf.connect(srtkImageReconstruction, "output_sdi", srtkTVSuperResolution, "input_sdi")
 
 
         if self.m_do_refine_hr_mask:
             self.wf.connect(srtkIntensityStandardization02, ("output_images", utils.sort_ascending), srtkHRMask, "input_images")
-            self.wf.connect(masks_filtered, ("output_files", utils.sort_ascending), srtkHRMask, "input_masks")
+            self.wf.connect(masks_roi[0], (masks_roi[1], utils.sort_ascending), srtkHRMask, "input_masks")
             self.wf.connect(srtkImageReconstruction, ("output_transforms", utils.sort_ascending), srtkHRMask, "input_transforms")
             self.wf.connect(srtkTVSuperResolution, "output_sr", srtkHRMask, "input_sr")
         else:
@@ -502,19 +891,59 @@ class AnatomicalPipeline:
         self.wf.connect(srtkHRMask, "output_srmask", srtkN4BiasFieldCorrection, "input_mask")
 
         self.wf.connect(stacksOrdering, "stacks_order", finalFilenamesGeneration, "stacks_order")
-        self.wf.connect(finalFilenamesGeneration, "substitutions", datasink, "substitutions")
-        self.wf.connect(masks_filtered, ("output_files", utils.sort_ascending), datasink, 'anat.@LRmasks')
+        for datasink in datasinks.values():
+            self.wf.connect(finalFilenamesGeneration, "substitutions", datasink, "substitutions")
+        self._connect_image_to_datasink(masks_roi[0], (masks_roi[1], utils.sort_ascending), datasinks['masks'], 'anat.@LRmasks')
+
+        self._connect_image_to_datasink(srtkIntensityStandardization02, ("output_images", utils.sort_ascending), datasinks['preproc'], 'anat.@LRsPreproc')
+        self._connect_image_to_datasink(srtkMaskImage01, ("out_im_file", utils.sort_ascending), datasinks['preproc'], 'anat.@LRsDenoised')
+        self.wf.connect(srtkImageReconstruction, ("output_transforms", utils.sort_ascending), datasinks['transforms'], 'xfm.@transforms')
+        if self.m_pack_transforms:
+            packSliceTransforms = Node(interface=postprocess.PackSliceTransforms(), name='packSliceTransforms')
+            packSliceTransforms.inputs.sub_ses = sub_ses
+            packSliceTransforms.inputs.sr_id = self.sr_id
+            self.wf.connect(srtkImageReconstruction, "output_transforms", packSliceTransforms, "input_transforms")
+            self.wf.connect(stacksOrdering, "stacks_order", packSliceTransforms, "stacks_order")
+            self.wf.connect(packSliceTransforms, "output_file", datasinks['transforms'], 'xfm.@packedtransforms')
+
+        self._connect_image_to_datasink(srtkImageReconstruction, "output_sdi", datasinks['SDI'], 'anat.@SDI')
+        self._connect_image_to_datasink(srtkN4BiasFieldCorrection, "output_image", datasinks['SR'], 'anat.@SR')
+        self.wf.connect(srtkTVSuperResolution, "output_json_path", datasinks['SR'], 'anat.@SRjson')
+        self.wf.connect(srtkTVSuperResolution, "output_convergence", datasinks['SR'], 'anat.@SRconvergence')
+        self._connect_image_to_datasink(srtkHRMask, "output_srmask", datasinks['SR'], 'anat.@SRmask')
+
+    def _connect_image_to_datasink(self, node, output, datasink, sink_field):
+        """Connect an output image (or list of images) of a node to the datasink.
+
+        If intermediate images are uncompressed, the images are first gzip-compressed
+        by a :class:`pymialsrtk.interfaces.preprocess.NiftiConversion` node such that
+        all final outputs are saved in the ``.nii.gz`` format.
+
+        Parameters
+        ----------
+        node <nipype.pipeline.Node>
+            Node producing the image(s)
+
+        output <string> or <tuple>
+            Output of the node, optionally with a connection function as in ``Workflow.connect()``
 
-        self.wf.connect(srtkIntensityStandardization02, ("output_images", utils.sort_ascending), datasink, 'anat.@LRsPreproc')
-        self.wf.connect(srtkMaskImage01, ("out_im_file", utils.sort_ascending), datasink, 'anat.@LRsDenoised')
-        self.wf.connect(srtkImageReconstruction, ("output_transforms", utils.sort_ascending), datasink, 'xfm.@transforms')
+        datasink <nipype.pipeline.Node>
+            Datasink node
 
-        self.wf.connect(srtkImageReconstruction, "output_sdi", datasink, 'anat.@SDI')
-        self.wf.connect(srtkN4BiasFieldCorrection, "output_image", datasink, 'anat.@SR')
-        self.wf.connect(srtkTVSuperResolution, "output_json_path", datasink, 'anat.@SRjson')
-        self.wf.connect(srtkHRMask, "output_srmask", datasink, 'anat.@SRmask')
+        sink_field <string>
+            Input field of the datasink, e.g. ``'anat.@SR'``
 
-    def run(self, number_of_cores=1):
+        """
+        if self.m_uncompressed_intermediates:
+            compression = Node(interface=preprocess.NiftiConversion(),
+                               name='compression_' + sink_field.split('@')[-1])
+            compression.inputs.out_ext = '.nii.gz'
+            self.wf.connect(node, output, compression, "input_images")
+            self.wf.connect(compression, ("output_images", utils.sort_ascending), datasink, sink_field)
+        else:
+            self.wf.connect(node, output, datasink, sink_field)
+
+    def run(self, number_of_cores=1, memory_gb=None):
         """Execute the workflow of the super-resolution reconstruction pipeline.
 
         Nipype execution engine will take care of the management and execution of
@@ -522,18 +951,499 @@ class AnatomicalPipeline:
         Note that the complete execution graph is saved as a PNG image to support
         transparency on the whole processing.
 
+        Intermediate outputs are removed during and after the execution according to
+        ``m_prune_intermediates`` and ``m_keep_only_outputs``, and a compact provenance
+        file is saved in the ``logs/`` folder of the subject derivatives.
+
+        If ``m_openmp_number_of_cores`` is set, each node declares its number of threads
+        (see :func:`~pymialsrtk.pipelines.execution.allocate_threads`) such that the
+        threads of the nodes running in parallel never exceed ``number_of_cores``.
+
+        The peak memory of each node is estimated from the dimensions of the input stacks
+        (see :mod:`pymialsrtk.pipelines.resources`) such that the nodes running in parallel
+        do not exceed ``memory_gb``. The geometry of the stacks is saved in the provenance
+        file to calibrate the timing models used by :meth:`dry_run`.
+
+        With the ``"dask"`` execution backend, the nodes are scheduled with the same
+        thread and memory constraints but executed by the workers of a Dask cluster,
+        whose dashboard shows the progress of the execution. With the ``"native"`` execution
+        backend, the interfaces are run directly by a pool of processes and the returned
+        results are the outputs of the nodes indexed by node name.
+
+        If ``m_cpu_affinity`` is True, the cores assigned to the MIALSRTK tools are managed
+        in a ledger shared by all the running tools (see :func:`~pymialsrtk.interfaces.utils.acquire_cores`).
+        If the environment variable ``MIALSRTK_CPU_AFFINITY_LEDGER`` is already set, e.g. by the
+        BIDS App processing several subjects in parallel, its ledger is used. Otherwise, a ledger
+        with ``number_of_cores`` of the cores available to the process is created in the working directory.
+
+        If ``m_time_budget`` is set, the workflow is first re-created with the settings fitting
+        in the budget (see :meth:`fit_time_budget`). The chosen settings, the predicted and the
+        actual wall times are saved under ``"Time budget"`` in the provenance file.
+
+        Each output is published in the derivatives as soon as it is available, by one datasink
+        per stage (masks, preprocessed stacks, transforms, SDI and SR), which moves it atomically to
+        its final location (see :class:`~pymialsrtk.interfaces.postprocess.AtomicDataSink`). The
+        outputs published and the status of the reconstruction (``"running"``, ``"done"`` or ``"failed"``)
+        are recorded in the status manifest ``logs/<sub_ses>_rec-SR_id-<id>_status.json``.
+
+        If ``m_preview`` is set, the preview reconstruction (see :meth:`create_preview_pipeline`)
+        is run and published first. A failure of the preview does not stop the full reconstruction,
+        which is not run if ``m_preview_only`` is set (the results of the preview are then returned).
+
         Parameters
         ----------
         number_of_cores <int>
             Number of cores / CPUs used by the workflow
 
+        memory_gb <float>
+            Memory in GB available to the workflow. If None, Nipype uses 90% of the system memory.
+
         """
+        if self.m_preview and not self.m_is_preview:
+            iflogger = logging.getLogger('nipype.interface')
+            try:
+                preview_res = self.create_preview_pipeline().run(number_of_cores, memory_gb)
+                iflogger.info("Preview reconstruction published")
+            except Exception as e:
+                if self.m_preview_only:
+                    raise
+                iflogger.error("Preview reconstruction failed: {}".format(e))
+            if self.m_preview_only:
+                return preview_res
+
+        if self.m_time_budget is not None:
+            self.fit_time_budget(number_of_cores, memory_gb)
+        start = time.time()
 
         self.wf.write_graph(dotfilename='graph.dot', graph2use='colored', format='png', simple_form=True)
-        if number_of_cores > 1:
-            res = self.wf.run(plugin='MultiProc', plugin_args={'n_procs': number_of_cores})
 
-        else:
-            res = self.wf.run()
+        if self.m_hash_method == "cached":
+            self.hash_input_files()
+
+        geometry = self._configure_resources(number_of_cores, memory_gb)
+
+        sub_ses = self.subject
+        if self.session is not None:
+            sub_ses = ''.join([sub_ses, '_', self.session])
+        final_res_dir = self.wf.get_node('data_sinker_SR').inputs.base_directory
+        manifest_file = self.wf.get_node('data_sinker_SR').inputs.manifest_file
+        utils.update_status_manifest(manifest_file, p_status="running", p_reset=True,
+                                     p_metadata={"Subject": self.subject,
+                                                 "Session": self.session,
+                                                 "sr-id": self.sr_id,
+                                                 "Version": __version__})
+
+        recorder = ProvenanceRecorder({"Pipeline": "pymialsrtk",
+                                       "Version": __version__,
+                                       "Subject": self.subject,
+                                       "Session": self.session,
+                                       "sr-id": self.sr_id,
+                                       "Stacks": self.m_stacks,
+                                       "Stacks geometry": [[list(shape), list(zooms)] for shape, zooms in geometry],
+                                       "paramTV": {"deltatTV": self.deltatTV,
+                                                   "lambdaTV": self.lambdaTV,
+                                                   "primal_dual_loops": self.primal_dual_loops,
+                                                   "multiresolution": self.multiresolutionTV},
+                                       "Working directory": os.path.join(self.wf.base_dir, self.wf.name)})
+        if self.m_time_budget_choice is not None:
+            recorder.metadata["Time budget"] = dict(self.m_time_budget_choice)
+        if self.m_is_preview:
+            recorder.metadata["Preview"] = PREVIEW_SETTINGS
+        if self.m_lineage is not None:
+            recorder.metadata["Lineage"] = self.m_lineage
+        # Ledger of the cores assigned to the running tools
+        affinity_ledger = None
+        own_affinity_ledger = False
+        if self.m_cpu_affinity:
+            affinity_ledger = os.environ.get(utils.CPU_AFFINITY_LEDGER_ENV)
+            if affinity_ledger is None:
+                own_affinity_ledger = True
+                affinity_ledger = os.path.join(self.wf.base_dir, self.wf.name, '_cpu_affinity.json')
+                os.makedirs(os.path.dirname(affinity_ledger), exist_ok=True)
+                if os.path.exists(affinity_ledger):
+                    os.remove(affinity_ledger)
+                utils.init_cpu_affinity_ledger(affinity_ledger, utils.get_available_cores()[:number_of_cores])
+                os.environ[utils.CPU_AFFINITY_LEDGER_ENV] = affinity_ledger
+
+        callbacks = StatusCallbacks([recorder])
+        if self.m_prune_intermediates:
+            callbacks.append(IntermediatesPruner(self.wf, protected=[name for name in self.wf.list_node_names()
+                                                                      if name.startswith('data_sinker')]))
+
+        status = "failed"
+        try:
+            if self.m_execution_backend == "dask":
+                from pymialsrtk.pipelines.executors import DaskPlugin
+                plugin_args = {'n_procs': number_of_cores,
+                               'status_callback': callbacks,
+                               'scheduler_address': self.m_dask_scheduler,
+                               'annotate_resources': self.m_dask_scheduler is not None}
+                if memory_gb is not None:
+                    plugin_args['memory_gb'] = memory_gb
+                res = self.wf.run(plugin=DaskPlugin(plugin_args=plugin_args))
+
+            elif self.m_execution_backend == "native":
+                from pymialsrtk.pipelines.executors import NativeExecutor
+                executor = NativeExecutor(number_of_cores=number_of_cores,
+                                          memory_gb=memory_gb,
+                                          status_callback=callbacks,
+                                          hash_method='timestamp' if self.m_hash_method == "timestamp" else 'content')
+                res = executor.run(self.wf)
+
+            elif number_of_cores > 1:
+                plugin_args = {'n_procs': number_of_cores,
+                               'status_callback': callbacks}
+                if memory_gb is not None:
+                    plugin_args['memory_gb'] = memory_gb
+                res = self.wf.run(plugin='MultiProc', plugin_args=plugin_args)
+
+            else:
+                res = self.wf.run(plugin='Linear', plugin_args={'status_callback': callbacks})
+            status = "done"
+        finally:
+            utils.update_status_manifest(manifest_file, p_status=status)
+            if "Time budget" in recorder.metadata:
+                recorder.metadata["Time budget"]["Actual wall time (s)"] = time.time() - start
+            if affinity_ledger is not None:
+                recorder.metadata["CPU affinity"] = utils.get_core_assignments(
+                    affinity_ledger, os.path.join(self.wf.base_dir, self.wf.name))
+                if own_affinity_ledger:
+                    del os.environ[utils.CPU_AFFINITY_LEDGER_ENV]
+            recorder.save(os.path.join(final_res_dir, 'logs',
+                                       sub_ses + '_rec-SR_id-' + str(self.sr_id) + '_provenance.json'))
+
+        if self.m_keep_only_outputs:
+            iflogger = logging.getLogger('nipype.interface')
+            # The TV checkpoints and the SVR transforms cache are kept outside of the workflow directory
+            for directory in [os.path.join(self.wf.base_dir, self.wf.name),
+                              os.path.join(self.wf.base_dir, 'tv_checkpoints'),
+                              os.path.join(os.path.dirname(self.wf.base_dir), 'svr_transforms')]:
+                if os.path.exists(directory):
+                    iflogger.info("Remove working directory {}".format(directory))
+                    shutil.rmtree(directory, ignore_errors=True)
 
         return res
+
+    def dry_run(self, number_of_cores=1, memory_gb=None):
+        """Predict the execution of the workflow of the super-resolution reconstruction pipeline without running it.
+
+        Only the headers of the input stacks are read. The threads and memory of the nodes
+        are configured as in :meth:`run`, and the execution time of each node is estimated with
+        the timing models of :mod:`pymialsrtk.pipelines.resources`, calibrated on the provenance
+        files of the past runs found in the output directory.
+
+        If ``m_time_budget`` is set, the prediction is made with the settings fitting in the
+        budget (see :meth:`fit_time_budget`), which are returned under ``"Time budget"``.
+        If ``m_preview`` is set, the prediction of the preview reconstruction is returned under
+        ``"Preview"`` (and only this one if ``m_preview_only`` is set).
+
+        Parameters
+        ----------
+        number_of_cores <int>
+            Number of cores / CPUs used by the workflow
+
+        memory_gb <float>
+            Memory in GB available to the workflow. If None, 90% of the system memory.
+
+        Returns
+        -------
+        plan <dict>
+            Prediction returned by :func:`~pymialsrtk.pipelines.resources.plan_workflow`
+
+        """
+        iflogger = logging.getLogger('nipype.interface')
+
+        preview_plan = None
+        if self.m_preview and not self.m_is_preview:
+            preview_plan = self.create_preview_pipeline().dry_run(number_of_cores, memory_gb)
+            if self.m_preview_only:
+                return preview_plan
+
+        if self.m_time_budget is not None:
+            self.fit_time_budget(number_of_cores, memory_gb)
+
+        geometry = self._configure_resources(number_of_cores, memory_gb)
+
+        plan = plan_workflow(self.wf, geometry, number_of_cores, self._calibrate_timing_models())
+        plan["Stacks"] = len(geometry)
+        if self.m_time_budget_choice is not None:
+            plan["Time budget"] = self.m_time_budget_choice
+        if preview_plan is not None:
+            plan["Preview"] = preview_plan
+
+        iflogger.info("Dry run: {} nodes, estimated wall time {:.0f} s "
+                      "(CPU time {:.0f} s on {} cores), peak memory of a step {:.2f} GB".format(
+                          plan["Number of nodes"], plan["Estimated wall time (s)"],
+                          plan["Estimated CPU time (s)"], number_of_cores,
+                          plan["Estimated peak memory of a step (GB)"]))
+        iflogger.info("Critical path ({:.0f} s): {}".format(plan["Critical path time (s)"],
+                                                            " -> ".join(plan["Critical path"])))
+        return plan
+
+    def create_preview_pipeline(self):
+        """Create the pipeline of a fast preview of the reconstruction, with its workflow.
+
+        The preview uses the same stacks, masks and parameters as the pipeline with the cheaper
+        settings of :data:`PREVIEW_SETTINGS`: the NLM denoising is skipped, the SVR runs with a few
+        iterations (or not at all if it is skipped), and a short TV super-resolution is run on a coarser
+        HR grid, without multi-resolution levels, checkpoints or refinement of the HR mask. It is published
+        in the ``pymialsrtk-<version>-preview`` derivatives, with the same filenames as the reconstruction.
+
+        Returns
+        -------
+        preview <AnatomicalPipeline>
+            Pipeline of the preview, whose workflow is created
+
+        """
+        preview = copy.copy(self)
+        preview.m_is_preview = True
+        preview.m_preview = False
+        preview.m_preview_only = False
+        preview.m_time_budget = None
+        preview.m_time_budget_choice = None
+        preview.m_incremental_from = None
+        preview.m_lineage = None
+
+        preview.m_skip_nlm_denoising = True
+        preview.m_do_refine_hr_mask = False
+        preview.m_svr_iterations = min(self.m_svr_iterations or 10, PREVIEW_SETTINGS["svr_iterations"])
+        preview.primal_dual_loops = min(int(self.primal_dual_loops), PREVIEW_SETTINGS["primal_dual_loops"])
+        preview.m_tv_iterations = min(self.m_tv_iterations or 50, PREVIEW_SETTINGS["tv_iterations"])
+        preview.m_hr_voxel_factor = max(self.m_hr_voxel_factor, PREVIEW_SETTINGS["hr_voxel_factor"])
+        preview.multiresolutionTV = None
+        preview.m_tv_checkpoint_loops = 0
+
+        preview.create_workflow()
+        return preview
+
+    def fit_time_budget(self, number_of_cores=1, memory_gb=None):
+        """Choose the settings of the reconstruction such that its predicted wall time fits in ``m_time_budget``.
+
+        The settings are degraded step by step following :data:`TIME_BUDGET_LADDER`, starting from
+        the configured ones. For each candidate, the workflow is re-created and its wall time is
+        predicted as in :meth:`dry_run`, from the headers of the stacks and the timing models calibrated
+        on the past runs, the cost of the iterative steps being scaled by their number of iterations and
+        the size of the HR grid (see :func:`~pymialsrtk.pipelines.resources.get_work_scale`).
+        The first candidate that fits is kept. If none fits, the cheapest one is kept with a warning.
+
+        Parameters
+        ----------
+        number_of_cores <int>
+            Number of cores / CPUs used by the workflow
+
+        memory_gb <float>
+            Memory in GB available to the workflow. If None, 90% of the system memory.
+
+        Returns
+        -------
+        choice <dict>
+            Chosen settings, degradations applied and predicted wall time, also stored in ``m_time_budget_choice``
+
+        """
+        iflogger = logging.getLogger('nipype.interface')
+
+        timing_models = self._calibrate_timing_models()
+        configured = {"tv_iterations": self.m_tv_iterations,
+                      "svr_iterations": self.m_svr_iterations,
+                      "skip_nlm_denoising": self.m_skip_nlm_denoising,
+                      "primal_dual_loops": self.primal_dual_loops,
+                      "skip_svr": self.m_skip_svr,
+                      "hr_voxel_factor": self.m_hr_voxel_factor}
+        budget_s = 60.0 * self.m_time_budget
+
+        settings = {}
+        for nb_of_steps in range(len(TIME_BUDGET_LADDER) + 1):
+            if nb_of_steps > 0:
+                settings.update(TIME_BUDGET_LADDER[nb_of_steps - 1][1])
+
+            self._apply_time_budget_settings(configured, settings)
+            self.create_workflow()
+            geometry = self._configure_resources(number_of_cores, memory_gb)
+            plan = plan_workflow(self.wf, geometry, number_of_cores, timing_models)
+            iflogger.info("Time budget: {} step(s) of degradation, predicted wall time {:.0f} s for a budget "
+                          "of {:.0f} s".format(nb_of_steps, plan["Estimated wall time (s)"], budget_s))
+            if plan["Estimated wall time (s)"] <= budget_s:
+                break
+
+        fits = plan["Estimated wall time (s)"] <= budget_s
+        if not fits:
+            iflogger.warning("The predicted wall time of the cheapest settings ({:.0f} s) exceeds the time budget "
+                             "of {:.0f} s".format(plan["Estimated wall time (s)"], budget_s))
+
+        self.m_time_budget_choice = {"Time budget (min)": self.m_time_budget,
+                                     "Number of cores": number_of_cores,
+                                     "Fits": fits,
+                                     "Degradations": [step[0] for step in TIME_BUDGET_LADDER[:nb_of_steps]],
+                                     "Settings": {"NLM denoising": not self.m_skip_nlm_denoising,
+                                                  "SVR": not self.m_skip_svr,
+                                                  "SVR iterations": self.m_svr_iterations,
+                                                  "TV primal/dual loops": self.primal_dual_loops,
+                                                  "TV inner iterations": self.m_tv_iterations,
+                                                  "HR voxel size factor": self.m_hr_voxel_factor},
+                                     "Predicted wall time (s)": plan["Estimated wall time (s)"]}
+        iflogger.info("Settings chosen for the time budget: {}".format(self.m_time_budget_choice))
+        return self.m_time_budget_choice
+
+    def _apply_time_budget_settings(self, configured, settings):
+        """Set the attributes of the pipeline from the configured settings degraded by the ladder settings."""
+        # Settings only get cheaper than the configured ones
+        self.m_tv_iterations = min(configured["tv_iterations"] or 50, settings["tv_iterations"]) \
+            if "tv_iterations" in settings else configured["tv_iterations"]
+        self.m_svr_iterations = min(configured["svr_iterations"] or 10, settings["svr_iterations"]) \
+            if "svr_iterations" in settings else configured["svr_iterations"]
+        self.m_skip_nlm_denoising = configured["skip_nlm_denoising"] or settings.get("skip_nlm_denoising", False)
+        self.primal_dual_loops = max(1, int(round(int(configured["primal_dual_loops"]) *
+                                                  settings.get("tv_loops_factor", 1.0))))
+        self.m_skip_svr = configured["skip_svr"] or settings.get("skip_svr", False)
+        self.m_hr_voxel_factor = max(configured["hr_voxel_factor"], settings.get("hr_voxel_factor", 1.0))
+
+    def _calibrate_timing_models(self):
+        """Return the timing models calibrated on the provenance files of the past runs found in the output directory."""
+        iflogger = logging.getLogger('nipype.interface')
+
+        provenance_files = glob(os.path.join(self.output_dir, "pymialsrtk-*", "sub-*", "logs", "*_provenance.json"))
+        provenance_files += glob(os.path.join(self.output_dir, "pymialsrtk-*", "sub-*", "ses-*", "logs", "*_provenance.json"))
+        iflogger.info("Timing models calibrated on {} past runs".format(len(provenance_files)))
+        return calibrate_timing_models(provenance_files)
+
+    def _configure_resources(self, number_of_cores=1, memory_gb=None):
+        """Set the number of threads and the memory of the nodes before the execution.
+
+        Returns the geometry of the input stacks used for the memory estimates.
+        """
+        iflogger = logging.getLogger('nipype.interface')
+
+        if self.m_openmp_number_of_cores is not None:
+            multithreaded_interfaces = (preprocess.BtkNLMDenoising,
+                                        preprocess.BrainExtraction,
+                                        preprocess.MultipleBrainExtraction,
+                                        reconstruction.MialsrtkImageReconstruction,
+                                        reconstruction.MialsrtkTVSuperResolution)
+            nb_of_threads = max(1, min(self.m_openmp_number_of_cores, number_of_cores))
+            allocation = allocate_threads(self.wf, multithreaded_interfaces, nb_of_threads)
+            iflogger.info("Number of threads allocated to the nodes: {}".format(allocation))
+
+        from nipype.utils.profiler import get_system_total_memory_gb
+        memory_budget = memory_gb if memory_gb is not None else 0.9 * get_system_total_memory_gb()
+        geometry = get_stacks_geometry(self._get_input_stacks())
+        estimates = set_memory_estimates(self.wf, geometry, memory_budget)
+        iflogger.info("Memory (GB) estimated for the nodes: {}".format(estimates))
+
+        return geometry
+
+    def _setup_incremental(self, sub_ses, final_res_dir):
+        """Configure the update of the reconstruction ``m_incremental_from`` with new stacks.
+
+        The stacks of the previous reconstruction are read from its JSON sidecar and kept in the
+        same order, such that the target of the registration is unchanged, and the new stacks
+        (the ones of ``m_stacks`` or of the subject that were not used) are appended to them.
+        The slices are then registered against the previous SR image, the previous stacks being
+        warm-started from the slice transforms saved in ``xfm/`` by the previous reconstruction
+        (or, if they are missing, from the SVR transforms cache), and a short TV super-resolution
+        refines the previous SR image with all the stacks. The lineage is saved in ``m_lineage``.
+
+        Parameters
+        ----------
+        sub_ses <string>
+            Subject and session prefix of the filenames
+
+        final_res_dir <string>
+            Derivatives directory of the subject (and session)
+
+        Returns
+        -------
+        previous_sr <string>
+            Path of the previous SR image
+
+        previous_transforms list<string>
+            Paths of the slice transforms of the previous stacks found in ``xfm/``
+
+        """
+        previous = os.path.join(final_res_dir, 'anat',
+                                ''.join([sub_ses, '_rec-SR_id-', str(self.m_incremental_from), '_T2w']))
+        previous_sr = previous + '.nii.gz'
+        if not os.path.exists(previous_sr) or not os.path.exists(previous + '.json'):
+            raise ValueError('Reconstruction sr-id {} to update not found in {}'.format(
+                self.m_incremental_from, os.path.join(final_res_dir, 'anat')))
+        if str(self.m_incremental_from) == str(self.sr_id):
+            raise ValueError('The incremental reconstruction needs a new sr-id (sr-id {} is updated)'.format(self.sr_id))
+
+        with open(previous + '.json', 'r') as f:
+            previous_stacks = [int(run_id) for run_id in json.load(f)["Input sources run order"]]
+
+        if self.m_stacks is not None:
+            stacks = [int(run_id) for run_id in self.m_stacks]
+        else:
+            anat_dir = os.path.join(self.bids_dir, self.subject, 'anat') if self.session is None else \
+                os.path.join(self.bids_dir, self.subject, self.session, 'anat')
+            stacks = sorted(int(re.search(r'_run-(\d+)_', os.path.basename(f)).group(1))
+                            for f in glob(os.path.join(anat_dir, sub_ses + '*_run-*_T2w.nii.gz')))
+        added_stacks = [run_id for run_id in stacks if run_id not in previous_stacks]
+        if not added_stacks:
+            print('Warning: no stack added to reconstruction sr-id {}'.format(self.m_incremental_from))
+
+        self.m_stacks = previous_stacks + added_stacks
+        self.m_skip_stacks_ordering = True
+        self.m_svr_warm_start = True
+        self.m_lineage = {"Previous sr-id": self.m_incremental_from,
+                          "Previous reconstruction": os.path.basename(previous_sr),
+                          "Previous stacks": previous_stacks,
+                          "Added stacks": added_stacks}
+
+        previous_transforms = [os.path.join(final_res_dir, 'xfm', ''.join([sub_ses, '_run-', str(run_id), '_id-',
+                                                                           str(self.m_incremental_from),
+                                                                           '_T2w_from-origin_to-SDI_mode-image_xfm.txt']))
+                               for run_id in previous_stacks]
+        previous_transforms = [f for f in previous_transforms if os.path.exists(f)]
+        return previous_sr, previous_transforms
+
+    def _get_input_stacks(self):
+        """Return the input stacks processed by the workflow, i.e. the ones of ``m_stacks`` if it is set."""
+        stacks = self._get_input_files(['T2ws'])
+        if self.m_stacks is not None:
+            stacks = [f for f in stacks
+                      if any('_run-{}_'.format(run_id) in os.path.basename(f) for run_id in self.m_stacks)]
+        return stacks
+
+    def hash_input_files(self):
+        """Fill the digest cache with the input files of the workflow and report the hashing time.
+
+        The input files are the ones matched by the templates of the ``data_grabber`` node.
+        Files already in the digest cache, which were not modified since, are not read again.
+
+        Returns
+        -------
+        elapsed <float>
+            Time in seconds spent in hashing the input files
+
+        """
+        iflogger = logging.getLogger('nipype.interface')
+
+        input_files = self._get_input_files()
+
+        start = time.time()
+        for f in input_files:
+            utils.hash_file_cached(f)
+        elapsed = time.time() - start
+
+        total_size = sum(os.path.getsize(f) for f in input_files) / (1024.0 * 1024.0)
+        iflogger.info("Hashing of {} input files ({:.1f} MB) took {:.2f} s".format(len(input_files),
+                                                                                   total_size,
+                                                                                   elapsed))
+        return elapsed
+
+    def _get_input_files(self, fields=None):
+        """Return the input files matched by the templates of the ``data_grabber`` node.
+
+        Parameters
+        ----------
+        fields list<string>
+            Fields of the ``data_grabber`` node whose files are returned (all by default)
+
+        """
+        dg = self.wf.get_node('data_grabber')
+        input_files = []
+        for field, template in dg.inputs.field_template.items():
+            if fields is None or field in fields:
+                input_files += sorted(glob(os.path.join(dg.inputs.base_directory, template)))
+        return input_files
@@ -0,0 +1,259 @@
+# Copyright © 2016-2020 Medical Image Analysis Laboratory, University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+"""Module with the tools managing and monitoring the execution of the pipelines.
+
+The classes of this module are callables with the signature ``(node, status)``
+expected by the ``status_callback`` argument of the Nipype execution plugins.
+They are notified when a node starts (``"start"``), finishes (``"end"``) or
+fails (``"exception"``).
+"""
+
+import os
+import json
+import shutil
+import datetime
+from glob import glob
+
+from nipype import logging
+
+from pymialsrtk.pipelines.resources import get_work_scale
+
+# Interfaces whose outputs can be the input files themselves, i.e. files in the
+# directory of their producer (filtering of a list of files, identity, conversion
+# of images already in the target format).
+PASS_THROUGH_INTERFACES = ['IdentityInterface', 'FilteringByRunid', 'NiftiConversion']
+
+
+def allocate_threads(wf, multithreaded_interfaces, nb_of_threads):
+    """Function that sets the number of threads of each node of a workflow.
+
+    Nodes running one of the ``multithreaded_interfaces`` get ``nb_of_threads`` threads,
+    the other nodes whose interface has a ``num_threads`` input get a single thread.
+    Setting ``n_procs`` of a node also sets the ``num_threads`` input of its interface,
+    and lets the MultiProc plugin account for these threads in its total number of processors.
+
+    Parameters
+    ----------
+    wf <nipype.pipeline.Workflow>
+        Workflow whose nodes are configured
+
+    multithreaded_interfaces tuple<class>
+        Interface classes of the nodes that should get ``nb_of_threads`` threads
+
+    nb_of_threads <int>
+        Number of threads of the multithreaded nodes
+
+    Returns
+    -------
+    allocation <dict>
+        Number of threads allocated to each configured node, indexed by node name
+
+    Examples
+    --------
+    >>> from pymialsrtk.pipelines.execution import allocate_threads
+    >>> from pymialsrtk.interfaces.preprocess import BtkNLMDenoising
+    >>> allocate_threads(wf, (BtkNLMDenoising,), 4) # doctest: +SKIP
+
+    """
+    allocation = dict()
+    for node in wf._get_all_nodes():
+        if isinstance(node.interface, multithreaded_interfaces):
+            node.n_procs = nb_of_threads
+        elif hasattr(node.interface.inputs, 'num_threads'):
+            node.n_procs = 1
+        else:
+            continue
+        allocation[node.name] = node.n_procs
+    return allocation
+
+
+class StatusCallbacks:
+    """Class that dispatches the status of the workflow nodes to several callbacks.
+
+    Attributes
+    -----------
+    callbacks list<callable>
+        List of callbacks with the ``(node, status)`` signature
+
+    Examples
+    --------
+    >>> from pymialsrtk.pipelines.execution import StatusCallbacks
+    >>> callbacks = StatusCallbacks([pruner, recorder])
+    >>> wf.run(plugin='MultiProc', plugin_args={'status_callback': callbacks}) # doctest: +SKIP
+
+    """
+
+    def __init__(self, callbacks=None):
+        """Constructor of StatusCallbacks class instance."""
+        self.callbacks = list(callbacks) if callbacks is not None else []
+
+    def append(self, callback):
+        """Add a new callback."""
+        self.callbacks.append(callback)
+
+    def __call__(self, node, status):
+        for callback in self.callbacks:
+            callback(node, status)
+
+
+class IntermediatesPruner:
+    """Class that deletes the working directory of a node once all its consumers have finished.
+
+    The consumers of each node are given by the out-edges of the workflow graph. As the
+    nodes running one of the :data:`PASS_THROUGH_INTERFACES` can forward files of the
+    directory of their producer, the consumers of such a node are also consumers of its
+    producer, transitively. When the last consumer of a node finishes, the working directory
+    of the node is removed, except if the node is listed in ``protected``.
+    Note that pruned nodes are recomputed if the workflow is run again.
+
+    Attributes
+    -----------
+    base_dir <string>
+        Directory of the workflow. Only directories inside it are removed.
+
+    protected list<string>
+        Names of the nodes whose working directory should never be removed
+
+    Examples
+    --------
+    >>> from pymialsrtk.pipelines.execution import IntermediatesPruner
+    >>> pruner = IntermediatesPruner(wf, protected=['data_sinker'])
+
+    """
+
+    def __init__(self, wf, protected=None):
+        """Constructor of IntermediatesPruner class instance."""
+        self.base_dir = os.path.abspath(os.path.join(wf.base_dir, wf.name))
+        self.protected = set(protected) if protected is not None else set()
+
+        graph = wf._create_flat_graph()
+        successors = {node.name: set(succ.name for succ in graph.successors(node))
+                      for node in graph.nodes()}
+        forwarders = set(node.name for node in graph.nodes()
+                         if node.interface.__class__.__name__ in PASS_THROUGH_INTERFACES)
+
+        self._consumers = {name: self._get_consumers(name, successors, forwarders) for name in successors}
+        self._producers = {name: set() for name in successors}
+        for producer, consumers in self._consumers.items():
+            for consumer in consumers:
+                self._producers[consumer].add(producer)
+        self._dirs = {}
+        self.freed_bytes = 0
+
+    @staticmethod
+    def _get_consumers(name, successors, forwarders):
+        """Return the successors of a node, and the consumers of the successors forwarding its files."""
+        consumers = set()
+        to_visit = list(successors[name])
+        while to_visit:
+            consumer = to_visit.pop()
+            if consumer in consumers:
+                continue
+            consumers.add(consumer)
+            if consumer in forwarders:
+                to_visit.extend(successors[consumer])
+        return consumers
+
+    def __call__(self, node, status):
+        # Sub-nodes of MapNodes are not part of the workflow graph
+        if status != 'end' or node.name not in self._consumers:
+            return
+
+        self._dirs[node.name] = node.output_dir()
+
+        for producer in self._producers[node.name]:
+            remaining = self._consumers[producer]
+            remaining.discard(node.name)
+            if not remaining and producer not in self.protected:
+                self._remove(producer)
+
+    def _remove(self, name):
+        iflogger = logging.getLogger('nipype.interface')
+
+        node_dir = self._dirs.pop(name, None)
+        if node_dir is None or not os.path.isdir(node_dir):
+            return
+        if not os.path.abspath(node_dir).startswith(self.base_dir + os.sep):
+            return
+
+        size = 0
+        for root, _, files in os.walk(node_dir):
+            for f in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, f))
+                except OSError:
+                    pass
+
+        shutil.rmtree(node_dir, ignore_errors=True)
+        self.freed_bytes += size
+        iflogger.info("Removed intermediate outputs of {} ({:.1f} MB)".format(name, size / (1024.0 * 1024.0)))
+
+
+class ProvenanceRecorder:
+    """Class that records a compact provenance of the executed nodes.
+
+    For each node, it records the interface used, the hash of its inputs,
+    its status, its execution time and its amount of work relative to the
+    default settings of the interface (see :func:`~pymialsrtk.pipelines.resources.get_work_scale`).
+
+    Attributes
+    -----------
+    metadata <dict>
+        Metadata saved with the node records (pipeline version, parameters, ...)
+
+    nodes <dict>
+        Records of the nodes indexed by node name
+
+    Examples
+    --------
+    >>> from pymialsrtk.pipelines.execution import ProvenanceRecorder
+    >>> recorder = ProvenanceRecorder({'subject': 'sub-01', 'sr-id': 1})
+    >>> recorder.save('/path/to/provenance.json') # doctest: +SKIP
+
+    """
+
+    def __init__(self, metadata=None):
+        """Constructor of ProvenanceRecorder class instance."""
+        self.metadata = dict(metadata) if metadata is not None else dict()
+        self.nodes = dict()
+
+    def __call__(self, node, status):
+        record = self.nodes.setdefault(node.fullname, {"interface": node.interface.__class__.__name__})
+
+        if status == 'start':
+            record["start"] = datetime.datetime.now().isoformat()
+            scale = get_work_scale(node.interface)
+            if scale != 1.0:
+                record["work scale"] = scale
+        else:
+            record["end"] = datetime.datetime.now().isoformat()
+            record["status"] = "done" if status == 'end' else "failed"
+            hashfiles = glob(os.path.join(node.output_dir(), '_0x*.json'))
+            if hashfiles:
+                record["hash"] = os.path.basename(hashfiles[0])[1:-len('.json')]
+            if status == 'end':
+                record["duration"] = self._get_duration(node)
+
+    @staticmethod
+    def _get_duration(node):
+        try:
+            runtime = node.result.runtime
+        except Exception:
+            return None
+        # MapNodes have a list of runtimes, one per sub-node
+        if isinstance(runtime, list):
+            durations = [getattr(r, 'duration', None) for r in runtime]
+            durations = [d for d in durations if d is not None]
+            return sum(durations) if durations else None
+        return getattr(runtime, 'duration', None)
+
+    def save(self, filename):
+        """Save the provenance record in a JSON file."""
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        output_dict = dict(self.metadata)
+        output_dict["Nodes"] = self.nodes
+        with open(filename, 'w') as outfile:
+            json.dump(output_dict, outfile, indent=4)
+        return filename
@@ -0,0 +1,364 @@
+# Copyright © 2016-2020 Medical Image Analysis Laboratory, University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+"""Module with the alternative execution backends of the pipelines.
+
+The Dask execution backend is a Nipype execution plugin that can be passed
+to the ``run()`` method of a Nipype workflow. The native executor runs the
+interfaces of a workflow without the Nipype execution engine.
+"""
+
+import os
+from copy import deepcopy
+from types import SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import networkx as nx
+
+from nipype import logging
+from nipype.interfaces.base import isdefined
+from nipype.pipeline.engine import MapNode
+from nipype.pipeline.engine.utils import evaluate_connect_function
+from nipype.pipeline.plugins.base import DistributedPluginBase
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin, run_node
+from nipype.utils.profiler import get_system_total_memory_gb
+from nipype.utils.filemanip import loadpkl, savepkl
+
+try:
+    from dask.distributed import Client, LocalCluster
+except ImportError:
+    Client = None
+    LocalCluster = None
+
+
+class DaskPlugin(MultiProcPlugin):
+    """Nipype execution plugin running the nodes of a workflow as `Dask <https://distributed.dask.org>`_ tasks.
+
+    The nodes are scheduled as with the MultiProc plugin, which starts a node only if
+    its number of threads (``n_procs``) and its memory (``mem_gb``) fit in the resources
+    left by the running nodes, but they are executed by the workers of a ``dask.distributed``
+    cluster. If no scheduler address is given, a ``LocalCluster`` with one single-threaded
+    worker process per core is started and closed at the end of the execution.
+
+    The plugin arguments are the ones of the MultiProc plugin (``n_procs``, ``memory_gb``,
+    ``status_callback``, ...) and:
+
+    * ``scheduler_address``: address of the scheduler of an existing Dask cluster (optional)
+
+    * ``annotate_resources``: if True, the tasks are annotated with the ``threads`` and ``memory_gb``
+      resources, which must be declared by the workers of the existing cluster
+      (e.g. ``dask-worker --resources "threads=8 memory_gb=32"``). (default is False)
+
+    Examples
+    --------
+    >>> from pymialsrtk.pipelines.executors import DaskPlugin
+    >>> plugin = DaskPlugin(plugin_args={'n_procs': 8, 'memory_gb': 16})
+    >>> wf.run(plugin=plugin) # doctest: +SKIP
+
+    """
+
+    def __init__(self, plugin_args=None):
+        """Constructor of DaskPlugin class instance."""
+        if Client is None:
+            raise ImportError('dask.distributed is required by the Dask execution backend')
+
+        # The process pool of the MultiProc plugin is replaced by the Dask client
+        DistributedPluginBase.__init__(self, plugin_args=plugin_args)
+        self._taskresult = {}
+        self._task_obj = {}
+        self._taskid = 0
+        self._cwd = os.getcwd()
+        self._stats = None
+
+        self.processors = self.plugin_args.get('n_procs', os.cpu_count())
+        self.memory_gb = self.plugin_args.get('memory_gb', get_system_total_memory_gb() * 0.9)
+        self.raise_insufficient = self.plugin_args.get('raise_insufficient', True)
+        self.annotate_resources = self.plugin_args.get('annotate_resources', False)
+
+        scheduler_address = self.plugin_args.get('scheduler_address', None)
+        if scheduler_address is not None:
+            self.cluster = None
+            self.client = Client(scheduler_address)
+        else:
+            # Single-threaded worker processes, as Nipype nodes change the working directory
+            self.cluster = LocalCluster(n_workers=self.processors,
+                                        threads_per_worker=1,
+                                        processes=True)
+            self.client = Client(self.cluster)
+
+        iflogger = logging.getLogger('nipype.workflow')
+        iflogger.info('[Dask] Starting (n_procs={}, mem_gb={:.2f}, dashboard: {})'.format(
+            self.processors, self.memory_gb, self.client.dashboard_link))
+
+    def _submit_job(self, node, updatehash=False):
+        self._taskid += 1
+
+        # Don't allow streaming outputs
+        if getattr(node.interface, 'terminal_output', '') == 'stream':
+            node.interface.terminal_output = 'allatonce'
+
+        kwargs = {'pure': False,
+                  'key': '{}-{}'.format(node.fullname, self._taskid)}
+        if self.annotate_resources:
+            kwargs['resources'] = {'threads': node.n_procs, 'memory_gb': node.mem_gb}
+
+        result_future = self.client.submit(run_node, node, updatehash, self._taskid, **kwargs)
+        result_future.add_done_callback(self._async_callback)
+        self._task_obj[self._taskid] = result_future
+        return self._taskid
+
+    def _postrun_check(self):
+        self.client.close()
+        if self.cluster is not None:
+            self.cluster.close()
+
+
+def _run_task(interface, task_dir):
+    """Run an interface in its working directory and return its outputs and its duration."""
+    os.makedirs(task_dir, exist_ok=True)
+    result = interface.run(cwd=task_dir)
+    outputs = result.outputs.get() if result.outputs is not None else dict()
+    return outputs, getattr(result.runtime, 'duration', None)
+
+
+class _NativeNode:
+    """Class that exposes an executed node to the status callbacks of :mod:`pymialsrtk.pipelines.execution`."""
+
+    def __init__(self, node):
+        """Constructor of _NativeNode class instance."""
+        self.name = node.name
+        self.fullname = node.fullname
+        self.interface = node.interface
+        self.result = SimpleNamespace(runtime=[])
+        self._output_dir = node.output_dir()
+
+    def output_dir(self):
+        """Return the working directory of the node."""
+        return self._output_dir
+
+
+class NativeExecutor:
+    """Class that runs the interfaces of a workflow without the Nipype execution engine.
+
+    The nodes of the flattened workflow graph are run in topological order by a pool
+    of worker processes (``concurrent.futures``), the sub-nodes of a MapNode being run
+    in parallel. A node is started only if its number of threads (``n_procs``) and its
+    memory (``mem_gb``) fit in the resources left by the running nodes.
+
+    Each node runs in the same working directory as with Nipype (``mapflow/_<name><i>``
+    for the sub-nodes of a MapNode), so that the DataSink writes the same outputs.
+    Instead of the Nipype result files and reports, only a ``_native_<hash>.pklz`` file
+    with the outputs of the interface is written, and it is reused as long as the hash
+    of the inputs does not change. Nodes whose interface should always run (e.g. the DataSink)
+    are never cached.
+
+    Attributes
+    -----------
+    number_of_cores <int>
+        Number of cores used by the running nodes
+
+    memory_gb <float>
+        Memory in GB available to the running nodes
+
+    status_callback <callable>
+        Callback with the ``(node, status)`` signature notified when a node starts,
+        finishes or fails (optional)
+
+    hash_method <string>
+        Method used to hash the input files (``"content"`` or ``"timestamp"``)
+
+    Examples
+    --------
+    >>> from pymialsrtk.pipelines.executors import NativeExecutor
+    >>> executor = NativeExecutor(number_of_cores=8, memory_gb=16)
+    >>> outputs = executor.run(wf) # doctest: +SKIP
+
+    """
+
+    def __init__(self, number_of_cores=1, memory_gb=None, status_callback=None, hash_method='content'):
+        """Constructor of NativeExecutor class instance."""
+        self.number_of_cores = number_of_cores
+        self.memory_gb = memory_gb if memory_gb is not None else get_system_total_memory_gb() * 0.9
+        self.status_callback = status_callback
+        self.hash_method = hash_method
+
+    def run(self, wf):
+        """Run the workflow.
+
+        Parameters
+        ----------
+        wf <nipype.pipeline.Workflow>
+            Workflow to run
+
+        Returns
+        -------
+        outputs <dict>
+            Outputs of the nodes indexed by node name
+
+        """
+        iflogger = logging.getLogger('nipype.workflow')
+
+        graph = wf._create_flat_graph()
+        for node in graph.nodes():
+            node.base_dir = wf.base_dir
+
+        outputs = dict()
+        failed = []
+        pending = list(nx.topological_sort(graph))
+        tasks = []  # Tasks of the started nodes waiting for free resources
+        running = dict()  # Future -> (node, index, task_dir, cache_file, n_procs, mem_gb)
+        remaining_tasks = dict()
+        node_results = dict()
+        records = dict()
+        free_procs = self.number_of_cores
+        free_memory = self.memory_gb
+
+        iflogger.info('[Native] Running {} nodes (n_procs={}, mem_gb={:.2f})'.format(
+            len(pending), self.number_of_cores, self.memory_gb))
+
+        with ProcessPoolExecutor(max_workers=self.number_of_cores) as pool:
+            while pending or tasks or running:
+                # Start the nodes whose predecessors have all finished
+                for node in list(pending):
+                    predecessors = list(graph.predecessors(node))
+                    if any(pred.name in failed for pred in predecessors):
+                        pending.remove(node)
+                        failed.append(node.name)
+                        iflogger.error('[Native] Skip {} (upstream failure)'.format(node.fullname))
+                        continue
+                    if not all(pred.name in outputs for pred in predecessors):
+                        continue
+                    pending.remove(node)
+
+                    records[node.name] = _NativeNode(node)
+                    self._notify(records[node.name], 'start')
+                    node_tasks = self._create_tasks(graph, node, outputs)
+                    node_results[node.name] = [None] * len(node_tasks)
+                    remaining_tasks[node.name] = len(node_tasks)
+                    if not node_tasks:
+                        self._finish_node(node, [], outputs, records)
+                    for task in node_tasks:
+                        cached = self._load_cache(task)
+                        if cached is not None:
+                            self._task_done(node, task[1], cached, None, node_results, remaining_tasks,
+                                            outputs, records)
+                        else:
+                            tasks.append(task)
+
+                # Submit the tasks that fit in the free resources, the largest ones first
+                tasks.sort(key=lambda t: (t[0].mem_gb, t[0].n_procs), reverse=True)
+                for task in list(tasks):
+                    node = task[0]
+                    n_procs = min(node.n_procs, self.number_of_cores)
+                    mem_gb = min(node.mem_gb, self.memory_gb)
+                    if n_procs > free_procs or mem_gb > free_memory:
+                        continue
+                    tasks.remove(task)
+                    free_procs -= n_procs
+                    free_memory -= mem_gb
+                    future = pool.submit(_run_task, task[2], task[3])
+                    running[future] = task + (n_procs, mem_gb)
+
+                if not running:
+                    continue
+
+                done, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    node, index, interface, task_dir, cache_file, n_procs, mem_gb = running.pop(future)
+                    free_procs += n_procs
+                    free_memory += mem_gb
+                    if node.name in failed:
+                        continue
+                    try:
+                        task_outputs, duration = future.result()
+                    except Exception as e:
+                        iflogger.error('[Native] {} failed: {}'.format(node.fullname, e))
+                        failed.append(node.name)
+                        self._notify(records[node.name], 'exception')
+                        # Drop the waiting tasks of the failed node
+                        tasks = [t for t in tasks if t[0].name != node.name]
+                        continue
+                    if cache_file is not None:
+                        savepkl(cache_file, task_outputs)
+                    self._task_done(node, index, task_outputs, duration, node_results, remaining_tasks,
+                                    outputs, records)
+
+        if failed:
+            raise RuntimeError('Workflow did not execute cleanly. Failed nodes: {}'.format(', '.join(failed)))
+
+        return outputs
+
+    def _notify(self, node, status):
+        if self.status_callback is not None:
+            self.status_callback(node, status)
+
+    def _task_done(self, node, index, task_outputs, duration, node_results, remaining_tasks, outputs, records):
+        node_results[node.name][index] = task_outputs
+        records[node.name].result.runtime.append(SimpleNamespace(duration=duration))
+        remaining_tasks[node.name] -= 1
+        if remaining_tasks[node.name] == 0:
+            self._finish_node(node, node_results.pop(node.name), outputs, records)
+
+    def _finish_node(self, node, results, outputs, records):
+        if isinstance(node, MapNode):
+            fields = node.outputs.copyable_trait_names() if node.outputs is not None else []
+            outputs[node.name] = {field: [r.get(field) for r in results] for field in fields}
+        else:
+            outputs[node.name] = results[0]
+            records[node.name].result.runtime = records[node.name].result.runtime[0]
+        self._notify(records[node.name], 'end')
+
+    def _create_tasks(self, graph, node, outputs):
+        """Return the tasks ``(node, index, interface, task_dir, cache_file)`` running a node."""
+        interface = deepcopy(node._interface)
+        if getattr(interface, 'terminal_output', '') == 'stream':
+            interface.terminal_output = 'allatonce'
+
+        iterfield = node.iterfield if isinstance(node, MapNode) else []
+        iter_values = {field: getattr(node._inputs, field) for field in iterfield}
+
+        for pred in graph.predecessors(node):
+            for source, dest in graph.get_edge_data(pred, node)['connect']:
+                if isinstance(source, tuple):
+                    value = outputs[pred.name].get(source[0])
+                    if value is not None and isdefined(value):
+                        value = evaluate_connect_function(source[1], source[2], value)
+                else:
+                    value = outputs[pred.name].get(source)
+                if value is None or not isdefined(value):
+                    continue
+                if dest in iterfield:
+                    iter_values[dest] = deepcopy(value)
+                else:
+                    setattr(interface.inputs, dest, deepcopy(value))
+
+        if not isinstance(node, MapNode):
+            return [self._create_task(node, 0, interface, node.output_dir())]
+
+        nb_of_items = min(len(values) for values in iter_values.values()) if iter_values else 0
+        node_tasks = []
+        for index in range(nb_of_items):
+            subinterface = deepcopy(interface)
+            for field in iterfield:
+                setattr(subinterface.inputs, field, iter_values[field][index])
+            task_dir = os.path.join(node.output_dir(), 'mapflow', '_{}{}'.format(node.name, index))
+            node_tasks.append(self._create_task(node, index, subinterface, task_dir))
+        return node_tasks
+
+    def _create_task(self, node, index, interface, task_dir):
+        cache_file = None
+        if not getattr(interface, 'always_run', False):
+            _, hashvalue = interface.inputs.get_hashval(hash_method=self.hash_method)
+            cache_file = os.path.join(task_dir, '_native_{}.pklz'.format(hashvalue))
+        return node, index, interface, task_dir, cache_file
+
+    @staticmethod
+    def _load_cache(task):
+        cache_file = task[4]
+        if cache_file is None or not os.path.exists(cache_file):
+            return None
+        try:
+            return loadpkl(cache_file)
+        except Exception:
+            return None
@@ -0,0 +1,428 @@
+# Copyright © 2016-2020 Medical Image Analysis Laboratory, University Hospital Center and University of Lausanne (UNIL-CHUV), Switzerland
+#
+#  This software is distributed under the open-source license Modified BSD.
+
+"""Module with the estimation of the resources required by the nodes of the pipelines.
+
+The peak memory of each processing step is estimated from the dimensions of the
+input stacks with a linear model per interface. The estimates are set as the
+``mem_gb`` of the nodes such that the Nipype MultiProc plugin does not start
+more jobs than the memory budget allows.
+
+The execution time of each processing step is estimated in the same way, with
+models calibrated on past runs, to plan the execution of a workflow without running it.
+"""
+
+# Models of the peak memory of the interfaces, indexed by interface class name.
+# Each model is a tuple (base_gb, lr_factor, hr_factor, scope) where the peak memory is
+# base_gb + (lr_factor * LR voxels + hr_factor * HR voxels) * 4 bytes.
+# The factors are the number of single precision volumes held in memory by the tool.
+# ``scope`` is "stack" if the node processes one stack (MapNode) and "stacks" if it
+# processes all the stacks at once.
+# The values are conservative estimates that can be calibrated with the memory peaks
+# reported by the Nipype resource monitor (``runtime.mem_peak_gb``).
+MEMORY_MODELS = {
+    'BtkNLMDenoising': (0.1, 6, 0, "stack"),
+    'MialsrtkCorrectSliceIntensity': (0.1, 4, 0, "stack"),
+    'MialsrtkSliceBySliceN4BiasFieldCorrection': (0.2, 10, 0, "stack"),
+    'MialsrtkSliceBySliceCorrectBiasField': (0.1, 4, 0, "stack"),
+    'MialsrtkMaskImage': (0.1, 3, 0, "stack"),
+    'MaskImage': (0.2, 4, 0, "stack"),
+    'CropImageUsingMask': (0.2, 3, 0, "stack"),
+    'BrainExtraction': (1.5, 8, 0, "stack"),
+    'MialsrtkIntensityStandardization': (0.1, 3, 0, "stacks"),
+    'MialsrtkHistogramNormalization': (0.3, 8, 0, "stacks"),
+    'IntensityNormalization': (0.3, 8, 0, "stacks"),
+    'MialsrtkImageReconstruction': (0.5, 6, 4, "stacks"),
+    'MialsrtkTVSuperResolution': (1.0, 40, 12, "stacks"),
+    'MialsrtkRefineHRMaskByIntersection': (0.5, 6, 4, "stacks"),
+    'MialsrtkN4BiasFieldCorrection': (0.3, 0, 10, "stacks"),
+}
+
+
+def get_stacks_geometry(p_files):
+    """Function that reads the dimensions and voxel sizes of a list of stacks.
+
+    Only the headers of the images are read.
+
+    Parameters
+    ----------
+    p_files list<string>
+        Paths of the stacks
+
+    Returns
+    -------
+    geometry list<tuple>
+        List of ``(shape, zooms)`` tuples, one per stack
+
+    Examples
+    --------
+    >>> from pymialsrtk.pipelines.resources import get_stacks_geometry
+    >>> get_stacks_geometry(['sub-01_run-1_T2w.nii.gz']) # doctest: +SKIP
+    [((256, 256, 25), (1.125, 1.125, 4.4))]
+
+    """
+    import nibabel
+
+    geometry = []
+    for f in p_files:
+        header = nibabel.load(f).header
+        geometry.append((tuple(int(d) for d in header.get_data_shape()[:3]),
+                         tuple(float(z) for z in header.get_zooms()[:3])))
+    return geometry
+
+
+def estimate_hr_voxels(p_geometry):
+    """Function that estimates the number of voxels of the high-resolution reconstruction.
+
+    The reconstruction is assumed to cover the largest field of view of the stacks
+    with an isotropic resolution equal to the smallest in-plane voxel size.
+
+    Parameters
+    ----------
+    p_geometry list<tuple>
+        List of ``(shape, zooms)`` tuples returned by :func:`get_stacks_geometry`
+
+    Returns
+    -------
+    voxels <int>
+        Estimated number of voxels of the reconstruction
+
+    """
+    if not p_geometry:
+        return 0
+    resolution = min(min(zooms) for _, zooms in p_geometry)
+    fov = max(shape[0] * zooms[0] * shape[1] * zooms[1] * shape[2] * zooms[2]
+              for shape, zooms in p_geometry)
+    return int(fov / resolution ** 3)
+
+
+def estimate_memory_gb(p_interface_name, p_geometry):
+    """Function that estimates the peak memory of an interface from the geometry of the stacks.
+
+    Parameters
+    ----------
+    p_interface_name <string>
+        Class name of the interface
+
+    p_geometry list<tuple>
+        List of ``(shape, zooms)`` tuples returned by :func:`get_stacks_geometry`
+
+    Returns
+    -------
+    mem_gb <float>
+        Estimated peak memory in GB, or None if there is no model for the interface
+
+    Examples
+    --------
+    >>> from pymialsrtk.pipelines.resources import estimate_memory_gb
+    >>> estimate_memory_gb('BtkNLMDenoising', [((256, 256, 25), (1.125, 1.125, 4.4))])
+    0.1393216
+
+    """
+    if p_interface_name not in MEMORY_MODELS or not p_geometry:
+        return None
+    base_gb, lr_factor, hr_factor, scope = MEMORY_MODELS[p_interface_name]
+
+    lr_voxels = [shape[0] * shape[1] * shape[2] for shape, _ in p_geometry]
+    if scope == "stack":
+        lr_voxels = max(lr_voxels)
+    else:
+        lr_voxels = sum(lr_voxels)
+    hr_voxels = estimate_hr_voxels(p_geometry) if hr_factor > 0 else 0
+
+    return base_gb + (lr_factor * lr_voxels + hr_factor * hr_voxels) * 4 / 1e9
+
+
+def set_memory_estimates(wf, p_geometry, p_max_memory_gb=None):
+    """Function that sets the ``mem_gb`` of the nodes of a workflow to their estimated peak memory.
+
+    Nodes whose interface has no memory model keep their ``mem_gb``.
+
+    Parameters
+    ----------
+    wf <nipype.pipeline.Workflow>
+        Workflow whose nodes are configured
+
+    p_geometry list<tuple>
+        List of ``(shape, zooms)`` tuples returned by :func:`get_stacks_geometry`
+
+    p_max_memory_gb <float>
+        Upper bound of the estimates (e.g. the memory budget of the scheduler) such that
+        a node is never requiring more memory than available (optional)
+
+    Returns
+    -------
+    estimates <dict>
+        Memory in GB set for each configured node, indexed by node name
+
+    """
+    estimates = dict()
+    for node in wf._get_all_nodes():
+        mem_gb = estimate_memory_gb(node.interface.__class__.__name__, p_geometry)
+        if mem_gb is None:
+            continue
+        if p_max_memory_gb is not None:
+            mem_gb = min(mem_gb, p_max_memory_gb)
+        # Set the attribute used by Node and MapNode, as mem_gb is a read-only property
+        node._mem_gb = mem_gb
+        estimates[node.name] = round(mem_gb, 2)
+    return estimates
+
+
+# Models of the execution time of the interfaces, indexed by interface class name.
+# Each model is a tuple (base_s, s_per_megavoxel, scope) where the execution time is
+# base_s + s_per_megavoxel * megavoxels. The voxels are the ones of one stack if ``scope``
+# is "stack" (time of one MapNode iteration), of all the stacks if ``scope`` is "stacks",
+# and of the high-resolution reconstruction if ``scope`` is "hr".
+# The default values are rough estimates that are replaced by the ones calibrated on
+# past runs by :func:`calibrate_timing_models`.
+TIMING_MODELS = {
+    'BtkNLMDenoising': (5.0, 60.0, "stack"),
+    'MialsrtkCorrectSliceIntensity': (2.0, 5.0, "stack"),
+    'MialsrtkSliceBySliceN4BiasFieldCorrection': (5.0, 120.0, "stack"),
+    'MialsrtkSliceBySliceCorrectBiasField': (2.0, 5.0, "stack"),
+    'MialsrtkMaskImage': (1.0, 2.0, "stack"),
+    'MaskImage': (1.0, 2.0, "stack"),
+    'CropImageUsingMask': (1.0, 2.0, "stack"),
+    'NiftiConversion': (1.0, 5.0, "stacks"),
+    'BrainExtraction': (20.0, 60.0, "stack"),
+    'StacksOrdering': (2.0, 5.0, "stacks"),
+    'MialsrtkIntensityStandardization': (2.0, 3.0, "stacks"),
+    'MialsrtkHistogramNormalization': (3.0, 10.0, "stacks"),
+    'IntensityNormalization': (3.0, 8.0, "stacks"),
+    'MialsrtkImageReconstruction': (30.0, 200.0, "stacks"),
+    'MialsrtkTVSuperResolution': (60.0, 1500.0, "stacks"),
+    'MialsrtkRefineHRMaskByIntersection': (20.0, 100.0, "stacks"),
+    'MialsrtkN4BiasFieldCorrection': (20.0, 30.0, "hr"),
+}
+
+# Model of the interfaces without timing model (utilities, datasink, ...)
+DEFAULT_TIMING_MODEL = (1.0, 0.0, "stacks")
+
+
+def get_work_scale(p_interface):
+    """Function that returns the amount of work of an interface relative to the one of its default settings.
+
+    The time per megavoxel of the timing models corresponds to the default settings of
+    the interfaces. It is scaled by the number of iterations of the iterative interfaces:
+
+    * ``MialsrtkTVSuperResolution``: number of outer loops times the number of inner iterations,
+      relative to 10 x 50, on a high-resolution grid coarsened by ``hr_voxel_factor`` and
+      including the loops of the coarse levels of the multi-resolution mode
+
+    * ``MialsrtkImageReconstruction``: number of slice-to-volume registration iterations relative
+      to 10, or 0.1 if the registration is skipped and only the SDI is computed
+
+    Parameters
+    ----------
+    p_interface <nipype.interfaces.base.BaseInterface>
+        Interface of a node
+
+    Returns
+    -------
+    scale <float>
+        Amount of work relative to the default settings (1.0 for the other interfaces)
+
+    """
+    from nipype.interfaces.base import isdefined
+
+    name = p_interface.__class__.__name__
+    inputs = p_interface.inputs
+
+    if name == 'MialsrtkTVSuperResolution':
+        loops = float(inputs.in_loop) if isdefined(inputs.in_loop) else 10.0
+        factor = float(inputs.hr_voxel_factor)
+        scale = loops * inputs.in_iter / (10.0 * 50.0) / factor ** 3
+        for level, level_loops in zip(inputs.multiresolution_levels, inputs.multiresolution_loops):
+            scale += level_loops * inputs.in_iter / (10.0 * 50.0) / (factor * level) ** 3
+        return scale
+
+    if name == 'MialsrtkImageReconstruction':
+        if inputs.no_reg:
+            return 0.1
+        return (inputs.in_iter if isdefined(inputs.in_iter) else 10) / 10.0
+
+    return 1.0
+
+
+def _get_megavoxels(p_scope, p_geometry):
+    """Return the number of megavoxels processed by an interface according to its scope."""
+    if not p_geometry:
+        return 0.0
+    lr_voxels = [shape[0] * shape[1] * shape[2] for shape, _ in p_geometry]
+    if p_scope == "stack":
+        return float(sum(lr_voxels)) / len(lr_voxels) / 1e6
+    elif p_scope == "hr":
+        return estimate_hr_voxels(p_geometry) / 1e6
+    return sum(lr_voxels) / 1e6
+
+
+def calibrate_timing_models(p_provenance_files, p_timing_models=None):
+    """Function that calibrates the timing models on the provenance files of past runs.
+
+    For each interface, the time per megavoxel is set to the median of the ones
+    measured in the provenance files saved by :class:`~pymialsrtk.pipelines.execution.ProvenanceRecorder`
+    that record the geometry of the input stacks. The sums of the iterations recorded
+    for MapNodes are divided by the number of stacks, and the times of the iterative
+    interfaces by their recorded work scale (see :func:`get_work_scale`).
+
+    Parameters
+    ----------
+    p_provenance_files list<string>
+        Paths of the provenance files of past runs
+
+    p_timing_models <dict>
+        Timing models to be calibrated (default is :data:`TIMING_MODELS`)
+
+    Returns
+    -------
+    timing_models <dict>
+        Calibrated timing models
+
+    """
+    import json
+
+    timing_models = dict(p_timing_models if p_timing_models is not None else TIMING_MODELS)
+
+    rates = dict()
+    for provenance_file in p_provenance_files:
+        try:
+            with open(provenance_file, 'r') as f:
+                provenance = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if "Stacks geometry" not in provenance:
+            continue
+        geometry = [(tuple(shape), tuple(zooms)) for shape, zooms in provenance["Stacks geometry"]]
+
+        for name, record in provenance.get("Nodes", {}).items():
+            interface = record.get("interface")
+            duration = record.get("duration")
+            if interface not in timing_models or duration is None or record.get("status") != "done":
+                continue
+            base_s, _, scope = timing_models[interface]
+            # MapNode records sum the durations of their iterations named _<node><index>
+            if scope == "stack" and not name.split('.')[-1].startswith('_'):
+                duration = float(duration) / max(1, len(geometry))
+            megavoxels = _get_megavoxels(scope, geometry) * record.get("work scale", 1.0)
+            if megavoxels > 0:
+                rates.setdefault(interface, []).append(max(0.0, duration - base_s) / megavoxels)
+
+    for interface, values in rates.items():
+        values = sorted(values)
+        base_s, _, scope = timing_models[interface]
+        timing_models[interface] = (base_s, values[len(values) // 2], scope)
+    return timing_models
+
+
+def estimate_duration_s(p_interface_name, p_geometry, p_timing_models=None, p_work_scale=1.0):
+    """Function that estimates the execution time of an interface from the geometry of the stacks.
+
+    Parameters
+    ----------
+    p_interface_name <string>
+        Class name of the interface
+
+    p_geometry list<tuple>
+        List of ``(shape, zooms)`` tuples returned by :func:`get_stacks_geometry`
+
+    p_timing_models <dict>
+        Timing models (default is :data:`TIMING_MODELS`)
+
+    p_work_scale <float>
+        Amount of work of the interface relative to its default settings (see :func:`get_work_scale`)
+
+    Returns
+    -------
+    duration <float>
+        Estimated time in seconds of one execution (one iteration for a MapNode)
+
+    """
+    timing_models = p_timing_models if p_timing_models is not None else TIMING_MODELS
+    base_s, s_per_megavoxel, scope = timing_models.get(p_interface_name, DEFAULT_TIMING_MODEL)
+    return base_s + s_per_megavoxel * _get_megavoxels(scope, p_geometry) * p_work_scale
+
+
+def plan_workflow(wf, p_geometry, p_number_of_cores=1, p_timing_models=None):
+    """Function that predicts the execution of a workflow without running it.
+
+    The ``n_procs`` and ``mem_gb`` of the nodes should be set beforehand, as for
+    the execution. The iterations of a MapNode (one per stack) run in parallel
+    on the cores left by their number of threads.
+
+    Parameters
+    ----------
+    wf <nipype.pipeline.Workflow>
+        Workflow to be planned
+
+    p_geometry list<tuple>
+        List of ``(shape, zooms)`` tuples returned by :func:`get_stacks_geometry`
+
+    p_number_of_cores <int>
+        Number of cores used by the workflow
+
+    p_timing_models <dict>
+        Timing models (default is :data:`TIMING_MODELS`)
+
+    Returns
+    -------
+    plan <dict>
+        Prediction with the number of nodes, the estimated time, threads and memory of
+        each node, the total CPU time, the wall time, the peak memory of a step with its
+        parallel iterations, and the critical path
+
+    """
+    import math
+    import networkx as nx
+    from nipype.pipeline import MapNode
+
+    graph = wf._create_flat_graph()
+
+    nodes = dict()
+    wall = dict()
+    cpu_time = 0.0
+    peak_memory = 0.0
+    for node in graph.nodes():
+        duration = estimate_duration_s(node.interface.__class__.__name__, p_geometry, p_timing_models,
+                                       get_work_scale(node.interface))
+        n_procs = max(1, min(node.n_procs, p_number_of_cores))
+        iterations = len(p_geometry) if isinstance(node, MapNode) else 1
+        slots = max(1, p_number_of_cores // n_procs)
+        wall[node] = math.ceil(iterations / float(slots)) * duration
+        cpu_time += iterations * duration * n_procs
+        peak_memory = max(peak_memory, node.mem_gb * min(iterations, slots))
+        nodes[node.fullname] = {"interface": node.interface.__class__.__name__,
+                                "iterations": iterations,
+                                "threads": n_procs,
+                                "duration": round(wall[node], 1),
+                                "mem_gb": round(node.mem_gb, 2)}
+
+    # Longest path weighted by the wall time of the nodes
+    finish = dict()
+    previous = dict()
+    for node in nx.topological_sort(graph):
+        predecessors = list(graph.predecessors(node))
+        start = 0.0
+        previous[node] = None
+        for pred in predecessors:
+            if finish[pred] > start:
+                start = finish[pred]
+                previous[node] = pred
+        finish[node] = start + wall[node]
+
+    critical_path = []
+    node = max(finish, key=finish.get) if finish else None
+    while node is not None:
+        critical_path.insert(0, node.fullname)
+        node = previous[node]
+    critical_time = max(finish.values()) if finish else 0.0
+
+    return {"Number of nodes": len(nodes),
+            "Number of cores": p_number_of_cores,
+            "Estimated CPU time (s)": round(cpu_time, 1),
+            "Estimated wall time (s)": round(max(critical_time, cpu_time / p_number_of_cores), 1),
+            "Estimated peak memory of a step (GB)": round(peak_memory, 2),
+            "Critical path": critical_path,
+            "Critical path time (s)": round(critical_time, 1),
+            "Nodes": nodes}
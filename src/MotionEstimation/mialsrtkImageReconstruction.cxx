@@ -28,6 +28,8 @@ Copyright (c) 2017 Medical Image Analysis Laboratory (MIAL), Lausanne
 #include "itkMinimumMaximumImageCalculator.h"
 #include "itkEuler3DTransform.h"
 #include "itkTransformFileWriter.h"
+#include "itkTransformFileReader.h"
+#include "itkTransformFactory.h"
 #include "itkImage.h"
 #include "itkImageMaskSpatialObject.h"
 #include "itkCastImageFilter.h"
@@ -75,9 +77,11 @@ int main( int argc, char *argv[] )
   std::vector< std::string > input;
   std::vector< std::string > mask;
   std::vector< std::string > transform;
+  std::vector< std::string > initTransform;
   std::vector< std::string > roi;
   std::vector< std::string > resampled;
   unsigned int itMax;
+  unsigned int refineIter;
   double epsilon;
   double margin;
 
@@ -95,6 +99,9 @@ int main( int argc, char *argv[] )
   TCLAP::MultiArg<std::string> maskArg("m","","Mask file",false,"string",cmd);
   TCLAP::MultiArg<std::string> transformArg("t","transform","Transform output "
       "file",false,"string",cmd);
+  TCLAP::MultiArg<std::string> initTransformArg("","init-transform","Initial slice by slice "
+      "transform of each image, e.g. estimated by a previous reconstruction with the same "
+      "target image, or 'none' to initialize it with the global rigid registration",false,"string",cmd);
   TCLAP::MultiArg<std::string> roiArg("","roi","roi file (written as mask)",false,
       "string",cmd);
   TCLAP::MultiArg<std::string> resampledArg("","ir","Resampled image with initial "
@@ -107,6 +114,9 @@ int main( int argc, char *argv[] )
       "masks combined in a single one",false,"","string",cmd);
   TCLAP::ValueArg<unsigned int> iterArg("n","iter","Maximum number of iterations"
       " (default 10)",false, 10,"unsigned int",cmd);
+  TCLAP::ValueArg<unsigned int> refineIterArg("","refine-iter","Maximum number of iterations"
+      " of the slice by slice registration of the images initialized with --init-transform"
+      " (default 200, 0 keeps their initial transforms)",false, 200,"unsigned int",cmd);
   TCLAP::ValueArg<double> epsilonArg("e","epsilon","Minimal percent change between "
       "two iterations considered as convergence. (default 0.0001)",false, 1e-4,
       "double",cmd);
@@ -151,9 +161,11 @@ int main( int argc, char *argv[] )
   refImage = refArg.getValue();
   combinedMask = combinedMaskArg.getValue().c_str();
   transform = transformArg.getValue();
+  initTransform = initTransformArg.getValue();
   roi = roiArg.getValue();
   resampled = resampledArg.getValue();
   itMax = iterArg.getValue();
+  refineIter = refineIterArg.getValue();
   epsilon = epsilonArg.getValue();
   margin = marginArg.getValue();
 
@@ -398,11 +410,35 @@ int main( int argc, char *argv[] )
     hrRefImage = lowToHighResFilter->GetHighResolutionImage();
   }
 
+  if ( initTransform.size() > 0 && initTransform.size() != numberOfImages )
+  {
+    std::cerr << "error: --init-transform should be given once per image" << std::endl;
+    return EXIT_FAILURE;
+  }
+
+  // Register the SliceBySlice transform (a non-default ITK transform) with the TransformFactory of ITK
+  itk::TransformFactory<TransformType>::RegisterTransform();
+
+  std::vector< bool > warmStarted(numberOfImages, false);
+
   for (unsigned int i=0; i<numberOfImages; i++)
   {
     if (rigid3D)
     {
       rigid3DTransforms[i] = lowToHighResFilter -> GetTransformArray(i);
+    }else if ( initTransform.size() > 0 && initTransform[i] != "none" )
+    {
+      // Warm start from a previous slice by slice transform
+      std::cout<<"Reading initial transform : "<<initTransform[i]<<"\n";
+      typedef itk::TransformFileReader TransformReaderType;
+      TransformReaderType::Pointer transformReader = TransformReaderType::New();
+      transformReader -> SetFileName( initTransform[i] );
+      transformReader -> Update();
+
+      TransformReaderType::TransformListType * transformsList = transformReader -> GetTransformList();
+      transforms[i] = static_cast< TransformType * >( transformsList -> begin() -> GetPointer() );
+      transforms[i] -> SetImage( images[i] );
+      warmStarted[i] = true;
     }else
     {
       transforms[i] = TransformType::New();
@@ -487,6 +523,8 @@ int main( int argc, char *argv[] )
 
           if (noreg)
             registration[im] -> SetIterations( 0 );
+          else if (warmStarted[im])
+            registration[im] -> SetIterations( refineIter );
 
           try
             {